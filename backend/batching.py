@@ -0,0 +1,169 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+
+
+class BatchingEngine:
+    """
+    Merge single-image inference calls into micro-batches.
+
+    Callers submit one preprocessed image for a named model and get back the
+    probability row for that image. One worker thread per model collects
+    requests until either `max_batch_size` images are queued or `max_wait_ms`
+    has passed since the first one arrived, then runs a single forward pass
+    through `run_batch(model_name, batch)`.
+
+    With `enabled=False` every call runs immediately as a batch of one, which
+    is the old per-request behaviour.
+    """
+
+    def __init__(self, run_batch: Callable[[str, np.ndarray], np.ndarray],
+                 max_batch_size: int = 16, max_wait_ms: float = 5.0, enabled: bool = True):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.enabled = enabled
+
+        self._queues: Dict[str, queue.Queue] = {}
+        self._workers: Dict[str, threading.Thread] = {}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+        self._requests = 0
+        self._batches = 0
+        self._batched_images = 0
+        self._max_seen_batch = 0
+        self._queue_wait = 0.0
+
+    def submit(self, model_name: str, x: np.ndarray) -> Future:
+        """
+        Queue one image of shape (size, size, 3) and return a future with its probabilities.
+        """
+        future = Future()
+        if not self.enabled:
+            try:
+                future.set_result(self._run(model_name, [x])[0])
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        self._queue_for(model_name).put((x, future, time.perf_counter()))
+        return future
+
+    def submit_many(self, model_name: str, images: np.ndarray) -> List[Future]:
+        """
+        Queue a batch of images together, so they run in as few forward passes as
+        `max_batch_size` allows (alongside any single requests queued meanwhile).
+        """
+        if not self.enabled:
+            futures = [Future() for _ in images]
+            try:
+                probs = self._run(model_name, list(images))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                return futures
+            for row, future in zip(probs, futures):
+                future.set_result(row)
+            return futures
+
+        q = self._queue_for(model_name)
+        futures = []
+        queued = time.perf_counter()
+        for x in images:
+            future = Future()
+            q.put((x, future, queued))
+            futures.append(future)
+        return futures
+
+    def predict(self, model_name: str, x: np.ndarray, timeout: float = None) -> np.ndarray:
+        return self.submit(model_name, x).result(timeout=timeout)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait_ms,
+                'requests': self._requests,
+                'batches': self._batches,
+                'avg_batch_size': self._batched_images / self._batches if self._batches else 0.0,
+                'max_seen_batch_size': self._max_seen_batch,
+                'avg_queue_wait_ms': 1000 * self._queue_wait / self._batched_images if self._batched_images else 0.0,
+            }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._stopped = True
+            queues = list(self._queues.values())
+        for q in queues:
+            q.put(None)
+
+    def _queue_for(self, model_name: str) -> queue.Queue:
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Batching engine has been shut down")
+            q = self._queues.get(model_name)
+            if q is None:
+                q = queue.Queue()
+                worker = threading.Thread(target=self._worker, args=(model_name, q),
+                                          name=f"batching-{model_name}", daemon=True)
+                self._queues[model_name] = q
+                self._workers[model_name] = worker
+                worker.start()
+            return q
+
+    def _worker(self, model_name: str, q: queue.Queue) -> None:
+        while True:
+            first = q.get()
+            if first is None:
+                return
+            pending = [first]
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = q.get(timeout=remaining) if remaining > 0 else q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    q.put(None)
+                    break
+                pending.append(item)
+            self._dispatch(model_name, pending)
+
+    def _dispatch(self, model_name: str, pending: List[Tuple[np.ndarray, Future, float]]) -> None:
+        # Callers may have cancelled their future while it was queued; those images are not run,
+        # and the others can no longer be cancelled
+        pending = [item for item in pending if item[1].set_running_or_notify_cancel()]
+        if not pending:
+            return
+        started = time.perf_counter()
+        with self._lock:
+            self._queue_wait += sum(started - queued for _, _, queued in pending)
+        try:
+            probs = self._run(model_name, [x for x, _, _ in pending])
+        except Exception as e:
+            for _, future, _ in pending:
+                future.set_exception(e)
+            return
+        for row, (_, future, _) in zip(probs, pending):
+            future.set_result(row)
+
+    def _run(self, model_name: str, images: List[np.ndarray]) -> np.ndarray:
+        batch = np.stack(images)
+        probs = np.asarray(self.run_batch(model_name, batch))
+        if len(probs) != len(images):
+            # Results could not be matched to their callers
+            raise RuntimeError(f"Model '{model_name}' returned {len(probs)} results for a batch of {len(images)}")
+        with self._lock:
+            self._requests += len(images)
+            self._batches += 1
+            self._batched_images += len(images)
+            self._max_seen_batch = max(self._max_seen_batch, len(images))
+        return probs
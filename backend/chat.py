@@ -0,0 +1,475 @@
+"""
+Gemini chat for the backend.
+
+Replies are streamed from the Gemini REST API as server-sent events over one
+pooled `requests.Session`, so the upstream connection is kept alive and
+reused between messages instead of being set up per request. Upstream calls
+run on a bounded thread pool: slow chats queue there rather than tying up
+the threads that serve /predict.
+
+Each client gets its own `ChatSession` from a `SessionStore`, with a bounded
+history window and idle/memory eviction. Replies to the canned per-body-part
+questions are shared across sessions through a `ResponseCache`.
+
+Set GEMINI_BASE_URL to the address of `stub_llm.py` to run without an API key.
+"""
+import copy
+import json
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List
+import requests
+from requests.adapters import HTTPAdapter
+
+default_base_url = 'https://generativelanguage.googleapis.com'
+
+# Create the model with the required configuration
+generation_config = {
+    "temperature": 1,
+    "topP": 0.95,
+    "topK": 40,
+    "maxOutputTokens": 8192,
+    "responseMimeType": "text/plain",
+}
+
+system_prompt = (
+    "You are Vivi, a knowledgeable and compassionate medical assistant chatbot. Your primary function is to provide guidance and information about bone fractures. You have an extensive understanding of bone anatomy, fracture types, common causes, symptoms, and treatment options. \n\n### Initial Greeting:\n1. Greet the user warmly and introduce yourself.\n   Example: \"Hello! I’m Vivi, your assistant. Let me provide you with information about fractures.\"\n\n### Provide Fracture Information Based on Body Part:\n2. When the user mentions a body part, immediately provide detailed information about fractures related to that body part:\n   - **For fractures:**\n     - Describe possible fracture types (e.g., closed, open, greenstick, spiral).\n     - Explain the typical causes (e.g., falls, accidents).\n     - Offer information on symptoms (e.g., swelling, pain, deformity).\n     - Suggest next steps: \"It's important to see a healthcare provider for a diagnosis.\"\n     - Offer advice for immediate care (e.g., immobilizing the area, applying ice).\n   - **For no fractures:**\n     - Reassure the user that their symptoms might not be due to a fracture.\n     - Advise seeing a doctor for confirmation if symptoms persist.\n     - Suggest ways to manage pain (e.g., rest, pain relievers).\n\n### Example Interactions:\n- **User:** \"I think I fractured my wrist.\"\n- **Vivi:** \"Wrist fractures often happen from falls or impacts. Symptoms may include swelling, bruising, and pain around the wrist. If this is indeed a fracture, it’s important to immobilize the wrist and consult a healthcare provider for further evaluation.\"\n\n- **User:** \"I think I broke my leg.\"\n- **Vivi:** \"Leg fractures commonly result from direct trauma, like a fall or car accident. They may cause severe pain, swelling, and inability to move the leg. Avoid putting weight on the leg and seek immediate medical attention.\"\n\n- **User:** \"It just hurts a lot.\"\n- **Vivi:** \"Pain in a bone may be from bruising or a sprain rather than a fracture. If you're unsure, I recommend seeing a doctor to rule out any serious injury and get appropriate care.\"\n\n### Empathy:\n- Always respond with empathy and professionalism. Avoid offering direct medical advice and recommend that users see a healthcare provider for an accurate diagnosis and treatment.\n"
+)
+greeting = "Hello! I am Vivi, your assistant. Let me provide you with information about fractures."
+
+
+def initial_history(prompt: str = system_prompt, reply: str = greeting) -> List[Dict]:
+    """
+    History every conversation starts from: the instructions and Vivi's greeting.
+    """
+    return [
+        {"role": "user", "parts": [{"text": prompt}]},
+        {"role": "model", "parts": [{"text": reply}]},
+    ]
+
+
+def _text(payload: Dict) -> str:
+    # Text of the first candidate of a generateContent response
+    candidates = payload.get('candidates') or []
+    if not candidates:
+        return ''
+    return ''.join(part.get('text', '') for part in candidates[0].get('content', {}).get('parts', []))
+
+
+class GeminiClient:
+    """
+    Minimal client for the Gemini `generateContent` and `streamGenerateContent` endpoints.
+    """
+
+    def __init__(self, api_key: str, model: str = 'gemini-1.5-pro', base_url: str = default_base_url,
+                 config: Dict = None, timeout: float = 60.0, pool_size: int = 8):
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+        self.config = config or generation_config
+        self.timeout = timeout
+        self.session = requests.Session()
+        # One keep-alive connection per concurrent chat, reused across messages
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json', 'x-goog-api-key': api_key})
+
+    def _url(self, method: str) -> str:
+        return f"{self.base_url}/v1beta/models/{self.model}:{method}"
+
+    def generate(self, contents: List[Dict]) -> str:
+        response = self.session.post(self._url('generateContent'), timeout=self.timeout,
+                                     json={'contents': contents, 'generationConfig': self.config})
+        response.raise_for_status()
+        return _text(response.json())
+
+    def stream(self, contents: List[Dict]) -> Iterator[str]:
+        """
+        Yield the reply text chunk by chunk as the model produces it.
+        """
+        with self.session.post(self._url('streamGenerateContent'), params={'alt': 'sse'}, stream=True,
+                               timeout=self.timeout,
+                               json={'contents': contents, 'generationConfig': self.config}) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith('data:'):
+                    text = _text(json.loads(line[len('data:'):]))
+                    if text:
+                        yield text
+
+
+class ChatSession:
+    """
+    One conversation. A turn is added to the history only once its reply has
+    completed, so an interrupted stream leaves the history unchanged.
+
+    With `max_turns` set, only the instructions and the last `max_turns`
+    exchanges are sent upstream; older ones are dropped.
+    """
+
+    def __init__(self, client: GeminiClient, history: List[Dict] = None, max_turns: int = None):
+        self.client = client
+        self.history = history if history is not None else initial_history()
+        self.max_turns = max_turns
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        # Entries that are never trimmed, and the bytes of text held beyond them
+        self._base = len(self.history)
+        self.nbytes = 0
+
+    def send_message(self, message: str) -> str:
+        return ''.join(self.stream_message(message))
+
+    def stream_message(self, message: str) -> Iterator[str]:
+        turn = {"role": "user", "parts": [{"text": message}]}
+        with self.lock:
+            contents = self.history + [turn]
+        reply = []
+        for text in self.client.stream(contents):
+            reply.append(text)
+            yield text
+        self.record(message, ''.join(reply))
+
+    def record(self, message: str, reply: str) -> None:
+        """
+        Add a completed exchange to the history.
+        """
+        with self.lock:
+            self.history.extend([{"role": "user", "parts": [{"text": message}]},
+                                 {"role": "model", "parts": [{"text": reply}]}])
+            if self.max_turns is not None and len(self.history) - self._base > 2 * self.max_turns:
+                del self.history[self._base:len(self.history) - 2 * self.max_turns]
+            self.nbytes = sum(len(part['text'].encode()) for entry in self.history[self._base:]
+                              for part in entry['parts'])
+            self.last_used = time.monotonic()
+
+    def fresh(self) -> "ChatSession":
+        """
+        A new session with the same instructions and none of this session's exchanges.
+        """
+        with self.lock:
+            base = copy.deepcopy(self.history[:self._base])
+        return ChatSession(self.client, base, self.max_turns)
+
+
+class SessionStore:
+    """
+    Chat sessions keyed by a client-chosen session id, so each user has their
+    own conversation. Least recently used sessions are dropped once they have
+    been idle for `idle_seconds`, once there are more than `max_sessions`, or
+    while the history held by all sessions exceeds `max_bytes`.
+    """
+
+    def __init__(self, client: GeminiClient, history_factory: Callable[[], List[Dict]] = initial_history,
+                 max_turns: int = 10, idle_seconds: float = 1800.0, max_sessions: int = 1000,
+                 max_bytes: int = 64 * 2 ** 20):
+        self.client = client
+        self.history_factory = history_factory
+        self.max_turns = max_turns
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'evicted_idle': 0, 'evicted_capacity': 0}
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    def get(self, session_id: str) -> ChatSession:
+        """
+        Session `session_id`, started from the initial history if it does not exist (or was evicted).
+        """
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(self.client, self.history_factory(), self.max_turns)
+                self._sessions[session_id] = session
+                self._stats['created'] += 1
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            self._evict_over_limit(keep=session_id)
+            return session
+
+    def fresh(self) -> ChatSession:
+        """
+        A new session that is not stored, e.g. to warm the response cache.
+        """
+        return ChatSession(self.client, self.history_factory(), self.max_turns)
+
+    def drop(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, sessions=len(self._sessions),
+                        history_bytes=sum(s.nbytes for s in self._sessions.values()))
+
+    def _evict_idle(self) -> None:
+        # Caller holds the lock; sessions are ordered by last use
+        deadline = time.monotonic() - self.idle_seconds
+        while self._sessions and next(iter(self._sessions.values())).last_used < deadline:
+            self._sessions.popitem(last=False)
+            self._stats['evicted_idle'] += 1
+
+    def _evict_over_limit(self, keep: str) -> None:
+        # Caller holds the lock
+        total = sum(s.nbytes for s in self._sessions.values())
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions or total > self.max_bytes):
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                break
+            total -= self._sessions.pop(oldest).nbytes
+            self._stats['evicted_capacity'] += 1
+
+
+# Query the frontend sends after a prediction
+fracture_query = "tell me more about the fracture in my {part}"
+
+# Phrasings treated as the same question about a body part
+fracture_patterns = [
+    re.compile(r"^(?:tell me )?(?:more )?about (?:the )?fracture in my (?P<part>\w+)$"),
+    re.compile(r"^(?:tell me )?(?:more )?about my (?P<part>\w+) fracture$"),
+]
+
+
+class ResponseCache:
+    """
+    Replies to the canned per-body-part questions, shared by all sessions.
+
+    A message is cacheable when, after lower-casing and trimming whitespace
+    and trailing punctuation, it matches one of `patterns` with a known body
+    part; every phrasing of the same question maps to one entry. Entries
+    expire after `ttl` seconds and the least recently used is dropped beyond
+    `max_entries`. While one request generates a reply, others asking the
+    same question wait for it instead of calling the model too.
+    """
+
+    def __init__(self, parts: List[str], max_entries: int = 256, ttl: float = None, patterns=None):
+        self.parts = {part.lower(): part for part in parts}
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.patterns = patterns or fracture_patterns
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._pending: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'saved_ms': 0.0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, message: str) -> str:
+        """
+        Cache key of `message`, or None if it is not one of the canned questions.
+        """
+        if not self.enabled:
+            return None
+        text = ' '.join(message.lower().split()).rstrip('?.!')
+        for pattern in self.patterns:
+            match = pattern.match(text)
+            if match and match.group('part') in self.parts:
+                return f"fracture:{self.parts[match.group('part')]}"
+        return None
+
+    def lookup(self, key: str, timeout: float = None) -> tuple:
+        """
+        Returns (reply, leader). On a miss exactly one caller becomes the leader,
+        which must call `put` or `release`; the others wait for its reply.
+        """
+        with self._lock:
+            reply = self._get(key)
+            if reply is not None:
+                return reply, False
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = threading.Event()
+                self._stats['misses'] += 1
+                return None, True
+        pending.wait(timeout)
+        with self._lock:
+            reply = self._get(key)
+            if reply is None:
+                self._stats['misses'] += 1
+            return reply, False
+
+    def put(self, key: str, reply: str, seconds: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        self.release(key)
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries and not self._expired(self._entries[key][0])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _get(self, key: str) -> str:
+        # Caller holds the lock; counts a hit and the model time it saved
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, reply, seconds = entry
+        if self._expired(created):
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self._stats['hits'] += 1
+        self._stats['saved_ms'] += seconds * 1000
+        return reply
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl is not None and time.monotonic() - created > self.ttl
+
+
+_done = object()
+
+
+class ChatService:
+    """
+    Runs chat sessions on a bounded pool of `max_workers` threads.
+    `stream` hands chunks to the caller through a queue as they arrive.
+    Questions found in `response_cache` are answered without calling the model.
+    Replies that go into the cache are generated without the asking session's
+    earlier turns, since they are served to every session.
+    """
+
+    def __init__(self, max_workers: int = 8, timeout: float = 120.0, response_cache: ResponseCache = None):
+        self.timeout = timeout
+        self.response_cache = response_cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat')
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'in_flight': 0, 'first_chunk_ms_total': 0.0, 'first_chunks': 0}
+
+    def send(self, session: ChatSession, message: str) -> str:
+        return ''.join(self.stream(session, message))
+
+    def stream(self, session: ChatSession, message: str) -> Iterator[str]:
+        cache = self.response_cache
+        key = cache.key(message) if cache is not None else None
+        leader = False
+        if key is not None:
+            reply, leader = cache.lookup(key, self.timeout)
+            if reply is not None:
+                session.record(message, reply)
+                yield reply
+                return
+
+        if not leader:
+            yield from self._stream_upstream(session, message)
+            return
+
+        # The reply will be cached for every session, so it must not depend on this one's history
+        start = time.perf_counter()
+        reply = []
+        try:
+            for text in self._stream_upstream(session.fresh(), message):
+                reply.append(text)
+                yield text
+            reply = ''.join(reply)
+            cache.put(key, reply, time.perf_counter() - start)
+            session.record(message, reply)
+        finally:
+            cache.release(key)
+
+    def warm(self, messages: List[str], session_factory: Callable[[], ChatSession]) -> threading.Thread:
+        """
+        Fill the response cache with replies to `messages` in a background thread,
+        each generated in a fresh session.
+        """
+        def run():
+            for message in messages:
+                key = self.response_cache.key(message)
+                if key is None or self.response_cache.contains(key):
+                    continue
+                try:
+                    self.send(session_factory(), message)
+                except Exception as e:
+                    print(f"Chat cache warm-up failed for '{message}': {e}")
+
+        thread = threading.Thread(target=run, name='chat-cache-warm', daemon=True)
+        thread.start()
+        return thread
+
+    def _stream_upstream(self, session: ChatSession, message: str) -> Iterator[str]:
+        chunks: "queue.Queue" = queue.Queue()
+        cancelled = threading.Event()
+        start = time.perf_counter()
+
+        def produce():
+            try:
+                for text in session.stream_message(message):
+                    if cancelled.is_set():
+                        # The client went away: stop reading from upstream
+                        return
+                    chunks.put(text)
+                chunks.put(_done)
+            except Exception as e:
+                chunks.put(e)
+
+        self._count('requests')
+        self._count('in_flight')
+        self.executor.submit(produce)
+        first = True
+        try:
+            while True:
+                try:
+                    item = chunks.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No reply from the chat model within {self.timeout:.0f}s")
+                if item is _done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                if first:
+                    first = False
+                    self._count('first_chunks')
+                    self._count('first_chunk_ms_total', (time.perf_counter() - start) * 1000)
+                yield item
+        except Exception:
+            self._count('errors')
+            raise
+        finally:
+            cancelled.set()
+            self._count('in_flight', -1)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+        first_chunks = stats.pop('first_chunks')
+        total = stats.pop('first_chunk_ms_total')
+        stats['avg_first_chunk_ms'] = total / first_chunks if first_chunks else 0.0
+        if self.response_cache is not None:
+            stats['cache'] = self.response_cache.stats()
+        return stats
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        with self._lock:
+            self._stats[key] += amount
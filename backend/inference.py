@@ -0,0 +1,60 @@
+"""
+The models behind the API and the one function that runs them.
+
+`model_dict` is the shared registry (see model_training/registry.py), with
+the fused and embedding models registered on top of it. `run_batch(name,
+batch)` returns the probabilities of one batch: in this process, or, when
+serve.py has set MODEL_SERVER, in its shared model process (see
+model_server.py), so the workers never load weights of their own.
+"""
+import os
+import sys
+from typing import Dict
+import numpy as np
+from model_server import ModelClient
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(THIS_FOLDER, '..', 'model_training'))
+from cascade import build_fused_model, feature_extractor
+from registry import registry_from_env
+
+max_batch_size = int(os.environ.get('BATCH_MAX_SIZE', 16))
+
+# Models are loaded through the shared registry (lazily by default, see MODEL_LOAD_MODE),
+# each warmed for single requests and for full micro-batches
+model_dict = registry_from_env("./weights", warmup_batch_sizes=(1, max_batch_size))
+
+# INFERENCE_MODE selects how /predict uses the models:
+#   cascade - body part model, then only the fracture model of that part (2 passes)
+#   fused   - one graph sharing the ResNet50 backbone across all four heads (1 pass)
+#   legacy  - parts model followed by all three fracture models
+inference_mode = os.environ.get('INFERENCE_MODE', 'cascade')
+if inference_mode == 'fused':
+    if model_dict.runtime == 'keras':
+        model_dict.register('Fused', lambda: model_dict.prepare(build_fused_model(model_dict)))
+    else:
+        # Exported by `export_runtime.py --fused`
+        model_dict.register('Fused', lambda: model_dict.loader(model_dict.model_path('Fused')))
+
+# Embeddings for /similar come from the backbone of the Keras body part model
+if model_dict.runtime == 'keras':
+    model_dict.register('Embedding', lambda: model_dict.prepare(feature_extractor(model_dict['Parts'])))
+
+# Set by serve.py for its workers: the models are then held by one process for all of them
+model_server = None
+if os.environ.get('MODEL_SERVER'):
+    model_server = ModelClient(os.environ['MODEL_SERVER'], bytes.fromhex(os.environ.get('MODEL_SERVER_KEY', '')))
+
+
+def run_batch(name: str, batch: np.ndarray) -> np.ndarray:
+    """
+    Probabilities of model `name` for a batch of decoded (224, 224, 3) images.
+    """
+    if model_server is not None:
+        return model_server.predict(name, batch)
+    return model_dict[name].predict(batch, verbose=0)
+
+
+def load_stats() -> Dict[str, Dict[str, float]]:
+    # Load state, load time and memory of each model, from the process that holds them
+    return model_server.stats() if model_server is not None else model_dict.stats()
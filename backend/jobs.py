@@ -0,0 +1,406 @@
+"""
+Asynchronous prediction jobs for the backend.
+
+A client submits an upload and gets a job id straight away; the upload is
+classified later by a pool of worker threads, and the result is fetched by
+polling or pushed to a callback URL. Jobs wait in a bounded broker queue:
+when it is full, submissions are refused (the API answers 429) instead of
+piling up behind the models. Higher-priority jobs are served first, each
+job records how long it queued and ran, and finished results expire after
+`result_ttl` seconds.
+
+Callback URLs must resolve to public addresses (or to a host on an explicit
+allow-list), so a submission cannot make the server POST to itself or to
+the internal network. Callbacks are sent from their own small thread pool,
+with retries, so a slow receiver never holds up inference.
+
+Two brokers are provided as local stand-ins for a real one:
+  MemoryBroker - in-process, for a single server process
+  SQLiteBroker - a SQLite file, shared by all workers of serve.py on one machine
+"""
+import json
+import heapq
+import ipaddress
+import itertools
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Collection, Dict, List, Optional
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first
+priorities = {'high': 0, 'normal': 1, 'low': 2}
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class QueueFull(Exception):
+    """
+    Raised by `submit` when the broker already holds `max_queued` waiting jobs.
+    """
+
+
+def check_callback_url(url: str, allowed_hosts: Collection[str] = ()) -> None:
+    """
+    Raise ValueError unless `url` is an http(s) URL whose host is in
+    `allowed_hosts` or resolves only to public addresses (not loopback,
+    private, link-local, reserved or multicast).
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    if parts.hostname.lower() in allowed_hosts:
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)}
+    except (OSError, ValueError) as e:
+        raise ValueError(f"callback_url host cannot be resolved: {e}")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"callback_url must not point to a non-public address ({address})")
+
+
+class Job:
+    def __init__(self, job_id: str, payload: bytes, priority: int = priorities['normal'], filename: str = '',
+                 callback_url: str = None, submitted: float = None):
+        self.id = job_id
+        self.payload = payload
+        self.priority = priority
+        self.filename = filename
+        self.callback_url = callback_url
+        self.status = QUEUED
+        self.submitted = submitted or time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.status_code = None
+
+    @property
+    def priority_name(self) -> str:
+        return next(name for name, value in priorities.items() if value == self.priority)
+
+    def to_dict(self) -> Dict[str, object]:
+        """
+        Job as returned by the API: state, result or error, and timings in milliseconds.
+        """
+        body = {'job_id': self.id, 'status': self.status, 'filename': self.filename,
+                'priority': self.priority_name}
+        if self.status in (DONE, FAILED):
+            body['result'] = self.result if self.status == DONE else {'error': self.error}
+            body['status_code'] = self.status_code
+        end = self.finished or time.time()
+        body['timings'] = {
+            'queue_ms': ((self.started or end) - self.submitted) * 1000,
+            'run_ms': (end - self.started) * 1000 if self.started else 0.0,
+            'total_ms': (end - self.submitted) * 1000,
+        }
+        return body
+
+
+class MemoryBroker:
+    """
+    In-process broker: a bounded priority queue of waiting jobs (first in,
+    first out within a priority) plus a table of every job until it expires.
+    """
+
+    def __init__(self, max_queued: int = 256, result_ttl: float = 3600):
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._jobs: Dict[str, Job] = {}
+        self._queue: List[tuple] = []
+        self._order = itertools.count()
+        self._ready = threading.Condition()
+
+    def put(self, job: Job) -> None:
+        with self._ready:
+            if len(self._queue) >= self.max_queued:
+                raise QueueFull(f"{len(self._queue)} jobs are already waiting")
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (job.priority, next(self._order), job.id))
+            self._ready.notify()
+
+    def claim(self, timeout: float = None) -> Optional[Job]:
+        """
+        Take the next waiting job and mark it running, waiting up to `timeout` seconds for one.
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._queue, timeout):
+                return None
+            _, _, job_id = heapq.heappop(self._queue)
+            job = self._jobs[job_id]
+            job.status = RUNNING
+            job.started = time.time()
+            return job
+
+    def finish(self, job: Job) -> None:
+        with self._ready:
+            # The upload is not needed once the job has run
+            job.payload = None
+            self._jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._ready:
+            return self._jobs.get(job_id)
+
+    def expire(self) -> int:
+        """
+        Forget finished jobs older than `result_ttl`; returns how many were dropped.
+        """
+        cutoff = time.time() - self.result_ttl
+        with self._ready:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and job.finished < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            return len(expired)
+
+    def counts(self) -> Dict[str, int]:
+        with self._ready:
+            counts = {state: 0 for state in (QUEUED, RUNNING, DONE, FAILED)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+
+class SQLiteBroker:
+    """
+    Broker kept in a SQLite file, so a job submitted to one serve.py worker
+    process can be run by any of them and polled through any of them.
+    Workers poll the table for new jobs every `poll_interval` seconds.
+
+    A claimed job is leased for `lease_seconds`: if it is still running after
+    that, its worker is assumed to have died and the job is queued again, or
+    failed once it has been claimed `max_attempts` times.
+    """
+
+    def __init__(self, path: str, max_queued: int = 256, result_ttl: float = 3600, poll_interval: float = 0.05,
+                 lease_seconds: float = 300, max_attempts: int = 2):
+        self.path = path
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "id TEXT PRIMARY KEY, priority INTEGER, status TEXT, filename TEXT, callback_url TEXT, "
+                       "payload BLOB, result TEXT, error TEXT, status_code INTEGER, "
+                       "submitted REAL, started REAL, finished REAL, attempts INTEGER DEFAULT 0)")
+            # Files created before jobs were leased
+            if 'attempts' not in [row[1] for row in db.execute("PRAGMA table_info(jobs)")]:
+                db.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER DEFAULT 0")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, submitted)")
+
+    def put(self, job: Job) -> None:
+        db = self._connect()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            queued = db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFull(f"{queued} jobs are already waiting")
+            db.execute("INSERT INTO jobs (id, priority, status, filename, callback_url, payload, submitted) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (job.id, job.priority, QUEUED, job.filename, job.callback_url, job.payload, job.submitted))
+
+    def claim(self, timeout: float = None) -> Optional[Job]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        db = self._connect()
+        while True:
+            with db:
+                # The write lock makes selecting and marking the job one step across processes
+                db.execute("BEGIN IMMEDIATE")
+                now = time.time()
+                self._recover(db, now)
+                row = db.execute("SELECT id FROM jobs WHERE status = ? ORDER BY priority, submitted LIMIT 1",
+                                 (QUEUED,)).fetchone()
+                if row is not None:
+                    db.execute("UPDATE jobs SET status = ?, started = ?, attempts = attempts + 1 WHERE id = ?",
+                               (RUNNING, now, row[0]))
+            if row is not None:
+                return self.get(row[0], with_payload=True)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def finish(self, job: Job) -> None:
+        db = self._connect()
+        with db:
+            db.execute("UPDATE jobs SET status = ?, payload = NULL, result = ?, error = ?, status_code = ?, "
+                       "finished = ? WHERE id = ?",
+                       (job.status, json.dumps(job.result) if job.result is not None else None, job.error,
+                        job.status_code, job.finished, job.id))
+
+    def get(self, job_id: str, with_payload: bool = False) -> Optional[Job]:
+        row = self._connect().execute(
+            "SELECT id, priority, status, filename, callback_url, payload, result, error, status_code, "
+            "submitted, started, finished FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = Job(row[0], row[5] if with_payload else None, row[1], row[3], row[4], row[9])
+        job.status, job.status_code, job.started, job.finished = row[2], row[8], row[10], row[11]
+        job.result = json.loads(row[6]) if row[6] is not None else None
+        job.error = row[7]
+        return job
+
+    def expire(self) -> int:
+        db = self._connect()
+        with db:
+            return db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                              (time.time() - self.result_ttl,)).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        counts = {state: 0 for state in (QUEUED, RUNNING, DONE, FAILED)}
+        for status, count in self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[status] = count
+        return counts
+
+    def _recover(self, db: sqlite3.Connection, now: float) -> None:
+        # Caller holds the write lock; requeues or fails jobs whose lease ran out
+        expired = now - self.lease_seconds
+        db.execute("UPDATE jobs SET status = ?, payload = NULL, error = ?, status_code = 500, finished = ? "
+                   "WHERE status = ? AND started < ? AND attempts >= ?",
+                   (FAILED, f"The job was abandoned by its worker {self.max_attempts} times", now,
+                    RUNNING, expired, self.max_attempts))
+        db.execute("UPDATE jobs SET status = ?, started = NULL WHERE status = ? AND started < ?",
+                   (QUEUED, RUNNING, expired))
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread; transactions are opened explicitly
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+
+class JobQueue:
+    """
+    Pool of `workers` threads running `process(job)` on the jobs of `broker`.
+
+    `process` returns (status code, result body); a status code of 400 or
+    more marks the job failed. When a job has a `callback_url`, its final
+    state is POSTed there as JSON by one of `callback_workers` threads,
+    retried up to `callback_retries` times with exponential backoff. Callback
+    hosts must be public unless listed in `callback_hosts`. `on_finish(job)`
+    is called after each job, e.g. to record metrics.
+    """
+
+    def __init__(self, broker, process: Callable[[Job], tuple], workers: int = 4,
+                 on_finish: Callable[[Job], None] = None, callback_timeout: float = 10.0,
+                 expire_interval: float = 60.0, callback_workers: int = 2, callback_retries: int = 3,
+                 callback_hosts: Collection[str] = ()):
+        self.broker = broker
+        self.process = process
+        self.on_finish = on_finish
+        self.callback_timeout = callback_timeout
+        self.callback_retries = callback_retries
+        self.callback_hosts = {host.lower() for host in callback_hosts}
+        self.expire_interval = expire_interval
+        self._stopped = threading.Event()
+        self._last_expiry = time.monotonic()
+        self._expiry_lock = threading.Lock()
+        self._callbacks = requests.Session()
+        self._callback_pool = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix='job-callbacks')
+        self._threads = [threading.Thread(target=self._worker, name=f"jobs-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, payload: bytes, filename: str = '', priority: str = 'normal', callback_url: str = None) -> Job:
+        """
+        Queue `payload` and return its job; raises QueueFull when the broker is at capacity,
+        and ValueError for an unknown priority or a callback URL that is not allowed.
+        """
+        if priority not in priorities:
+            raise ValueError(f"Priority must be one of {list(priorities)}")
+        if callback_url is not None:
+            check_callback_url(callback_url, self.callback_hosts)
+        job = Job(uuid.uuid4().hex, payload, priorities[priority], filename, callback_url)
+        self.broker.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.broker.get(job_id)
+
+    def stats(self) -> Dict[str, object]:
+        return dict(self.broker.counts(), workers=len(self._threads), max_queued=self.broker.max_queued,
+                    result_ttl=self.broker.result_ttl)
+
+    def shutdown(self, timeout: float = None) -> None:
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._callback_pool.shutdown(wait=False)
+
+    def _worker(self) -> None:
+        while not self._stopped.is_set():
+            self._maybe_expire()
+            job = self.broker.claim(timeout=0.5)
+            if job is None:
+                continue
+            try:
+                job.status_code, body = self.process(job)
+            except Exception as e:
+                job.status_code, body = 500, {'error': f'Error processing the request: {str(e)}'}
+            job.finished = time.time()
+            if job.status_code < 400:
+                job.status, job.result = DONE, body
+            else:
+                job.status, job.error = FAILED, body.get('error', str(body))
+            self.broker.finish(job)
+            # The job is stored; a failing hook or callback must not stop this worker
+            if self.on_finish is not None:
+                try:
+                    self.on_finish(job)
+                except Exception:
+                    logger.exception("on_finish failed for job %s", job.id)
+            if job.callback_url:
+                try:
+                    self._callback_pool.submit(self._notify, job)
+                except RuntimeError as e:
+                    # The callback pool has been shut down
+                    logger.warning("Callback for job %s to %s not sent: %s", job.id, job.callback_url, e)
+
+    def _notify(self, job: Job) -> None:
+        body = job.to_dict()
+        for attempt in range(self.callback_retries + 1):
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            try:
+                # Checked again at send time, in case the host now resolves elsewhere
+                check_callback_url(job.callback_url, self.callback_hosts)
+                response = self._callbacks.post(job.callback_url, json=body, timeout=self.callback_timeout,
+                                                allow_redirects=False)
+                if response.status_code < 500:
+                    return
+                error = f"status {response.status_code}"
+            except ValueError as e:
+                logger.warning("Callback for job %s to %s refused: %s", job.id, job.callback_url, e)
+                return
+            except requests.RequestException as e:
+                error = str(e)
+        logger.warning("Callback for job %s to %s failed after %d attempts: %s", job.id, job.callback_url,
+                       self.callback_retries + 1, error)
+
+    def _maybe_expire(self) -> None:
+        # One worker at a time drops expired results, at most every `expire_interval` seconds
+        if time.monotonic() - self._last_expiry < self.expire_interval or not self._expiry_lock.acquire(False):
+            return
+        try:
+            self._last_expiry = time.monotonic()
+            self.broker.expire()
+        finally:
+            self._expiry_lock.release()
@@ -0,0 +1,256 @@
+"""
+Load test for the /predict endpoint.
+
+Fires concurrent uploads at the app and reports requests/sec and latency.
+Without --url the app is driven in-process through Flask's test client, so
+the batched and per-request paths can be compared on the same machine:
+
+    python load_test.py --compare --concurrency 16 --requests 256
+    python load_test.py --url http://127.0.0.1:5000/predict
+
+Every request posts the same image, so the prediction cache is disabled in
+the in-process app; start a server under test with PREDICTION_CACHE_SIZE=0
+and without PREDICTION_CACHE_PATH, or every request after the first is a hit.
+
+--chat-concurrency keeps that many /chat/stream replies in flight while
+/predict is measured (start `stub_llm.py` and set GEMINI_BASE_URL to avoid
+calling the real API).
+
+--check-metrics posts one streamed /predict_batch and /chat/stream request
+to the in-process app and checks that each is counted once in the request
+latency histogram of /metrics.
+"""
+import argparse
+import io
+import json
+import os
+import threading
+import time
+import uuid
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
+import numpy as np
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+default_image = os.path.join(THIS_FOLDER, '..', 'model_training', 'test', 'Hand', 'fractured', 'broken.jpg')
+default_message = 'tell me more about the fracture in my Hand'
+
+
+def http_sender(url: str, image_path: str, field: str = 'file') -> Callable[[], int]:
+    """
+    Build a function that posts `image_path` to `url` as multipart/form-data and returns the status code.
+    """
+    with open(image_path, 'rb') as f:
+        payload = f.read()
+    boundary = uuid.uuid4().hex
+    filename = os.path.basename(image_path)
+    body = (
+        f"--{boundary}\r\n"
+        f"Content-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: application/octet-stream\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+    def send() -> int:
+        req = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+
+    return send
+
+
+def test_client_sender(app, image_path: str, path: str = '/predict') -> Callable[[], int]:
+    """
+    Build a function that posts `image_path` to the in-process Flask app.
+    """
+    with open(image_path, 'rb') as f:
+        payload = f.read()
+    filename = os.path.basename(image_path)
+
+    def send() -> int:
+        with app.test_client() as client:
+            response = client.post(path, data={'file': (io.BytesIO(payload), filename)},
+                                   content_type='multipart/form-data')
+            return response.status_code
+
+    return send
+
+
+def http_chat_sender(url: str, message: str = default_message) -> Callable[[], int]:
+    """
+    Build a function that posts `message` to a /chat/stream `url` and reads the whole stream.
+    """
+    body = json.dumps({'message': message}).encode()
+
+    def send() -> int:
+        req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+
+    return send
+
+
+def test_client_chat_sender(app, message: str = default_message, path: str = '/chat/stream') -> Callable[[], int]:
+    def send() -> int:
+        with app.test_client() as client:
+            response = client.post(path, json={'message': message})
+            response.get_data()
+            return response.status_code
+
+    return send
+
+
+@contextmanager
+def background_load(send: Callable[[], int], concurrency: int) -> Iterator[Dict[str, int]]:
+    """
+    Keep `concurrency` threads calling `send` until the block exits; yields a count of completed calls.
+    """
+    done = {'completed': 0, 'errors': 0}
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            try:
+                ok = send() == 200
+            except Exception:
+                ok = False
+            done['completed' if ok else 'errors'] += 1
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        yield done
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def run_load(send: Callable[[], int], n_requests: int, concurrency: int) -> Dict[str, float]:
+    """
+    Call `send` `n_requests` times from `concurrency` threads and summarise the results.
+    """
+    def timed(_) -> Tuple[float, int]:
+        start = time.perf_counter()
+        status = send()
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(n_requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(1 for _, status in results if status != 200)
+    return {
+        'requests': n_requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_sec': n_requests / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+def request_count(app, endpoint: str) -> int:
+    """
+    Requests to `endpoint` recorded in fracture_request_seconds, read from /metrics.
+    """
+    prefix = f'fracture_request_seconds_count{{endpoint="{endpoint}"}} '
+    with app.test_client() as client:
+        for line in client.get('/metrics').get_data(as_text=True).splitlines():
+            if line.startswith(prefix):
+                return int(float(line[len(prefix):]))
+    return 0
+
+
+def check_streamed_metrics(app, image_path: str) -> bool:
+    """
+    Send one request to each streamed endpoint and check that it is counted exactly once.
+    """
+    with open(image_path, 'rb') as f:
+        payload = f.read()
+    requests_by_endpoint = {
+        'predict_batch_api': lambda client: client.post(
+            '/predict_batch', data={'files': (io.BytesIO(payload), os.path.basename(image_path))},
+            content_type='multipart/form-data'),
+        'chat_stream': lambda client: client.post('/chat/stream', json={'message': default_message}),
+    }
+    ok = True
+    for endpoint, send in requests_by_endpoint.items():
+        before = request_count(app, endpoint)
+        with app.test_client() as client:
+            response = send(client)
+            response.get_data()
+            response.close()
+        after = request_count(app, endpoint)
+        print(f"  {endpoint: <20}{'ok' if after == before + 1 else f'FAILED: counted {after - before} times'}")
+        ok &= after == before + 1
+    return ok
+
+
+def print_result(title: str, result: Dict[str, float]) -> None:
+    print(f"\n{title}")
+    for key, value in result.items():
+        print(f"  {key: <20}{value:.2f}" if isinstance(value, float) else f"  {key: <20}{value}")
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="Target a running server instead of the in-process app")
+    parser.add_argument('--image', default=default_image)
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--compare', action='store_true',
+                        help="In-process only: also run with batching disabled")
+    parser.add_argument('--chat-concurrency', type=int, default=0,
+                        help="Chat streams kept in flight while /predict is measured")
+    parser.add_argument('--check-metrics', action='store_true',
+                        help="In-process only: check that streamed requests are recorded in /metrics")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        chat_send = http_chat_sender(urllib.parse.urljoin(args.url, '/chat/stream'))
+        with background_load(chat_send, args.chat_concurrency) as chats:
+            result = run_load(http_sender(args.url, args.image), args.requests, args.concurrency)
+        if args.chat_concurrency:
+            result.update({f"chats_{k}": v for k, v in chats.items()})
+        print_result(f"HTTP {args.url}", result)
+        return
+
+    # Must be set before model_v2 creates its prediction cache
+    os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    os.environ.pop('PREDICTION_CACHE_PATH', None)
+    import model_v2
+    if args.check_metrics:
+        print("Streamed requests in fracture_request_seconds:")
+        if not check_streamed_metrics(model_v2.app, args.image):
+            raise SystemExit(1)
+        return
+
+    send = test_client_sender(model_v2.app, args.image)
+    send()  # warm up the models before timing
+
+    modes = [True, False] if args.compare else [model_v2.batch_engine.enabled]
+    for enabled in modes:
+        model_v2.batch_engine.enabled = enabled
+        with background_load(test_client_chat_sender(model_v2.app), args.chat_concurrency) as chats:
+            result = run_load(send, args.requests, args.concurrency)
+        if args.chat_concurrency:
+            result.update({f"chats_{k}": v for k, v in chats.items()})
+        if enabled:
+            result.update({f"engine_{k}": v for k, v in model_v2.batch_engine.stats().items()
+                           if k in ('avg_batch_size', 'max_seen_batch_size', 'avg_queue_wait_ms')})
+        print_result("Batched" if enabled else "Per-request", result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+In-process metrics in the Prometheus text format, and a sampling profiler
+for slow requests. Both are plain Python with no extra dependency.
+"""
+import bisect
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Seconds; from a cached hit (sub-millisecond) to a cold model load
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+batch_size_buckets = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = default_buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count in each bucket (the last one is +Inf), then the sum
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class _Callback:
+    """
+    Metric read from elsewhere (e.g. a `stats()` dict) when /metrics is scraped.
+    """
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.fn():g}"]
+
+
+class MetricsRegistry:
+    """
+    Named counters and histograms rendered together at /metrics.
+
+    Recording costs one lock and a dict update; with `enabled=False` the
+    metrics are still created, but `counter()`/`histogram()` hand out
+    instances whose recording methods do nothing.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames) if self.enabled else _NullCounter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = default_buckets) -> Histogram:
+        metric = Histogram(name, help, labelnames, buckets) if self.enabled else _NullHistogram(name, help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def callback(self, name: str, help: str, fn: Callable[[], float], kind: str = 'gauge') -> None:
+        self._metrics.append(_Callback(name, help, kind, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class _NullCounter(Counter):
+    def inc(self, amount: float = 1, **labels) -> None:
+        pass
+
+
+class _NullHistogram(Histogram):
+    def observe(self, value: float, **labels) -> None:
+        pass
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        yield
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler that writes a profile of each request slower than
+    `threshold_ms`.
+
+    Between `begin` and `end` a background thread records the stack of the
+    request thread every `interval_ms`. When a slow request ends, its samples
+    are written to `out_dir` in the collapsed stack format (`frame;frame;frame
+    count` per line) read by flamegraph.pl and speedscope; samples of requests
+    that finish in time are discarded. The thread starts with the first
+    request and sleeps while none is tracked.
+
+    Work a request hands to other threads (such as the forward passes of the
+    batching engine) is captured by naming them in `follow_threads`: samples
+    of threads whose name starts with one of these prefixes are added to every
+    profile being taken, under a `thread <name>` root frame.
+    """
+
+    def __init__(self, threshold_ms: float, out_dir: str, interval_ms: float = 5.0,
+                 follow_threads: Sequence[str] = ()):
+        self.threshold = threshold_ms / 1000
+        self.out_dir = out_dir
+        self.interval = interval_ms / 1000
+        self.follow_threads = tuple(follow_threads)
+        self.dumps = 0
+        self._active: Dict[int, StackCounter] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._sampler = None
+
+    def begin(self, label: str) -> tuple:
+        """
+        Start sampling the calling thread; pass the result to `end` when the request is done.
+        """
+        samples = StackCounter()
+        with self._lock:
+            self._active[threading.get_ident()] = samples
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="slow-request-profiler", daemon=True)
+                self._sampler.start()
+            self._wake.notify()
+        return threading.get_ident(), label, time.perf_counter(), samples
+
+    def end(self, token: tuple) -> Optional[str]:
+        """
+        Stop sampling; returns the path of the profile written if the request was slow.
+        """
+        thread_id, label, start, samples = token
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._active.pop(thread_id, None)
+        if elapsed < self.threshold or not samples:
+            return None
+        return self._dump(label, elapsed, samples)
+
+    def _sample_loop(self) -> None:
+        while True:
+            with self._lock:
+                while not self._active:
+                    self._wake.wait()
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            followed = [f"thread {thread.name};{_collapse(frames[thread.ident])}" for thread in threading.enumerate()
+                        if thread.name.startswith(self.follow_threads) and thread.ident in frames] \
+                if self.follow_threads else []
+            for thread_id, samples in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[_collapse(frame)] += 1
+                for stack in followed:
+                    samples[stack] += 1
+            time.sleep(self.interval)
+
+    def _dump(self, label: str, elapsed: float, samples: StackCounter) -> str:
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', label)}-{elapsed * 1000:.0f}ms.txt"
+        path = os.path.join(self.out_dir, name)
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self.dumps += 1
+        return path
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
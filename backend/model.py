@@ -1,10 +1,15 @@
 from flask import Flask, request, jsonify
 import os
+import sys
 import numpy as np
-import tensorflow as tf
 import keras
-import google.generativeai as genai
 from flask_cors import CORS
+from chat import GeminiClient, SessionStore, default_base_url, initial_history
+
+# Shared inference code lives next to the training scripts
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(THIS_FOLDER, '..', 'model_training'))
+from registry import registry_from_env
 
 app = Flask(__name__)
 CORS(app, support_credentials=True)
@@ -16,11 +21,8 @@ def after_request(response):
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     return response
 
-# Load models
-model_elbow_frac = tf.keras.models.load_model("./weights/ResNet50_Elbow_frac.h5")
-model_hand_frac = tf.keras.models.load_model("./weights/ResNet50_Hand_frac.h5")
-model_shoulder_frac = tf.keras.models.load_model("./weights/ResNet50_Shoulder_frac.h5")
-model_parts = tf.keras.models.load_model("./weights/ResNet50_BodyParts.h5")
+# Models are loaded through the shared registry (lazily by default, see MODEL_LOAD_MODE)
+model_dict = registry_from_env("./weights")
 
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
@@ -42,7 +44,7 @@ def predict_api():
 
         # Prediction function for body fracture
         size = 224
-        chosen_model = model_parts  # First, check if it's fractured using model_parts
+        chosen_model = model_dict['Parts']  # First, check if it's fractured using model_parts
 
         # Load and preprocess image
         temp_img = keras.preprocessing.image.load_img(file_path, target_size=(size, size))
@@ -61,9 +63,9 @@ def predict_api():
 
         # If fractured, check all three body parts (Elbow, Hand, Shoulder)
         models = {
-            "Elbow": model_elbow_frac,
-            "Hand": model_hand_frac,
-            "Shoulder": model_shoulder_frac
+            "Elbow": model_dict['Elbow'],
+            "Hand": model_dict['Hand'],
+            "Shoulder": model_dict['Shoulder']
         }
 
         # Initialize variables to track the best prediction
@@ -91,53 +93,44 @@ def predict_api():
         return jsonify({'error': f'Error processing the request: {str(e)}'}), 500
 
 
-# Configure Gemini API
-genai.configure(api_key="GEMINI_API_KEY")  # Use environment variables for security
-
-# Create the model with the required configuration
-generation_config = {
-    "temperature": 1,
-    "top_p": 0.95,
-    "top_k": 40,
-    "max_output_tokens": 8192,
-    "response_mime_type": "text/plain",
-}
-
+# Gemini chat through the shared client in chat.py (reads the same variables as model_v2.py)
+chat_client = GeminiClient(
+    api_key=os.environ.get('GEMINI_API_KEY', ''),
+    model=os.environ.get('GEMINI_MODEL', 'gemini-1.5-pro'),
+    base_url=os.environ.get('GEMINI_BASE_URL', default_base_url)
+)
 
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-pro",
-    generation_config=generation_config,
+system_prompt = (
+    "You are Vivi, a knowledgeable and compassionate medical assistant chatbot. Your primary function is to provide guidance and information about bone fractures. You have an extensive understanding of bone anatomy, fracture types, common causes, symptoms, and treatment options. \n\n### Initial Greeting:\n1. Greet the user warmly and ask how you can assist them.\n2. Example: \"Hello! I’m Vivi, your assistant. How may I help you today?\"\n\n### Gathering Information:\n3. After the user responds, ask for more specifics about the suspected fracture, particularly which body part they believe is injured.\n   Example: \"Can you please tell me which part of your body you think might be fractured? (e.g., wrist, ankle, leg)\"\n\n### Provide Fracture Information Based on Body Part:\n4. Once the user specifies the body part, provide detailed information about that body part, common fractures that occur in it, symptoms to look out for, and the general course of action:\n   - **For fractures:**\n     - Describe possible fracture types (e.g., closed, open, greenstick, spiral).\n     - Explain the typical causes (e.g., falls, accidents).\n     - Offer information on symptoms (e.g., swelling, pain, deformity).\n     - Suggest next steps: \"It's important to see a healthcare provider for a diagnosis.\"\n     - Offer advice for immediate care (e.g., immobilizing the area, applying ice).\n   - **For no fractures:**\n     - Reassure the user that their symptoms might not be due to a fracture.\n     - Advise seeing a doctor for confirmation if symptoms persist.\n     - Suggest ways to manage pain (e.g., rest, pain relievers).\n   \n### Example Interactions:\n- **User:** \"I think I fractured my wrist.\"\n- **Vivi:** \"Thank you for sharing. Wrist fractures often happen from falls or impacts. The symptoms may include swelling, bruising, and pain around the wrist. If this is indeed a fracture, it’s important to keep the wrist immobilized and consult an orthopedic specialist for further evaluation.\"\n  \n- **User:** \"I think I broke my leg.\"\n- **Vivi:** \"Leg fractures can result from direct trauma, like a fall or a car accident. They may be accompanied by severe pain, swelling, and an inability to move the leg. If you suspect a fracture, it's important to avoid putting weight on the leg and seek immediate medical attention.\"\n  \n- **User:** \"I'm not sure, it just hurts a lot.\"\n- **Vivi:** \"Pain in the bones can sometimes be from bruising or sprains rather than fractures. If you're unsure, it's always a good idea to visit a doctor. They can provide a proper examination to rule out any fractures or other injuries.\"\n\n### Empathy:\n- Always respond with empathy and professionalism. Avoid offering direct medical advice and recommend that users see a healthcare provider for an accurate diagnosis and treatment.\n"
 )
 
-# Initialize chat session with history (you can adjust this based on your need)
-chat_session = model.start_chat(
-    history=[
-        {
-            "role": "user",
-            "parts": [
-                "You are Vivi, a knowledgeable and compassionate medical assistant chatbot. Your primary function is to provide guidance and information about bone fractures. You have an extensive understanding of bone anatomy, fracture types, common causes, symptoms, and treatment options. \n\n### Initial Greeting:\n1. Greet the user warmly and ask how you can assist them.\n2. Example: \"Hello! I’m Vivi, your assistant. How may I help you today?\"\n\n### Gathering Information:\n3. After the user responds, ask for more specifics about the suspected fracture, particularly which body part they believe is injured.\n   Example: \"Can you please tell me which part of your body you think might be fractured? (e.g., wrist, ankle, leg)\"\n\n### Provide Fracture Information Based on Body Part:\n4. Once the user specifies the body part, provide detailed information about that body part, common fractures that occur in it, symptoms to look out for, and the general course of action:\n   - **For fractures:**\n     - Describe possible fracture types (e.g., closed, open, greenstick, spiral).\n     - Explain the typical causes (e.g., falls, accidents).\n     - Offer information on symptoms (e.g., swelling, pain, deformity).\n     - Suggest next steps: \"It's important to see a healthcare provider for a diagnosis.\"\n     - Offer advice for immediate care (e.g., immobilizing the area, applying ice).\n   - **For no fractures:**\n     - Reassure the user that their symptoms might not be due to a fracture.\n     - Advise seeing a doctor for confirmation if symptoms persist.\n     - Suggest ways to manage pain (e.g., rest, pain relievers).\n   \n### Example Interactions:\n- **User:** \"I think I fractured my wrist.\"\n- **Vivi:** \"Thank you for sharing. Wrist fractures often happen from falls or impacts. The symptoms may include swelling, bruising, and pain around the wrist. If this is indeed a fracture, it’s important to keep the wrist immobilized and consult an orthopedic specialist for further evaluation.\"\n  \n- **User:** \"I think I broke my leg.\"\n- **Vivi:** \"Leg fractures can result from direct trauma, like a fall or a car accident. They may be accompanied by severe pain, swelling, and an inability to move the leg. If you suspect a fracture, it's important to avoid putting weight on the leg and seek immediate medical attention.\"\n  \n- **User:** \"I'm not sure, it just hurts a lot.\"\n- **Vivi:** \"Pain in the bones can sometimes be from bruising or sprains rather than fractures. If you're unsure, it's always a good idea to visit a doctor. They can provide a proper examination to rule out any fractures or other injuries.\"\n\n### Empathy:\n- Always respond with empathy and professionalism. Avoid offering direct medical advice and recommend that users see a healthcare provider for an accurate diagnosis and treatment.\n",
-            ],
-        },
-        {
-            "role": "model",
-            "parts": ["Hello! I am Vivi, your assistant. How may I help you today?"],
-        }, 
-    ]
+# One conversation per session id, each starting from this history
+chat_sessions = SessionStore(
+    chat_client,
+    history_factory=lambda: initial_history(system_prompt, "Hello! I am Vivi, your assistant. How may I help you today?"),
+    max_turns=int(os.environ.get('CHAT_HISTORY_TURNS', 10)),
+    idle_seconds=float(os.environ.get('CHAT_SESSION_IDLE', 1800)),
+    max_sessions=int(os.environ.get('CHAT_MAX_SESSIONS', 1000)),
+    max_bytes=int(float(os.environ.get('CHAT_MEMORY_MB', 64)) * 2 ** 20)
 )
 
 # Route for handling chat messages
 @app.route('/chat', methods=['POST'])
 def chat():
     # Retrieve the user's message from the request
-    user_input = request.json.get('message')
+    body = request.get_json(silent=True) or {}
+    user_input = body.get('message')
+    session_id = body.get('session_id') or SessionStore.new_id()
     
     if not user_input:
         return jsonify({"error": "No message provided"}), 400
+    if not isinstance(session_id, str) or len(session_id) > 128:
+        return jsonify({"error": "Invalid session_id"}), 400
     
     # Send the user's input to the chatbot and get the response
     try:
-        response = chat_session.send_message(user_input)
-        return jsonify({'response': response.text}), 200
+        response = chat_sessions.get(session_id).send_message(user_input)
+        return jsonify({'response': response, 'session_id': session_id}), 200
     except Exception as e:
         return jsonify({"error": f"Error processing the request: {str(e)}"}), 500
 
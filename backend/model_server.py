@@ -0,0 +1,123 @@
+"""
+Shared model process for the workers of serve.py.
+
+TensorFlow cannot be forked once it is running, so models loaded in the
+serve.py master could not be handed down to its workers, and models loaded
+in each worker cost a full copy of the weights per worker. Instead serve.py
+starts one process that loads the models and runs every forward pass; the
+workers send it their batches over a Unix socket. Adding a worker then adds
+its interpreter and Flask state, not another set of models. Batches from all
+workers go through one BatchingEngine, so concurrent requests to different
+workers still share forward passes.
+
+    ModelServer - the model process: answers ('predict', name, batch) and ('stats',)
+    ModelClient - the worker side, used by inference.run_batch when MODEL_SERVER is set
+"""
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Callable, Dict, List
+import numpy as np
+
+
+class ModelServer:
+    """
+    Serve the models of `engine` (a BatchingEngine) on the Unix socket
+    `address`, one thread per connected worker thread. Clients must know
+    `authkey`. `stats` returns the load statistics of the models.
+    """
+
+    def __init__(self, address: str, authkey: bytes, engine, stats: Callable[[], Dict] = None):
+        self.engine = engine
+        self.stats = stats or (lambda: {})
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+
+    def serve_forever(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # The listener was closed
+                return
+            threading.Thread(target=self._serve, args=(conn,), name='model-server', daemon=True).start()
+
+    def close(self) -> None:
+        self.listener.close()
+
+    def _serve(self, conn: Connection) -> None:
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self._handle(request))
+                except Exception as e:
+                    reply = ('error', f"{type(e).__name__}: {e}")
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def _handle(self, request: tuple):
+        if request[0] == 'stats':
+            return self.stats()
+        if request[0] == 'predict':
+            _, name, batch = request
+            return np.stack([future.result() for future in self.engine.submit_many(name, batch)])
+        raise ValueError(f"Unknown request '{request[0]}'")
+
+
+class ModelClient:
+    """
+    Runs forward passes in the model process at `address`. Safe to call from
+    any number of threads: each call borrows one of a pool of connections,
+    which is opened on demand and dropped if the model process goes away.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self._idle: List[Connection] = []
+        self._lock = threading.Lock()
+
+    def predict(self, name: str, batch: np.ndarray) -> np.ndarray:
+        return self._call(('predict', name, np.asarray(batch, dtype=np.float32)))
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return self._call(('stats',))
+
+    def _call(self, request: tuple):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is not None:
+            try:
+                return self._exchange(conn, request)
+            except (EOFError, OSError):
+                # The model process was restarted since this connection was opened: drop the others
+                # from before the restart too, and retry once on a new connection
+                with self._lock:
+                    stale, self._idle = self._idle, []
+                for conn in stale:
+                    conn.close()
+        try:
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            return self._exchange(conn, request)
+        except (EOFError, OSError, AuthenticationError) as e:
+            raise RuntimeError(f"The model process at {self.address} is unavailable: {e}")
+
+    def _exchange(self, conn: Connection, request: tuple):
+        try:
+            conn.send(request)
+            status, value = conn.recv()
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            self._idle.append(conn)
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
@@ -1,29 +1,156 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-import tensorflow as tf
-import keras
-import google.generativeai as genai
 from flask_cors import CORS
+from batching import BatchingEngine
+from jobs import JobQueue, MemoryBroker, QueueFull, SQLiteBroker, check_callback_url, priorities
+from chat import ChatService, GeminiClient, ResponseCache, SessionStore, default_base_url, fracture_query
+from metrics import MetricsRegistry, SlowRequestProfiler, batch_size_buckets
+from uploads import expand_uploads
+
+# Shared inference code lives next to the training scripts
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(THIS_FOLDER, '..', 'model_training'))
+from cascade import classify, classify_batch, classify_fused, categories_parts, categories_fracture
+from image_io import decode_image, decode_limits, decode_stats
+from inference import inference_mode, max_batch_size, load_stats, model_dict, run_batch
+from prediction_cache import PredictionCache, image_key
+from similarity_index import SimilarityService, default_index_path
 
 app = Flask(__name__)
 CORS(app, support_credentials=True)
 
 @app.after_request
 def after_request(response):
+    responses_total.inc(endpoint=request.endpoint or 'unknown', status=response.status_code)
     response.headers['Access-Control-Allow-Origin'] = 'http://localhost:5173'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
     return response
 
-# Load models
-model_elbow_frac = tf.keras.models.load_model("./weights/ResNet50_Elbow_frac.h5")
-model_hand_frac = tf.keras.models.load_model("./weights/ResNet50_Hand_frac.h5")
-model_shoulder_frac = tf.keras.models.load_model("./weights/ResNet50_Shoulder_frac.h5")
-model_parts = tf.keras.models.load_model("./weights/ResNet50_BodyParts.h5")
+# Latency of each request and of each stage of /predict, served at /metrics. METRICS=0 turns recording off.
+metrics = MetricsRegistry(enabled=os.environ.get('METRICS', '1') != '0')
+request_seconds = metrics.histogram('fracture_request_seconds', "Time to handle a request, until a streamed response ends",
+                                    ['endpoint'])
+responses_total = metrics.counter('fracture_responses_total', "Responses by endpoint and status code",
+                                  ['endpoint', 'status'])
+stage_seconds = metrics.histogram('fracture_stage_seconds', "Time /predict spends decoding, classifying and responding",
+                                  ['stage'])
+model_wait_seconds = metrics.histogram('fracture_model_wait_seconds',
+                                       "Time a request waits for a model output (cache, batching queue and forward pass)",
+                                       ['model'])
+model_batch_seconds = metrics.histogram('fracture_model_batch_seconds', "Duration of one forward pass", ['model'])
+model_batch_size = metrics.histogram('fracture_model_batch_size', "Images per forward pass", ['model'],
+                                     buckets=batch_size_buckets)
+model_calls_total = metrics.counter('fracture_model_calls_total', "Forward passes per model", ['model'])
+similar_search_seconds = metrics.histogram('fracture_similar_search_seconds',
+                                           "Time to search the similar-case index, excluding the embedding")
+job_queue_seconds = metrics.histogram('fracture_job_queue_seconds', "Time a job waits for a worker", ['priority'])
+job_run_seconds = metrics.histogram('fracture_job_run_seconds', "Time a worker spends on a job", ['priority'])
+jobs_total = metrics.counter('fracture_jobs_total', "Finished jobs by final status", ['status'])
+decode_seconds = metrics.histogram('fracture_decode_seconds', "Time to decode one image, by format", ['format'])
+if metrics.enabled:
+    decode_stats.listeners.append(lambda image_format, seconds: decode_seconds.observe(seconds, format=image_format))
+
+# PROFILE_SLOW_MS writes a sampled profile of every request slower than that to PROFILE_DIR
+profiler = None
+if os.environ.get('PROFILE_SLOW_MS'):
+    profiler = SlowRequestProfiler(float(os.environ['PROFILE_SLOW_MS']), os.environ.get('PROFILE_DIR', './profiles'),
+                                   interval_ms=float(os.environ.get('PROFILE_INTERVAL_MS', 5)),
+                                   follow_threads=('batching-',))
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    if profiler is not None:
+        g.profile = profiler.begin(f"{request.method} {request.path}")
+
+@app.teardown_request
+def end_request(exc):
+    # Runs once per request; for a streamed response (stream_with_context) only after the stream has ended
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    request_seconds.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown')
+    if profiler is not None:
+        profiler.end(g.profile)
+
+# Models, INFERENCE_MODE and BATCH_MAX_SIZE are set up in inference.py, shared with serve.py's model process.
+# Shared inference engine: concurrent requests are merged into one forward pass per model.
+# Set BATCHING=0 to fall back to one model.predict call per request.
+def run_model_batch(name, batch):
+    with model_batch_seconds.time(model=name):
+        probs = run_batch(name, batch)
+    model_batch_size.observe(len(batch), model=name)
+    model_calls_total.inc(model=name)
+    return probs
+
+batch_engine = BatchingEngine(
+    run_batch=run_model_batch,
+    max_batch_size=max_batch_size,
+    max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)),
+    enabled=os.environ.get('BATCHING', '1') != '0'
+)
+
+# Results keyed by image content, so repeated uploads of the same radiograph skip the models.
+# PREDICTION_CACHE_SIZE=0 disables the in-memory tier; PREDICTION_CACHE_PATH adds a SQLite tier.
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+    ttl=float(os.environ['PREDICTION_CACHE_TTL']) if os.environ.get('PREDICTION_CACHE_TTL') else None,
+    disk_path=os.environ.get('PREDICTION_CACHE_PATH'),
+    max_disk_entries=int(os.environ.get('PREDICTION_CACHE_DISK_SIZE', 100000))
+)
+
+def cached_predictor(key):
+    # Probabilities of one model for the image identified by `key`
+    def predict_fn(name, x):
+        with model_wait_seconds.time(model=name):
+            return prediction_cache.get_or_compute(key, model_dict.cache_name(name),
+                                                   lambda: batch_engine.predict(name, x))
+    return predict_fn
 
-categories_parts = ["Elbow", "Hand", "Shoulder"]
-categories_fracture = ['fractured', 'normal']
+def format_result(result):
+    # Keep the response shape of the original endpoint: a normal result has no body part
+    if result['prediction'] == 'normal':
+        return {'prediction': 'normal, no fracture detected'}
+    return {'prediction': result['prediction'], 'body_part': result['body_part']}
+
+def legacy_predict(x):
+    # Previous behaviour, kept for latency comparisons: parts model, then all three fracture models
+    fracture_prediction = np.argmax(batch_engine.predict('Parts', x))
+    fracture_result = categories_fracture[fracture_prediction.item()]
+
+    if fracture_result == 'normal':
+        return {'prediction': 'normal, no fracture detected'}
+
+    # Initialize variables to track the best prediction
+    max_prob = -1
+    best_part = None
+
+    pending = {part: batch_engine.submit(part, x) for part in categories_parts}
+    for part, future in pending.items():
+        probs = future.result()
+        part_prob = probs[np.argmax(probs)]
+
+        # Compare and choose the body part with the highest probability
+        if part_prob > max_prob:
+            max_prob = part_prob
+            best_part = part
+
+    return {'prediction': fracture_result, 'body_part': best_part}
+
+def classify_image(x):
+    # Result of /predict for one decoded image
+    if inference_mode == 'legacy':
+        return legacy_predict(x)
+    predict_fn = cached_predictor(image_key(x))
+    if inference_mode == 'fused':
+        return format_result(classify_fused(predict_fn('Fused', x)))
+    return format_result(classify(x, predict_fn))
 
 @app.route('/predict', methods=['POST'])
 def predict_api():
@@ -31,117 +158,348 @@ def predict_api():
         return jsonify({'error': 'No file uploaded'}), 400
 
     file = request.files['file']
-    file_path = f"temp/{file.filename}"
 
     try:
-        if not os.path.exists("temp"):
-            os.makedirs("temp")
-
-        # Save the uploaded file
-        file.save(file_path)
-
-        # Prediction function for body fracture
-        size = 224
-        chosen_model = model_parts  # First, check if it's fractured using model_parts
-
-        # Load and preprocess image
-        temp_img = keras.preprocessing.image.load_img(file_path, target_size=(size, size))
-        x = keras.preprocessing.image.img_to_array(temp_img)
-        x = np.expand_dims(x, axis=0)
-        images = np.vstack([x])
-
-        # First prediction: Is it fractured or not?
-        fracture_prediction = np.argmax(chosen_model.predict(images), axis=1)
-        fracture_result = categories_fracture[fracture_prediction.item()]
-
-        if fracture_result == 'normal':
-            # If the image is not fractured, return early
-            os.remove(file_path)
-            return jsonify({'prediction': 'normal, no fracture detected'})
-
-        # If fractured, check all three body parts (Elbow, Hand, Shoulder)
-        models = {
-            "Elbow": model_elbow_frac,
-            "Hand": model_hand_frac,
-            "Shoulder": model_shoulder_frac
-        }
-
-        # Initialize variables to track the best prediction
-        max_prob = -1
-        best_part = None
-
-        for part, model in models.items():
-            # Make prediction for each body part model
-            part_prediction = np.argmax(model.predict(images), axis=1)
-            part_prob = model.predict(images)[0][part_prediction.item()]
-
-            # Compare and choose the body part with the highest probability
-            if part_prob > max_prob:
-                max_prob = part_prob
-                best_part = part
-
-        # Cleanup
-        os.remove(file_path)
-
-        # Return the fracture status and the body part with the highest probability
-        return jsonify({'prediction': fracture_result, 'body_part': best_part})
+        # Decode the upload straight from the request stream
+        with stage_seconds.time(stage='decode'):
+            x = decode_image(file.stream)
+
+        with stage_seconds.time(stage='classify'):
+            result = classify_image(x)
+
+        with stage_seconds.time(stage='respond'):
+            return jsonify(result)
 
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         # Handle any error during prediction
         return jsonify({'error': f'Error processing the request: {str(e)}'}), 500
 
 
-# Configure Gemini API
-genai.configure(api_key="GEMINI_API_KEY")  # Use environment variables for security
+# /predict_batch limits and the threads decoding its images
+batch_upload_max_files = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', 256))
+batch_upload_max_bytes = int(os.environ.get('BATCH_UPLOAD_MAX_MB', 256)) * 2 ** 20
+# Request bodies larger than any endpoint accepts (plus room for the multipart framing)
+# are refused with a 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = max(batch_upload_max_bytes, decode_limits.max_bytes or 0) + 2 ** 20
+
+@app.errorhandler(413)
+def request_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // 2 ** 20
+    return jsonify({'error': f'Request body is over the limit of {limit_mb} MB'}), 413
+decode_workers = int(os.environ.get('DECODE_WORKERS', min(os.cpu_count() or 1, 8)))
+
+def cached_batch_predict(name, batch):
+    # Probabilities of one model for each image of `batch`; only the uncached images are run,
+    # queued together so the engine passes them through the model in full batches
+    keys = [image_key(x) for x in batch]
+    cache_name = model_dict.cache_name(name)
+    probs = [prediction_cache.get(key, cache_name) if prediction_cache.enabled else None for key in keys]
+    missing = [i for i, p in enumerate(probs) if p is None]
+    if missing:
+        futures = batch_engine.submit_many(name, batch[missing])
+        for i, future in zip(missing, futures):
+            probs[i] = future.result()
+            if prediction_cache.enabled:
+                prediction_cache.put(keys[i], cache_name, probs[i])
+    return np.stack(probs)
+
+def predict_images(images):
+    # Results of /predict for a batch of decoded images
+    if inference_mode == 'legacy':
+        return [legacy_predict(x) for x in images]
+    if inference_mode == 'fused':
+        results = [classify_fused(row) for row in cached_batch_predict('Fused', images)]
+    else:
+        results = classify_batch(images, cached_batch_predict)
+    return [format_result(result) for result in results]
+
+def predict_uploads(uploads):
+    """
+    Decode `uploads` ((filename, bytes) pairs) in parallel and classify them in
+    batches of the images decoded so far, yielding one NDJSON line per image as
+    soon as its result is known.
+    """
+    def line(index, status, body):
+        return json.dumps({'index': index, 'filename': uploads[index][0], 'status': status, 'result': body}) + '\n'
+
+    with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+        pending = {pool.submit(decode_image, data): i for i, (_, data) in enumerate(uploads)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            decoded = []
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    decoded.append((index, future.result()))
+                except ValueError as e:
+                    yield line(index, 400, {'error': str(e)})
+            # Classify in chunks of at most one model batch while the rest keep decoding
+            for start in range(0, len(decoded), max_batch_size):
+                chunk = decoded[start:start + max_batch_size]
+                try:
+                    results = predict_images(np.stack([x for _, x in chunk]))
+                except Exception as e:
+                    results = [{'error': f'Error processing the request: {str(e)}'}] * len(chunk)
+                for (index, _), result in zip(chunk, results):
+                    yield line(index, 500 if 'error' in result else 200, result)
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch_api():
+    # Any number of images, and zip/tar archives of images, under `files` (or `file`)
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    try:
+        uploads = expand_uploads([(f.filename, f.stream) for f in files], batch_upload_max_files,
+                                 batch_upload_max_bytes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not uploads:
+        return jsonify({'error': 'No images found in the upload'}), 400
+
+    return Response(stream_with_context(predict_uploads(uploads)), mimetype='application/x-ndjson',
+                    headers={'X-Image-Count': str(len(uploads))})
+
+# Asynchronous /predict: POST /jobs returns a job id at once, and a worker pool classifies the upload.
+# JOB_BROKER=sqlite:<path> shares the queue between the workers of serve.py; the default is in-process.
+def run_job(job):
+    try:
+        x = decode_image(job.payload)
+    except ValueError as e:
+        return 400, {'error': str(e)}
+    return 200, classify_image(x)
+
+def record_job(job):
+    job_queue_seconds.observe(job.started - job.submitted, priority=job.priority_name)
+    job_run_seconds.observe(job.finished - job.started, priority=job.priority_name)
+    jobs_total.inc(status=job.status)
+
+job_broker_url = os.environ.get('JOB_BROKER', 'memory')
+job_broker_options = {'max_queued': int(os.environ.get('JOB_QUEUE_SIZE', 256)),
+                      'result_ttl': float(os.environ.get('JOB_RESULT_TTL', 3600))}
+if job_broker_url.startswith('sqlite:'):
+    job_broker = SQLiteBroker(job_broker_url[len('sqlite:'):],
+                              lease_seconds=float(os.environ.get('JOB_LEASE_SECONDS', 300)), **job_broker_options)
+else:
+    job_broker = MemoryBroker(**job_broker_options)
+# Callbacks may only reach public hosts, or those listed in JOB_CALLBACK_HOSTS (comma-separated)
+job_callback_hosts = {host.strip().lower() for host in os.environ.get('JOB_CALLBACK_HOSTS', '').split(',')
+                      if host.strip()}
+job_queue = JobQueue(job_broker, run_job, workers=int(os.environ.get('JOB_WORKERS', 4)), on_finish=record_job,
+                     callback_hosts=job_callback_hosts)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    # Same upload as /predict, plus optional `priority` (high/normal/low) and `callback_url`
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    priority = request.values.get('priority', 'normal')
+    if priority not in priorities:
+        return jsonify({'error': f'priority must be one of {list(priorities)}'}), 400
+    callback_url = request.values.get('callback_url') or None
+    if callback_url is not None:
+        try:
+            check_callback_url(callback_url, job_callback_hosts)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    file = request.files['file']
+    # Read one byte past the size limit, so an oversized upload is refused without buffering all of it
+    max_bytes = decode_limits.max_bytes
+    payload = file.stream.read(max_bytes + 1) if max_bytes else file.stream.read()
+    if max_bytes and len(payload) > max_bytes:
+        return jsonify({'error': f'Image file is over the limit of {max_bytes / 2 ** 20:g} MB'}), 400
+
+    try:
+        job = job_queue.submit(payload, file.filename or '', priority, callback_url)
+    except QueueFull as e:
+        response = jsonify({'error': f'Too many jobs waiting, try again later ({str(e)})'})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+
+    response = jsonify({'job_id': job.id, 'status': job.status, 'poll': f'/jobs/{job.id}'})
+    response.headers['Location'] = f'/jobs/{job.id}'
+    return response, 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    # State of a job; `result` is the /predict body once it is done. Unknown and expired jobs are 404.
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+metrics.callback('fracture_jobs_queued', "Jobs waiting for a worker", lambda: job_queue.stats()['queued'])
+
+metrics.callback('fracture_prediction_cache_hits_total', "Prediction cache hits in memory and on disk",
+                 lambda: prediction_cache.hits + prediction_cache.disk_hits, kind='counter')
+metrics.callback('fracture_prediction_cache_misses_total', "Prediction cache misses",
+                 lambda: prediction_cache.misses, kind='counter')
+metrics.callback('fracture_batching_queue_wait_seconds_avg', "Average time an image waits to join a batch",
+                 lambda: batch_engine.stats()['avg_queue_wait_ms'] / 1000)
+
+# Similar prior studies from the embedding index built by `similarity_index.py build`.
+# The embeddings come from the backbone of the Keras body part model.
+similarity = SimilarityService(os.environ.get('SIMILAR_INDEX_PATH', default_index_path))
+similar_max_k = int(os.environ.get('SIMILAR_MAX_K', 50))
+
+@app.route('/similar', methods=['POST'])
+def similar_api():
+    # The `k` most similar indexed images to the uploaded `file`, optionally only of `body_part`
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    if 'Embedding' not in model_dict:
+        return jsonify({'error': 'Similar-case search needs INFERENCE_RUNTIME=keras'}), 503
+    try:
+        k = int(request.values.get('k', 5))
+    except ValueError:
+        return jsonify({'error': 'k must be an integer'}), 400
+    if not 1 <= k <= similar_max_k:
+        return jsonify({'error': f'k must be between 1 and {similar_max_k}'}), 400
+    body_part = request.values.get('body_part') or None
+    if body_part is not None and body_part not in categories_parts:
+        return jsonify({'error': f'body_part must be one of {categories_parts}'}), 400
+
+    try:
+        index = similarity.index()
+    except FileNotFoundError:
+        return jsonify({'error': 'The similar-case index has not been built'}), 503
+
+    try:
+        with stage_seconds.time(stage='decode'):
+            x = decode_image(request.files['file'].stream)
+        with model_wait_seconds.time(model='Embedding'):
+            embedding = batch_engine.predict('Embedding', x)
+        start = time.perf_counter()
+        results = index.search(embedding, k, body_part)
+        search_ms = (time.perf_counter() - start) * 1000
+        similar_search_seconds.observe(search_ms / 1000)
+        return jsonify({'results': results, 'indexed': len(index), 'search_ms': search_ms})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error processing the request: {str(e)}'}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
 
-# Create the model with the required configuration
-generation_config = {
-    "temperature": 1,
-    "top_p": 0.95,
-    "top_k": 40,
-    "max_output_tokens": 8192,
-    "response_mime_type": "text/plain",
-}
+@app.route('/models', methods=['GET'])
+def model_stats():
+    # Load state, load time and memory of each model
+    return jsonify(load_stats())
 
 
-model = genai.GenerativeModel(
-    model_name="gemini-1.5-pro",
-    generation_config=generation_config,
+# Gemini chat over a pooled, keep-alive REST connection (see chat.py).
+# GEMINI_BASE_URL can point at stub_llm.py for local testing.
+chat_workers = int(os.environ.get('CHAT_WORKERS', 8))
+chat_client = GeminiClient(
+    api_key=os.environ.get('GEMINI_API_KEY', ''),
+    model=os.environ.get('GEMINI_MODEL', 'gemini-1.5-pro'),
+    base_url=os.environ.get('GEMINI_BASE_URL', default_base_url),
+    pool_size=chat_workers
+)
+# Replies to "tell me more about the fracture in my <part>" are shared by all users.
+# CHAT_CACHE_SIZE=0 disables the cache; CHAT_CACHE_WARM=1 fills it at startup.
+chat_cache = ResponseCache(
+    categories_parts,
+    max_entries=int(os.environ.get('CHAT_CACHE_SIZE', 256)),
+    ttl=float(os.environ.get('CHAT_CACHE_TTL', 86400)) or None
 )
+chat_service = ChatService(max_workers=chat_workers, timeout=float(os.environ.get('CHAT_TIMEOUT', 120)),
+                           response_cache=chat_cache)
 
-# Initialize chat session with history (you can adjust this based on your need)
-chat_session = model.start_chat(
-    history=[
-        {
-            "role": "user",
-            "parts": [
-                "You are Vivi, a knowledgeable and compassionate medical assistant chatbot. Your primary function is to provide guidance and information about bone fractures. You have an extensive understanding of bone anatomy, fracture types, common causes, symptoms, and treatment options. \n\n### Initial Greeting:\n1. Greet the user warmly and introduce yourself.\n   Example: \"Hello! I’m Vivi, your assistant. Let me provide you with information about fractures.\"\n\n### Provide Fracture Information Based on Body Part:\n2. When the user mentions a body part, immediately provide detailed information about fractures related to that body part:\n   - **For fractures:**\n     - Describe possible fracture types (e.g., closed, open, greenstick, spiral).\n     - Explain the typical causes (e.g., falls, accidents).\n     - Offer information on symptoms (e.g., swelling, pain, deformity).\n     - Suggest next steps: \"It's important to see a healthcare provider for a diagnosis.\"\n     - Offer advice for immediate care (e.g., immobilizing the area, applying ice).\n   - **For no fractures:**\n     - Reassure the user that their symptoms might not be due to a fracture.\n     - Advise seeing a doctor for confirmation if symptoms persist.\n     - Suggest ways to manage pain (e.g., rest, pain relievers).\n\n### Example Interactions:\n- **User:** \"I think I fractured my wrist.\"\n- **Vivi:** \"Wrist fractures often happen from falls or impacts. Symptoms may include swelling, bruising, and pain around the wrist. If this is indeed a fracture, it’s important to immobilize the wrist and consult a healthcare provider for further evaluation.\"\n\n- **User:** \"I think I broke my leg.\"\n- **Vivi:** \"Leg fractures commonly result from direct trauma, like a fall or car accident. They may cause severe pain, swelling, and inability to move the leg. Avoid putting weight on the leg and seek immediate medical attention.\"\n\n- **User:** \"It just hurts a lot.\"\n- **Vivi:** \"Pain in a bone may be from bruising or a sprain rather than a fracture. If you're unsure, I recommend seeing a doctor to rule out any serious injury and get appropriate care.\"\n\n### Empathy:\n- Always respond with empathy and professionalism. Avoid offering direct medical advice and recommend that users see a healthcare provider for an accurate diagnosis and treatment.\n"
-            ],
-        },
-        {
-            "role": "model",
-            "parts": ["Hello! I am Vivi, your assistant. Let me provide you with information about fractures."],
-        }, 
-    ]
+# One conversation per session id, with a bounded history window and idle/memory eviction
+chat_sessions = SessionStore(
+    chat_client,
+    max_turns=int(os.environ.get('CHAT_HISTORY_TURNS', 10)),
+    idle_seconds=float(os.environ.get('CHAT_SESSION_IDLE', 1800)),
+    max_sessions=int(os.environ.get('CHAT_MAX_SESSIONS', 1000)),
+    max_bytes=int(float(os.environ.get('CHAT_MEMORY_MB', 64)) * 2 ** 20)
 )
 
+if os.environ.get('CHAT_CACHE_WARM', '0') == '1':
+    chat_service.warm([fracture_query.format(part=part) for part in categories_parts], chat_sessions.fresh)
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def chat_request():
+    # Message and session id of a chat request; a session id is issued when the client sends none
+    body = request.get_json(silent=True) or {}
+    session_id = body.get('session_id') or SessionStore.new_id()
+    if not isinstance(session_id, str) or len(session_id) > 128:
+        raise ValueError("Invalid session_id")
+    return body.get('message'), session_id
+
 
 # Route for handling chat messages
 @app.route('/chat', methods=['POST'])
 def chat():
     # Retrieve the user's message from the request
-    user_input = request.json.get('message')
+    try:
+        user_input, session_id = chat_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     if not user_input:
         return jsonify({"error": "No message provided"}), 400
     
     # Send the user's input to the chatbot and get the response
     try:
-        response = chat_session.send_message(user_input)
-        return jsonify({'response': response.text}), 200
+        response = chat_service.send(chat_sessions.get(session_id), user_input)
+        return jsonify({'response': response, 'session_id': session_id}), 200
     except Exception as e:
         return jsonify({"error": f"Error processing the request: {str(e)}"}), 500
 
 
+# Same as /chat, but the reply is streamed as server-sent events while it is generated:
+# A `session` event carries the session id, `message` events carry {"text": chunk},
+# then one `done` (or `error`) event ends the stream.
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    try:
+        user_input, session_id = chat_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not user_input:
+        return jsonify({"error": "No message provided"}), 400
+
+    session = chat_sessions.get(session_id)
+
+    def events():
+        yield sse('session', {'session_id': session_id})
+        try:
+            for text in chat_service.stream(session, user_input):
+                yield sse('message', {'text': text})
+            yield sse('done', {})
+        except Exception as e:
+            yield sse('error', {'error': f"Error processing the request: {str(e)}"})
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+metrics.callback('fracture_chat_requests_total', "Chat replies requested", lambda: chat_service.stats()['requests'],
+                 kind='counter')
+metrics.callback('fracture_chat_in_flight', "Chat replies being generated", lambda: chat_service.stats()['in_flight'])
+
+@app.route('/chat/stats', methods=['GET'])
+def chat_stats():
+    return jsonify(dict(chat_service.stats(), sessions=chat_sessions.stats()))
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    # Development server; use serve.py in production. Threaded so /predict keeps being served while chat replies stream
+    app.run(debug=True, threaded=True)
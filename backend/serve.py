@@ -0,0 +1,516 @@
+"""
+Production launcher for the Flask API (replaces `app.run(debug=True)`).
+
+A master process binds the port once and forks `--workers` processes that
+accept from the shared socket, each running a threaded WSGI server. The
+master never imports TensorFlow, which is not fork-safe, so models cannot be
+loaded before the fork. With more than one worker, the master therefore
+first starts one model process (model_server.py) that loads and warms the
+models, with TensorFlow and TFLite thread pools sized to all the cores. The
+workers hold no weights: they send their batches to the model process over
+a Unix socket, so each extra worker adds its interpreter and Flask state
+rather than another copy of the models. `serve_benchmark.py` measures the
+memory each extra worker adds. With --per-worker-models (or a single
+worker), each worker loads the models itself instead, with thread pools
+sized to its share of the cores (optionally pinned to them); memory then
+grows by a full model set per worker.
+
+Workers share nothing else. Jobs must go through a shared broker, so with
+more than one worker serve.py refuses to start model_v2 unless
+JOB_BROKER=sqlite:<path>. Chat sessions live in the worker that created
+them: a follow-up message served by another worker starts a new
+conversation, so clients that chat need a single worker or sticky routing.
+
+A worker (or the model process) that dies before it is ready is restarted
+after an exponential backoff, and the launcher gives up after
+--max-start-failures in a row. On SIGHUP a new model process is started
+with the new workers, and the old one stops once the old workers are gone.
+
+    python serve.py --workers 4 --port 5000
+    kill -HUP <master pid>     # start fresh workers, retire the old ones once the new are ready
+    kill -TERM <master pid>    # stop accepting, finish in-flight requests, exit
+"""
+import argparse
+import importlib
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Dict, List, Set
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Slot of the shared model process among the worker slots
+MODELS = -1
+
+
+class InFlight:
+    """
+    WSGI middleware counting requests whose response has not been fully sent
+    (streamed chat replies included), so a stopping worker can drain them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.count += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), self._done)
+        except BaseException:
+            self._done()
+            raise
+
+    def _done(self) -> None:
+        with self._idle:
+            self.count -= 1
+            self._idle.notify_all()
+
+    def wait_idle(self, timeout: float = None) -> bool:
+        with self._idle:
+            return self._idle.wait_for(lambda: self.count == 0, timeout)
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def default_threads(workers: int) -> int:
+    """
+    Compute threads per worker so that all workers together use each core once.
+    """
+    return max(len(available_cpus()) // workers, 1)
+
+
+def cpu_slices(workers: int, cpus: List[int]) -> List[List[int]]:
+    """
+    Split `cpus` into one contiguous group per worker. With more workers than
+    cores, workers share cores round-robin.
+    """
+    if workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    size, extra = divmod(len(cpus), workers)
+    slices, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cpus[start:end])
+        start = end
+    return slices
+
+
+def configure_threads(threads: int, interop_threads: int) -> None:
+    """
+    Size the thread pools of this process. Must run before the app module
+    imports TensorFlow for the first time.
+    """
+    for var in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'RUNTIME_THREADS'):
+        os.environ[var] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(interop_threads)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(interop_threads)
+
+
+def run_worker(args, listen_fd: int, ready_fd: int, cpus: List[int], threads: int) -> None:
+    # The master handles Ctrl-C and reloads; a worker only reacts to SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if args.pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    configure_threads(threads, args.interop_threads)
+
+    sys.path.insert(0, THIS_FOLDER)
+    if os.environ.get('MODEL_SERVER'):
+        # The models run in the shared model process; never load them here
+        os.environ['MODEL_LOAD_MODE'] = 'lazy'
+    module = importlib.import_module(args.app)
+    if hasattr(module, 'model_dict') and not os.environ.get('MODEL_SERVER'):
+        # Load and warm every model before taking traffic
+        module.model_dict.preload(block=True)
+
+    app = InFlight(module.app)
+    server = make_server(args.host, args.port, app, threaded=True, fd=listen_fd)
+
+    def stop(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    except OSError:
+        pass
+    server.serve_forever()
+    app.wait_idle(args.graceful_timeout)
+
+
+def run_model_server(args, address: str, authkey: bytes, ready_fd: int, threads: int) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # This process runs the models itself
+    os.environ.pop('MODEL_SERVER', None)
+    configure_threads(threads, args.interop_threads)
+
+    sys.path.insert(0, THIS_FOLDER)
+    import inference
+    from batching import BatchingEngine
+    from model_server import ModelServer
+    inference.model_dict.preload(block=True)
+    # Batches from all workers are merged again here, into full forward passes
+    engine = BatchingEngine(run_batch=inference.run_batch, max_batch_size=inference.max_batch_size,
+                            max_wait_ms=float(os.environ.get('BATCH_MAX_WAIT_MS', 5)),
+                            enabled=os.environ.get('BATCHING', '1') != '0')
+    if os.path.exists(address):
+        # Left behind by a model process that crashed on this socket
+        os.unlink(address)
+    server = ModelServer(address, authkey, engine, stats=inference.model_dict.stats)
+    try:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    except OSError:
+        pass
+    server.serve_forever()
+
+
+class Master:
+    """
+    Keeps `workers` processes (and the shared model process, if any) running:
+    restarts any that die, replaces all of them on SIGHUP, and stops them
+    gracefully on SIGTERM or Ctrl-C.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        cpus = available_cpus()
+        self.slices = cpu_slices(args.workers, cpus)
+        self.shared_models = args.workers > 1 and args.app == 'model_v2' and not args.per_worker_models
+        # Workers that only forward batches need no inference threads of their own
+        self.threads = 1 if self.shared_models else args.threads or default_threads(args.workers)
+        self.model_threads = args.threads or len(cpus)
+        self.model_dir = tempfile.mkdtemp(prefix='serve-models-') if self.shared_models else None
+        self.model_address = None
+        self.model_generation = 0
+        self.authkey = os.urandom(16)
+        self.retiring: List[tuple] = []  # (old model process pid, its remaining workers, deadline, socket)
+        self.workers: Dict[int, int] = {}  # pid -> slot, MODELS for the model process
+        self.starting: Dict[int, int] = {}  # pid -> ready pipe of restarted workers, None once it closed unready
+        self.failures: Dict[int, int] = {}  # slot -> failed starts in a row
+        self.restarts: Dict[int, float] = {}  # slot -> when its worker is due to be restarted
+        self.exit_code = 0
+        self.stopping = False
+        self.reload_requested = False
+        self.sock = None
+
+    def run(self) -> int:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.args.host, self.args.port))
+        self.sock.listen(self.args.backlog)
+        self.sock.set_inheritable(True)
+
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+
+        if self.shared_models and not self.start_models():
+            print("The model process failed to start", flush=True)
+            self.shutdown()
+            return 1
+
+        pending = {}
+        for slot in range(self.args.workers):
+            pid, ready_fd = self.spawn(slot)
+            self.workers[pid] = slot
+            pending[pid] = ready_fd
+        ready = self.wait_ready(pending, self.args.ready_timeout)
+        if len(ready) < len(pending):
+            print(f"{len(pending) - len(ready)} of {len(pending)} workers failed to start", flush=True)
+            self.shutdown()
+            return 1
+        models = (f"models in one shared process with {self.model_threads} threads" if self.shared_models
+                  else f"{self.threads} threads each")
+        print(f"Serving {self.args.app} on http://{self.args.host}:{self.args.port} with {len(ready)} workers, "
+              f"{models} (master pid {os.getpid()})", flush=True)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.check_started()
+            self.reap()
+            self.retire_models()
+            self.restart_due()
+            time.sleep(0.2)
+        self.shutdown()
+        return self.exit_code
+
+    def shutdown(self) -> None:
+        # Workers first, so their in-flight requests can still reach the model process
+        self.terminate([pid for pid, slot in self.workers.items() if slot != MODELS], wait=True)
+        self.terminate(list(self.workers) + [entry[0] for entry in self.retiring], wait=True)
+        self.retiring.clear()
+        self.sock.close()
+        if self.model_dir is not None:
+            shutil.rmtree(self.model_dir, ignore_errors=True)
+
+    def start_models(self) -> bool:
+        """
+        Start a model process on a new socket and wait until it has loaded the
+        models; new workers are pointed at it. On failure the previous socket is kept.
+        """
+        previous = self.model_address
+        self.model_generation += 1
+        self.model_address = os.path.join(self.model_dir, f"models-{self.model_generation}.sock")
+        pid, ready_fd = self.spawn(MODELS)
+        self.workers[pid] = MODELS
+        if self.wait_ready({pid: ready_fd}, self.args.ready_timeout):
+            return True
+        self.terminate([pid], wait=True)
+        self.model_address = previous
+        return False
+
+    def spawn(self, slot: int):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            code = 0
+            try:
+                if slot == MODELS:
+                    # The model process takes no HTTP traffic
+                    self.sock.close()
+                    run_model_server(self.args, self.model_address, self.authkey, write_fd, self.model_threads)
+                else:
+                    if self.shared_models:
+                        os.environ['MODEL_SERVER'] = self.model_address
+                        os.environ['MODEL_SERVER_KEY'] = self.authkey.hex()
+                    run_worker(self.args, self.sock.fileno(), write_fd, self.slices[slot], self.threads)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        return pid, read_fd
+
+    def wait_ready(self, pending: Dict[int, int], timeout: float) -> Set[int]:
+        """
+        Wait until the workers in `pending` (pid -> ready pipe) report ready, die, or `timeout` passes.
+        """
+        ready = set()
+        fds = {fd: pid for pid, fd in pending.items()}
+        deadline = time.monotonic() + timeout
+        while fds and time.monotonic() < deadline:
+            readable, _, _ = select.select(list(fds), [], [], max(deadline - time.monotonic(), 0))
+            for fd in readable:
+                if os.read(fd, 1):
+                    ready.add(fds[fd])
+                os.close(fd)
+                del fds[fd]
+        for fd in fds:
+            os.close(fd)
+        return ready
+
+    def reload(self) -> None:
+        """
+        Start a new generation of workers (which import the app and load the models
+        afresh, or use a new model process) and retire the current one only once
+        all new workers are ready.
+        """
+        print("Reloading: starting new workers", flush=True)
+        old = [pid for pid, slot in self.workers.items() if slot != MODELS]
+        old_models = [pid for pid, slot in self.workers.items() if slot == MODELS]
+        old_address = self.model_address
+        if self.shared_models:
+            if not self.start_models():
+                print("Reload failed: the new model process did not become ready, keeping the current one",
+                      flush=True)
+                return
+            new_models = [pid for pid, slot in self.workers.items() if slot == MODELS and pid not in old_models]
+        new, pending = {}, {}
+        for slot in range(self.args.workers):
+            pid, ready_fd = self.spawn(slot)
+            new[pid] = slot
+            pending[pid] = ready_fd
+        ready = self.wait_ready(pending, self.args.ready_timeout)
+        if len(ready) < len(new):
+            print("Reload failed: new workers did not become ready, keeping the current ones", flush=True)
+            self.terminate(list(new), wait=True)
+            if self.shared_models:
+                self.terminate(new_models, wait=True)
+                self.model_address = old_address
+            return
+        if self.shared_models:
+            new.update({pid: MODELS for pid in new_models})
+            # The old model process serves the old workers until they have drained
+            self.retiring.extend((pid, set(old), time.monotonic() + self.args.graceful_timeout + 5, old_address)
+                                 for pid in old_models)
+        self.workers = new
+        for fd in self.starting.values():
+            if fd is not None:
+                os.close(fd)
+        self.starting.clear()
+        self.failures.clear()
+        self.restarts.clear()
+        self.terminate(old)
+        print(f"Reloaded: {len(ready)} new workers serving", flush=True)
+
+    def reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for entry in self.retiring:
+                entry[1].discard(pid)
+            slot = self.workers.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+            name = "The model process" if slot == MODELS else f"Worker {pid}"
+            delay = 1
+            if pid in self.starting:
+                # Died before it was ready: likely to fail again, so back off
+                ready_fd = self.starting.pop(pid)
+                if ready_fd is not None:
+                    os.close(ready_fd)
+                failures = self.failures[slot] = self.failures.get(slot, 0) + 1
+                if failures >= self.args.max_start_failures:
+                    print(f"{name} failed to start {failures} times in a row; stopping", flush=True)
+                    self.exit_code = 1
+                    self.stopping = True
+                    return
+                delay = min(2 ** failures, 60)
+            print(f"{name} exited with status {status}; restarting it in {delay}s", flush=True)
+            self.restarts[slot] = time.monotonic() + delay
+
+    def retire_models(self) -> None:
+        # Stop model processes of previous generations once their workers have exited
+        now = time.monotonic()
+        for entry in list(self.retiring):
+            pid, remaining, deadline, address = entry
+            if not remaining or now >= deadline:
+                self.retiring.remove(entry)
+                self.terminate([pid])
+                try:
+                    os.unlink(address)
+                except FileNotFoundError:
+                    pass
+
+    def check_started(self) -> None:
+        """
+        Note which restarted workers have become ready, which resets their slot's failure count.
+        """
+        fds = {fd: pid for pid, fd in self.starting.items() if fd is not None}
+        if not fds:
+            return
+        readable, _, _ = select.select(list(fds), [], [], 0)
+        for fd in readable:
+            pid = fds[fd]
+            ready = os.read(fd, 1)
+            os.close(fd)
+            if ready:
+                del self.starting[pid]
+                self.failures.pop(self.workers.get(pid), None)
+            else:
+                self.starting[pid] = None
+
+    def restart_due(self) -> None:
+        now = time.monotonic()
+        for slot, due in list(self.restarts.items()):
+            if due <= now:
+                del self.restarts[slot]
+                pid, ready_fd = self.spawn(slot)
+                self.workers[pid] = slot
+                self.starting[pid] = ready_fd
+
+    def terminate(self, pids: List[int], wait: bool = False) -> None:
+        """
+        Ask workers to finish their in-flight requests and exit; with `wait`,
+        kill any still running after the graceful timeout.
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if not wait:
+            return
+        remaining = set(pids)
+        deadline = time.monotonic() + self.args.graceful_timeout + 5
+        while remaining and time.monotonic() < deadline:
+            for pid in list(remaining):
+                try:
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        remaining.discard(pid)
+                except ChildProcessError:
+                    remaining.discard(pid)
+            time.sleep(0.1)
+        for pid in remaining:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        for pid in pids:
+            self.workers.pop(pid, None)
+
+    def _on_reload(self, signum, frame) -> None:
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='model_v2', help="Module in the backend folder that defines `app`")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=len(available_cpus()))
+    parser.add_argument('--threads', type=int, default=None,
+                        help="TensorFlow/TFLite threads of the model process (default: cores), "
+                             "or per worker with --per-worker-models (default: cores / workers)")
+    parser.add_argument('--per-worker-models', action='store_true',
+                        help="Load the models in every worker instead of one shared model process")
+    parser.add_argument('--interop-threads', type=int, default=2)
+    parser.add_argument('--pin', action='store_true', help="Pin each worker to its own set of cores")
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--ready-timeout', type=float, default=300, help="Seconds a worker may take to load models")
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help="Seconds a stopping worker waits for in-flight requests")
+    parser.add_argument('--max-start-failures', type=int, default=5,
+                        help="Give up after a worker fails to start this many times in a row")
+    parser.add_argument('--quiet', action='store_true', help="Do not log every request")
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and args.app == 'model_v2':
+        if not os.environ.get('JOB_BROKER', 'memory').startswith('sqlite:'):
+            parser.error("with more than one worker, /jobs needs a queue shared by the workers: "
+                         "set JOB_BROKER=sqlite:<path>")
+        print("Note: chat sessions are kept per worker; a conversation continued on another worker "
+              "starts over", flush=True)
+
+    if args.quiet:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    sys.exit(Master(args).run())
+
+
+if __name__ == '__main__':
+    main()
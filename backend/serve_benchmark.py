@@ -0,0 +1,115 @@
+"""
+Throughput of serve.py from 1 to N workers.
+
+For each worker count the launcher is started on a free port, /predict is
+loaded over HTTP until `--requests` have completed, and the memory of all
+workers (and of serve.py's shared model process) is summed as PSS (shared
+pages split between the processes that map them), so the table shows both
+the speedup and the memory each extra worker adds. With more than one worker
+the models are held once, by the model process, so an extra worker should
+add well under the size of the models; --per-worker-models measures the
+launcher with a copy of the models in every worker instead. Jobs go through a
+temporary SQLite broker, which serve.py requires for more than one worker.
+Every request posts the same image, so the prediction cache is disabled:
+
+    python serve_benchmark.py --max-workers 4 --requests 256 --pin
+
+The load generator runs on the same machine and takes some CPU itself, so
+the top worker count is best kept below the number of cores.
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+from colorama import Fore
+from tabulate import tabulate
+from load_test import default_image, http_sender, run_load
+from serve import available_cpus, default_threads
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def child_pids(pid: int) -> List[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def pss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure(workers: int, args, broker_dir: str) -> Dict[str, float]:
+    port = free_port()
+    command = [sys.executable, os.path.join(THIS_FOLDER, 'serve.py'), '--app', args.app, '--port', str(port),
+               '--workers', str(workers), '--quiet'] + (['--pin'] if args.pin else []) \
+        + (['--per-worker-models'] if args.per_worker_models else [])
+    env = dict(os.environ, JOB_BROKER=f"sqlite:{os.path.join(broker_dir, f'jobs-{workers}.db')}",
+               PREDICTION_CACHE_SIZE='0')
+    env.pop('PREDICTION_CACHE_PATH', None)
+    master = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        # The master announces itself once every worker has loaded its models
+        for line in master.stdout:
+            if line.startswith('Serving'):
+                break
+        else:
+            raise RuntimeError(f"serve.py exited with status {master.wait()} before serving")
+        threading.Thread(target=master.stdout.read, daemon=True).start()
+
+        send = http_sender(f"http://127.0.0.1:{port}/predict", args.image)
+        send()
+        result = run_load(send, args.requests, args.concurrency * workers)
+        result['pss_mb'] = sum(pss_mb(pid) for pid in child_pids(master.pid))
+        return result
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='model_v2')
+    parser.add_argument('--image', default=default_image)
+    parser.add_argument('--max-workers', type=int, default=len(available_cpus()))
+    parser.add_argument('--requests', type=int, default=256)
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent requests per worker")
+    parser.add_argument('--pin', action='store_true', help="Pin each worker to its own set of cores")
+    parser.add_argument('--per-worker-models', action='store_true', help="Load the models in every worker")
+    args = parser.parse_args()
+
+    table = [["Workers", "Threads/worker", "Req/s", "Speedup", "p50 ms", "p95 ms", "Errors", "PSS MB",
+              "MB per extra worker"]]
+    baseline = None
+    with tempfile.TemporaryDirectory() as broker_dir:
+        for workers in range(1, args.max_workers + 1):
+            result = measure(workers, args, broker_dir)
+            baseline = baseline or result
+            extra = (result['pss_mb'] - baseline['pss_mb']) / (workers - 1) if workers > 1 else None
+            # Workers that send their batches to the model process run one inference thread each
+            shared = workers > 1 and args.app == 'model_v2' and not args.per_worker_models
+            table.append([
+                workers, 1 if shared else default_threads(workers),
+                f"{result['requests_per_sec']:.1f}",
+                f"{result['requests_per_sec'] / baseline['requests_per_sec']:.2f}x",
+                f"{result['p50_ms']:.0f}", f"{result['p95_ms']:.0f}", result['errors'],
+                f"{result['pss_mb']:.0f}", f"{extra:.0f}" if extra is not None else '-'
+            ])
+
+    print(Fore.BLUE + f"\nScaling of /predict over {len(available_cpus())} cores ({args.requests} requests per run):")
+    print(tabulate(table, headers="firstrow", tablefmt="grid", disable_numparse=True))
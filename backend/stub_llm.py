@@ -0,0 +1,120 @@
+"""
+Local stand-in for the Gemini REST API, for testing the chat endpoints
+without an API key or network access.
+
+Serves `generateContent` and `streamGenerateContent?alt=sse` with a
+configurable delay before the first chunk and between chunks. Connections
+are kept alive, and /stats reports how many were opened, so connection reuse
+can be checked:
+
+    python stub_llm.py --port 8089 --latency 1.5 --chunk-delay 0.05
+    GEMINI_BASE_URL=http://127.0.0.1:8089 python model_v2.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+stats = {'connections': 0, 'requests': 0}
+stats_lock = threading.Lock()
+
+
+def reply_chunks(contents: List[Dict], n_chunks: int) -> List[str]:
+    """
+    Deterministic reply to the last user message, split into `n_chunks` pieces.
+    """
+    message = ''.join(part.get('text', '') for part in contents[-1].get('parts', [])) if contents else ''
+    words = f"Stub reply to: {message}. Fractures should be assessed by a healthcare provider.".split(' ')
+    size = max(len(words) // n_chunks, 1)
+    pieces = [' '.join(words[i:i + size]) for i in range(0, len(words), size)]
+    return [piece + ' ' for piece in pieces[:-1]] + pieces[-1:]
+
+
+def candidate(text: str) -> Dict:
+    return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests
+    protocol_version = 'HTTP/1.1'
+    latency = 1.0
+    chunk_delay = 0.05
+    n_chunks = 8
+
+    def setup(self):
+        super().setup()
+        with stats_lock:
+            stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        with stats_lock:
+            self._send_json(dict(stats))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        with stats_lock:
+            stats['requests'] += 1
+        chunks = reply_chunks(body.get('contents', []), self.n_chunks)
+        time.sleep(self.latency)
+
+        if ':streamGenerateContent' in self.path:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i, text in enumerate(chunks):
+                if i:
+                    time.sleep(self.chunk_delay)
+                self._write_chunk(f"data: {json.dumps(candidate(text))}\r\n\r\n".encode())
+            self._write_chunk(b'')
+        elif ':generateContent' in self.path:
+            time.sleep(self.chunk_delay * (len(chunks) - 1))
+            self._send_json(candidate(''.join(chunks)))
+        else:
+            self.send_error(404)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, payload: Dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port: int = 8089, latency: float = 1.0, chunk_delay: float = 0.05, n_chunks: int = 8) -> ThreadingHTTPServer:
+    """
+    Start the stub in a background thread and return the server (call `shutdown()` to stop it).
+    """
+    handler = type('Handler', (StubHandler,), {'latency': latency, 'chunk_delay': chunk_delay, 'n_chunks': n_chunks})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=1.0, help="Seconds before the first chunk")
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help="Seconds between chunks")
+    parser.add_argument('--chunks', type=int, default=8)
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.chunk_delay, args.chunks)
+    print(f"Stub LLM listening on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+import pytest
+from batching import BatchingEngine
+
+
+def echo_batch(name, batch):
+    # One row per image, identifying it by its first pixel
+    return batch[:, 0, 0, :1] * 1.0
+
+
+def image(value: float) -> np.ndarray:
+    return np.full((4, 4, 3), value, dtype=np.float32)
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_results_go_back_to_their_callers(enabled):
+    engine = BatchingEngine(echo_batch, max_batch_size=8, max_wait_ms=20, enabled=enabled)
+    results = {}
+
+    def call(i):
+        results[i] = engine.predict('Parts', image(i), timeout=5)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert {i: float(row[0]) for i, row in results.items()} == {i: float(i) for i in range(32)}
+    engine.shutdown()
+
+
+def test_concurrent_requests_share_forward_passes():
+    sizes = []
+    release = threading.Event()
+
+    def run_batch(name, batch):
+        release.wait(5)
+        sizes.append(len(batch))
+        return echo_batch(name, batch)
+
+    engine = BatchingEngine(run_batch, max_batch_size=8, max_wait_ms=50)
+    futures = engine.submit_many('Parts', np.stack([image(i) for i in range(8)]))
+    release.set()
+    assert [float(f.result(timeout=5)[0]) for f in futures] == list(range(8))
+    assert sizes == [8]
+    assert engine.stats()['batches'] == 1
+    engine.shutdown()
+
+
+def test_cancelled_request_does_not_stop_the_worker():
+    started = threading.Event()
+    release = threading.Event()
+
+    def run_batch(name, batch):
+        started.set()
+        release.wait(5)
+        return echo_batch(name, batch)
+
+    engine = BatchingEngine(run_batch, max_batch_size=1, max_wait_ms=0)
+    first = engine.submit('Parts', image(1))
+    started.wait(5)
+    queued = engine.submit('Parts', image(2))
+    assert queued.cancel()
+    release.set()
+    assert float(first.result(timeout=5)[0]) == 1
+    assert float(engine.predict('Parts', image(3), timeout=5)[0]) == 3
+    engine.shutdown()
+
+
+def test_wrong_number_of_results_fails_the_batch():
+    engine = BatchingEngine(lambda name, batch: echo_batch(name, batch)[:-1], max_batch_size=4, max_wait_ms=20)
+    futures = engine.submit_many('Parts', np.stack([image(i) for i in range(4)]))
+    for future in futures:
+        with pytest.raises(RuntimeError, match='3 results for a batch of 4'):
+            future.result(timeout=5)
+    engine.shutdown()
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from jobs import DONE, FAILED, QUEUED, Job, JobQueue, MemoryBroker, QueueFull, SQLiteBroker, check_callback_url, \
+    priorities
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def broker(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBroker(max_queued=3)
+    return SQLiteBroker(str(tmp_path / 'jobs.db'), max_queued=3, poll_interval=0.01)
+
+
+def test_higher_priority_first_then_in_order(broker):
+    for job_id, priority, submitted in [('low', 'low', 1), ('normal1', 'normal', 2), ('high', 'high', 3)]:
+        broker.put(Job(job_id, b'x', priorities[priority], submitted=submitted))
+    with pytest.raises(QueueFull):
+        broker.put(Job('normal2', b'x', submitted=4))
+    assert broker.claim(timeout=1).id == 'high'
+    broker.put(Job('normal2', b'x', submitted=4))
+    assert [broker.claim(timeout=1).id for _ in range(3)] == ['normal1', 'normal2', 'low']
+    assert broker.claim(timeout=0.05) is None
+    assert broker.counts()[QUEUED] == 0
+
+
+def test_sqlite_lease_is_reclaimed_after_a_crash(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    crashed = SQLiteBroker(path, lease_seconds=0.2, max_attempts=2, poll_interval=0.01)
+    crashed.put(Job('job', b'payload'))
+    assert crashed.claim(timeout=1).id == 'job'
+
+    # Another worker process, sharing the file, takes the job over once the lease runs out
+    survivor = SQLiteBroker(path, lease_seconds=0.2, max_attempts=2, poll_interval=0.01)
+    assert survivor.claim(timeout=0.05) is None
+    job = survivor.claim(timeout=2)
+    assert job.id == 'job' and job.payload == b'payload'
+
+    # A job that keeps killing its worker is failed rather than retried forever
+    time.sleep(0.3)
+    assert survivor.claim(timeout=0.05) is None
+    job = survivor.get('job')
+    assert job.status == FAILED and job.status_code == 500
+
+
+def test_queue_runs_jobs_and_survives_a_failing_hook(broker):
+    finished = []
+
+    def on_finish(job):
+        finished.append(job.id)
+        raise RuntimeError("metrics are down")
+
+    def process(job):
+        return (200, {'size': len(job.payload)}) if job.payload else (400, {'error': 'Empty upload'})
+
+    queue = JobQueue(broker, process, workers=1, on_finish=on_finish)
+    try:
+        jobs = [queue.submit(payload) for payload in (b'abc', b'', b'de')]
+        wait_for(lambda: len(finished) == 3)
+        done = [queue.get(job.id) for job in jobs]
+        assert [job.status for job in done] == [DONE, FAILED, DONE]
+        assert done[0].result == {'size': 3}
+        assert done[1].to_dict()['result'] == {'error': 'Empty upload'}
+    finally:
+        queue.shutdown(timeout=2)
+
+
+@pytest.mark.parametrize('url', ['ftp://example.com/hook', 'http://127.0.0.1/hook', 'http://10.1.2.3/hook',
+                                 'http://169.254.169.254/latest', 'http://[::1]/hook'])
+def test_internal_callback_urls_are_refused(url):
+    with pytest.raises(ValueError):
+        check_callback_url(url)
+
+
+def test_allowed_callback_hosts():
+    check_callback_url('http://8.8.8.8/hook')
+    check_callback_url('http://127.0.0.1:8000/hook', allowed_hosts={'127.0.0.1'})
+
+
+def test_callback_receives_the_finished_job(broker):
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    queue = JobQueue(broker, lambda job: (200, {'ok': True}), workers=1, callback_hosts={'127.0.0.1'})
+    try:
+        job = queue.submit(b'x', callback_url=f"http://127.0.0.1:{server.server_port}/hook")
+        wait_for(lambda: received)
+        assert received[0]['job_id'] == job.id and received[0]['status'] == DONE
+        assert received[0]['result'] == {'ok': True}
+    finally:
+        queue.shutdown(timeout=2)
+        server.shutdown()
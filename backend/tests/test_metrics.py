@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from metrics import MetricsRegistry, SlowRequestProfiler
+
+
+def test_counters_and_histograms_render_in_prometheus_format():
+    metrics = MetricsRegistry()
+    responses = metrics.counter('responses_total', "Responses", ['endpoint', 'status'])
+    latency = metrics.histogram('request_seconds', "Latency", ['endpoint'], buckets=(0.1, 1.0))
+    metrics.callback('queued', "Queued jobs", lambda: 3)
+    responses.inc(endpoint='predict', status=200)
+    responses.inc(endpoint='predict', status=200)
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, endpoint='predict')
+
+    lines = metrics.render().splitlines()
+    assert 'responses_total{endpoint="predict",status="200"} 2' in lines
+    assert 'request_seconds_bucket{endpoint="predict",le="0.1"} 1' in lines
+    assert 'request_seconds_bucket{endpoint="predict",le="1"} 2' in lines
+    assert 'request_seconds_bucket{endpoint="predict",le="+Inf"} 3' in lines
+    assert 'request_seconds_sum{endpoint="predict"} 5.55' in lines
+    assert 'request_seconds_count{endpoint="predict"} 3' in lines
+    assert '# TYPE request_seconds histogram' in lines
+    assert 'queued 3' in lines
+
+
+def test_timer_records_even_when_the_block_raises():
+    latency = MetricsRegistry().histogram('stage_seconds', "Stages", ['stage'])
+    try:
+        with latency.time(stage='decode'):
+            raise ValueError
+    except ValueError:
+        pass
+    assert 'stage_seconds_count{stage="decode"} 1' in latency.render()
+
+
+def test_disabled_registry_records_nothing():
+    metrics = MetricsRegistry(enabled=False)
+    metrics.counter('responses_total', "Responses").inc()
+    with metrics.histogram('request_seconds', "Latency").time():
+        pass
+    assert not [line for line in metrics.render().splitlines() if not line.startswith('#')]
+
+
+def test_profiler_writes_only_slow_requests(tmp_path):
+    profiler = SlowRequestProfiler(threshold_ms=50, out_dir=str(tmp_path), interval_ms=1)
+    assert profiler.end(profiler.begin('fast')) is None
+
+    token = profiler.begin('POST /predict')
+    time.sleep(0.1)
+    path = profiler.end(token)
+    assert path is not None and os.path.dirname(path) == str(tmp_path)
+    assert 'POST_predict' in os.path.basename(path)
+    with open(path) as f:
+        assert 'test_profiler_writes_only_slow_requests' in f.read()
+    assert profiler.dumps == 1
+
+
+def test_profiler_follows_named_threads(tmp_path):
+    profiler = SlowRequestProfiler(threshold_ms=10, out_dir=str(tmp_path), interval_ms=1,
+                                   follow_threads=('batching-',))
+    done = threading.Event()
+    worker = threading.Thread(target=done.wait, args=(5,), name='batching-Parts', daemon=True)
+    worker.start()
+    token = profiler.begin('request')
+    time.sleep(0.05)
+    path = profiler.end(token)
+    done.set()
+    with open(path) as f:
+        assert any(line.startswith('thread batching-Parts;') for line in f)
@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from batching import BatchingEngine
+from model_server import ModelClient, ModelServer
+
+authkey = b'test-key'
+
+
+def start_server(address: str, scale: float = 1.0) -> ModelServer:
+    engine = BatchingEngine(lambda name, batch: batch[:, 0, 0, :2] * scale, max_batch_size=8, max_wait_ms=5)
+    server = ModelServer(address, authkey, engine, stats=lambda: {'Parts': {'loaded': True}})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def address(tmp_path):
+    return str(tmp_path / 'models.sock')
+
+
+def test_client_runs_batches_in_the_server(address):
+    server = start_server(address)
+    client = ModelClient(address, authkey)
+    batch = np.stack([np.full((4, 4, 3), i, dtype=np.float32) for i in range(3)])
+    np.testing.assert_array_equal(client.predict('Parts', batch), [[0, 0], [1, 1], [2, 2]])
+    assert client.stats() == {'Parts': {'loaded': True}}
+    server.close()
+
+
+def test_concurrent_clients_get_their_own_results(address):
+    server = start_server(address)
+    client = ModelClient(address, authkey)
+    results = {}
+
+    def call(i):
+        results[i] = client.predict('Parts', np.full((1, 4, 4, 3), i, dtype=np.float32))[0, 0]
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: i for i in range(16)}
+    server.close()
+
+
+def test_errors_are_raised_in_the_client(address):
+    server = start_server(address)
+    with pytest.raises(RuntimeError, match="Unknown request"):
+        ModelClient(address, authkey)._call(('train',))
+    server.close()
+
+
+def serve_in_process(address: str, scale: float) -> multiprocessing.Process:
+    # As in serve.py, where the model process can die and be restarted on the same socket
+    def run():
+        start_server(address, scale)
+        threading.Event().wait()
+
+    process = multiprocessing.get_context('fork').Process(target=run, daemon=True)
+    process.start()
+    deadline = time.monotonic() + 5
+    while not os.path.exists(address) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return process
+
+
+def test_client_reconnects_after_the_server_restarts(address):
+    process = serve_in_process(address, scale=1.0)
+    client = ModelClient(address, authkey)
+    x = np.ones((1, 4, 4, 3), dtype=np.float32)
+    np.testing.assert_array_equal(client.predict('Parts', x), [[1, 1]])
+    process.kill()
+    process.join()
+    with pytest.raises(RuntimeError, match="unavailable"):
+        client.predict('Parts', x)
+
+    os.unlink(address)
+    process = serve_in_process(address, scale=2.0)
+    try:
+        np.testing.assert_array_equal(client.predict('Parts', x), [[2, 2]])
+    finally:
+        process.kill()
+
+
+def test_wrong_key_is_refused(address):
+    server = start_server(address)
+    with pytest.raises(RuntimeError, match="unavailable"):
+        ModelClient(address, b'other-key').stats()
+    server.close()
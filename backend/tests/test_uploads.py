@@ -0,0 +1,79 @@
+import io
+import tarfile
+import zipfile
+import pytest
+from uploads import expand_uploads, is_archive
+
+
+def zip_bytes(files, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def tar_bytes(files, mode='w:gz') -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_archive_suffixes():
+    assert is_archive('scans.ZIP') and is_archive('scans.tar.gz') and is_archive('scans.tgz')
+    assert not is_archive('hand.png') and not is_archive(None)
+
+
+def test_archives_are_expanded_in_order():
+    uploads = expand_uploads([
+        ('first.png', io.BytesIO(b'1')),
+        ('scans.zip', io.BytesIO(zip_bytes({'a.png': b'a', 'dir/b.png': b'b', '__MACOSX/._a.png': b'',
+                                            '.DS_Store': b''}))),
+        ('more.tgz', io.BytesIO(tar_bytes({'c.png': b'c'}))),
+    ])
+    assert uploads == [('first.png', b'1'), ('scans.zip/a.png', b'a'), ('scans.zip/dir/b.png', b'b'),
+                       ('more.tgz/c.png', b'c')]
+
+
+def test_too_many_files():
+    with pytest.raises(ValueError, match='Too many images'):
+        expand_uploads([('scans.zip', io.BytesIO(zip_bytes({f'{i}.png': b'x' for i in range(5)})))], max_files=4)
+    with pytest.raises(ValueError, match='Too many images'):
+        expand_uploads([(f'{i}.png', io.BytesIO(b'x')) for i in range(5)], max_files=4)
+
+
+def test_uncompressed_size_is_checked_before_extracting():
+    # 4 MB of zeros compress to a few kB
+    bomb = zip_bytes({'big.png': bytes(4 * 2 ** 20)})
+    assert len(bomb) < 2 ** 20
+    with pytest.raises(ValueError, match='Upload too large'):
+        expand_uploads([('bomb.zip', io.BytesIO(bomb))], max_bytes=2 ** 20)
+
+
+def test_plain_files_are_read_only_up_to_the_limit():
+    stream = io.BytesIO(bytes(2 ** 20))
+    with pytest.raises(ValueError, match='Upload too large'):
+        expand_uploads([('big.png', stream)], max_bytes=1000)
+    assert stream.tell() == 1001
+
+
+@pytest.mark.parametrize('filename, data', [
+    ('scans.zip', b'not an archive'),
+    ('scans.zip', zip_bytes({'a.png': b'x' * 1000})[:60]),
+    ('scans.tgz', tar_bytes({'a.png': bytes(range(256)) * 40})[:-40]),
+])
+def test_unreadable_archives_raise_value_error(filename, data):
+    with pytest.raises(ValueError, match='Cannot read'):
+        expand_uploads([(filename, io.BytesIO(data))])
+
+
+def test_corrupt_member_raises_value_error():
+    data = bytearray(zip_bytes({'a.png': bytes(range(256)) * 8}))
+    # Flip a byte of the compressed data, after the 30-byte local header and the name
+    data[30 + len('a.png') + 10] ^= 0xff
+    with pytest.raises(ValueError, match="Cannot read 'scans.zip/a.png'"):
+        expand_uploads([('scans.zip', io.BytesIO(bytes(data)))])
@@ -0,0 +1,110 @@
+import io
+import lzma
+import os
+import tarfile
+import zipfile
+import zlib
+from typing import BinaryIO, List, Tuple
+
+# Uploads with these names are unpacked and every file inside is classified
+archive_suffixes = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+# Raised by zipfile and tarfile (and the decompressors beneath them) for corrupt, truncated,
+# encrypted or unsupported archives; RuntimeError and NotImplementedError come from encrypted
+# members and unsupported zip compression methods
+archive_errors = (zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, zlib.error, lzma.LZMAError,
+                  EOFError, OSError, RuntimeError, NotImplementedError)
+
+
+def is_archive(filename: str) -> bool:
+    return (filename or '').lower().endswith(archive_suffixes)
+
+
+def expand_uploads(files: List[Tuple[str, BinaryIO]], max_files: int = 256,
+                   max_bytes: int = 256 * 2 ** 20) -> List[Tuple[str, bytes]]:
+    """
+    Read a multipart upload into (filename, bytes) pairs, replacing each zip or
+    tar archive by the files it contains (in archive order, `archive/member`
+    names). Folders and metadata entries such as `__MACOSX/` or dotfiles are
+    skipped.
+
+    Raises ValueError for an unreadable archive, or when the upload holds more
+    than `max_files` images or `max_bytes` of uncompressed data. Plain files
+    are read at most one byte past the remaining budget; the member count and
+    sizes of an archive are checked from its headers before anything is
+    extracted.
+    """
+    uploads = []
+    total = 0
+    too_large = f"Upload too large: at most {max_bytes // 2 ** 20} MB of images per request"
+    too_many = f"Too many images: at most {max_files} per request"
+    for filename, stream in files:
+        if not is_archive(filename):
+            if len(uploads) == max_files:
+                raise ValueError(too_many)
+            data = stream.read(max_bytes - total + 1)
+            total += len(data)
+            if total > max_bytes:
+                raise ValueError(too_large)
+            uploads.append((filename, data))
+            continue
+
+        members = _archive_members(filename, stream, max_files - len(uploads))
+        if len(uploads) + len(members) > max_files:
+            raise ValueError(too_many)
+        if total + sum(size for _, size, _ in members) > max_bytes:
+            raise ValueError(too_large)
+        for name, size, read in members:
+            try:
+                data = read()
+            except archive_errors as e:
+                # e.g. a CRC mismatch or a truncated stream, only found while decompressing
+                raise ValueError(f"Cannot read '{name}': {e}")
+            total += len(data)
+            if total > max_bytes:
+                raise ValueError(too_large)
+            uploads.append((name, data))
+    return uploads
+
+
+def _archive_members(filename: str, stream: BinaryIO, max_files: int) -> List[Tuple[str, int, callable]]:
+    # (name, size, read) of each file in the archive, listed from the headers only;
+    # listing stops once there are more than `max_files`
+    try:
+        if filename.lower().endswith('.zip'):
+            # The central directory is read without decompressing anything
+            archive = zipfile.ZipFile(_seekable(stream))
+            entries = ((info.filename, info.file_size, info) for info in archive.infolist() if not info.is_dir())
+            extract = lambda info: archive.read(info)
+        else:
+            # Headers are read one at a time, so a huge member list stops at the limit
+            archive = tarfile.open(fileobj=_seekable(stream))
+            entries = ((member.name, member.size, member) for member in iter(archive.next, None)
+                       if member.isfile())
+            extract = lambda member: archive.extractfile(member).read()
+
+        members = []
+        for name, size, entry in entries:
+            if _is_metadata(name):
+                continue
+            members.append((f"{filename}/{name}", size, lambda entry=entry: extract(entry)))
+            if len(members) > max_files:
+                break
+    except archive_errors as e:
+        raise ValueError(f"Cannot read archive '{filename}': {e}")
+    return members
+
+
+def _seekable(stream: BinaryIO) -> BinaryIO:
+    # Flask spools uploads to a seekable file already; anything else is copied to memory
+    try:
+        if stream.seekable():
+            return stream
+    except AttributeError:
+        pass
+    return io.BytesIO(stream.read())
+
+
+def _is_metadata(name: str) -> bool:
+    parts = name.replace('\\', '/').split('/')
+    return parts[0] == '__MACOSX' or os.path.basename(name).startswith('.')
@@ -30,30 +30,60 @@ function App() {
   const [generatingAnswer, setGeneratingAnswer] = useState(false);
   const [file, setFile] = useState(null); // To hold uploaded image
   const chatContainerRef = useRef(null);
+  // Identifies this browser tab's conversation to the backend
+  const [sessionId] = useState(() => crypto.randomUUID());
 
   const [messages, setMessages] = useState([]);
 
+  // Append streamed text to the answer currently being generated
+  const appendToLastAnswer = (text) =>
+    setChatHistory((prev) => [
+      ...prev.slice(0, -1),
+      {
+        ...prev[prev.length - 1],
+        content: prev[prev.length - 1].content + text,
+      },
+    ]);
+
+  // Post a message to /chat/stream and call onText with each chunk of the reply
+  const streamChat = async (message, onText) => {
+    const response = await fetch("http://127.0.0.1:5000/chat/stream", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ message, session_id: sessionId }),
+    });
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+
+      for (const event of events) {
+        const type = event.match(/^event: (.*)$/m)?.[1];
+        const data = JSON.parse(event.match(/^data: (.*)$/m)?.[1] || "{}");
+        if (type === "error") throw new Error(data.error);
+        if (type === "message") onText(data.text);
+      }
+    }
+  };
+
   const AnswerFromGemini = async (userResponse) => {
     try {
       const userInput = userResponse;
 
       setMessages([...messages, { role: "user", content: userInput }]);
 
-      const response = await fetch("http://127.0.0.1:5000/chat", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ message: userInput }),
-      });
-
-      const result = await response.json();
-      console.log(result);
-
-      setChatHistory((prev) => [
-        ...prev,
-        { type: "answer", content: result.response },
-      ]);
+      setChatHistory((prev) => [...prev, { type: "answer", content: "" }]);
+      await streamChat(userInput, appendToLastAnswer);
     } catch (error) {
       console.error("Error fetching fracture details:", error);
       return "Sorry, I couldn't retrieve the details. Please try again later.";
@@ -64,20 +94,8 @@ function App() {
     try {
       const userInput = `tell me more about the fracture in my ${bodyPart}`;
 
-      const response = await fetch("http://127.0.0.1:5000/chat", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ message: userInput }),
-      });
-
-      const result = await response.json();
- 
-      setChatHistory((prev) => [
-        ...prev,
-        { type: "answer", content: result.response },
-      ]);
+      setChatHistory((prev) => [...prev, { type: "answer", content: "" }]);
+      await streamChat(userInput, appendToLastAnswer);
     } catch (error) {
       console.error("Error fetching fracture details:", error);
       return "Sorry, I couldn't retrieve the details. Please try again later.";
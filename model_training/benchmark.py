@@ -0,0 +1,288 @@
+"""
+Reproducible inference benchmark over the `test` subset.
+
+Measures, in one fresh process:
+  cold start  - importing predictions.py and classifying the first image
+  single      - warm latency of predictions.predict (body part, then fracture)
+                per image, with p50/p95/p99
+  batched     - images/sec of each model at several batch sizes
+  http        - end-to-end latency of /predict, served by backend/model_v2.py
+                on a loopback port, one request at a time and under load
+and the peak RSS after each stage. Nothing needs a GPU or network access.
+
+The prediction cache is disabled so repeated images still reach the models.
+Results are written as JSON, tagged with the commit and the inference
+settings, so runs can be compared across commits:
+
+    python benchmark.py --output benchmarks/after.json
+    python benchmark.py --compare benchmarks/before.json benchmarks/after.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+import numpy as np
+
+# Must be set before predictions.py or model_v2.py create their caches
+os.environ['PREDICTION_CACHE_SIZE'] = '0'
+os.environ.pop('PREDICTION_CACHE_PATH', None)
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+BACKEND_FOLDER = os.path.join(THIS_FOLDER, '..', 'backend')
+test_dir = os.path.join(THIS_FOLDER, 'test')
+
+# Settings that change what is measured, recorded with every run
+config_variables = ('INFERENCE_MODE', 'MODEL_LOAD_MODE', 'MAX_RESIDENT_MODELS', 'INFERENCE_RUNTIME',
+                    'RUNTIME_QUANTIZATION', 'RUNTIME_THREADS', 'COMPILED_INFERENCE', 'WARMUP_BATCH_SIZES',
+                    'BATCHING', 'BATCH_MAX_SIZE', 'BATCH_MAX_WAIT_MS', 'REDUCED_DECODE')
+
+# Metrics printed by --compare, and whether a higher value is better
+compared_metrics = {
+    'cold_start.seconds': False,
+    'single.p50_ms': False,
+    'single.p95_ms': False,
+    'single.p99_ms': False,
+    'http.single.p50_ms': False,
+    'http.single.p95_ms': False,
+    'http.single.p99_ms': False,
+    'http.load.requests_per_sec': True,
+    'peak_rss_mb': False,
+}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def percentiles(timings: List[float]) -> Dict[str, float]:
+    """
+    Summary of latencies given in seconds, in milliseconds.
+    """
+    ms = np.array(timings) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def time_each(fn: Callable[[str], object], items: List[str], repeats: int) -> List[float]:
+    timings = []
+    for _ in range(repeats):
+        for item in items:
+            start = time.perf_counter()
+            fn(item)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def test_images(path: str) -> List[str]:
+    return [os.path.join(root, name) for root, _, files in sorted(os.walk(path)) for name in sorted(files)]
+
+
+def commit_id() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=THIS_FOLDER, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def bench_predictions(paths: List[str], batch_sizes: List[int], repeats: int) -> Dict[str, object]:
+    """
+    Cold start, warm single-image latency and batched throughput of predictions.py.
+    """
+    results = {}
+
+    start = time.perf_counter()
+    import predictions
+    from image_io import decode_image, new_buffer
+    import_seconds = time.perf_counter() - start
+
+    def classify(path: str) -> None:
+        body_part = predictions.predict(path)
+        predictions.predict(path, body_part)
+
+    classify(paths[0])
+    results['cold_start'] = {'import_seconds': import_seconds, 'seconds': time.perf_counter() - start,
+                             'peak_rss_mb': peak_rss_mb()}
+
+    # Load every model before timing, so lazy loading is not counted as latency
+    predictions.model_dict.preload(block=True)
+    classify(paths[0])
+    results['single'] = dict(percentiles(time_each(classify, paths, repeats)), peak_rss_mb=peak_rss_mb())
+
+    # Decode once so only the forward passes are timed
+    decoded = new_buffer(len(paths))
+    for i, path in enumerate(paths):
+        decode_image(path, out=decoded[i])
+
+    batched = []
+    for name in predictions.model_dict.keys():
+        for batch_size in batch_sizes:
+            batch = decoded[np.arange(batch_size) % len(decoded)]
+            predictions.predict_proba(batch, name)
+            timings = time_each(lambda _: predictions.predict_proba(batch, name), [None], repeats)
+            batched.append({'model': name, 'batch_size': batch_size,
+                            'median_ms': float(np.median(timings)) * 1000,
+                            'images_per_sec': batch_size / float(np.median(timings))})
+    results['batched'] = batched
+    results['batched_peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+@contextmanager
+def serve_app(backend_dir: str) -> Iterator[str]:
+    """
+    Serve backend/model_v2.py on a free loopback port and yield the /predict URL.
+    The app reads ./weights, so the working directory is the backend folder while it runs.
+    """
+    from werkzeug.serving import make_server
+    previous_dir = os.getcwd()
+    os.chdir(backend_dir)
+    sys.path.insert(0, backend_dir)
+    try:
+        import model_v2
+        model_v2.model_dict.preload(block=True)
+        server = make_server('127.0.0.1', 0, model_v2.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, name='benchmark-server', daemon=True)
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}/predict"
+        finally:
+            server.shutdown()
+            thread.join()
+    finally:
+        os.chdir(previous_dir)
+
+
+def bench_http(paths: List[str], backend_dir: str, repeats: int, requests: int,
+               concurrency: int) -> Dict[str, object]:
+    """
+    Latency of /predict over loopback HTTP, sequential and with `concurrency` clients.
+    """
+    sys.path.insert(0, backend_dir)
+    from load_test import http_sender, run_load
+
+    with serve_app(backend_dir) as url:
+        senders = {path: http_sender(url, path) for path in paths}
+        statuses = [send() for send in senders.values()]  # warm up
+        if any(status != 200 for status in statuses):
+            raise RuntimeError(f"/predict returned {statuses} during warm-up")
+        single = percentiles(time_each(lambda path: senders[path](), paths, repeats))
+        load = run_load(senders[paths[0]], requests, concurrency)
+    return {'single': single, 'load': load, 'peak_rss_mb': peak_rss_mb()}
+
+
+def lookup(results: Dict[str, object], dotted: str):
+    for key in dotted.split('.'):
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(before_path: str, after_path: str) -> None:
+    from colorama import Fore
+    from tabulate import tabulate
+
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    table = [["Metric", before['commit'], after['commit'], "Change"]]
+    for metric, higher_is_better in compared_metrics.items():
+        old, new = lookup(before, metric), lookup(after, metric)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        better = change > 0 if higher_is_better else change < 0
+        color = Fore.GREEN if better else Fore.RED if change else ''
+        table.append([metric, f"{old:.2f}", f"{new:.2f}", color + f"{change:+.1f}%" + Fore.RESET])
+
+    for row in after.get('batched', []):
+        old = next((r for r in before.get('batched', [])
+                    if r['model'] == row['model'] and r['batch_size'] == row['batch_size']), None)
+        if old is None:
+            continue
+        change = (row['images_per_sec'] - old['images_per_sec']) / old['images_per_sec'] * 100
+        color = Fore.GREEN if change > 0 else Fore.RED if change else ''
+        table.append([f"batched.{row['model']}.b{row['batch_size']}.images_per_sec",
+                      f"{old['images_per_sec']:.1f}", f"{row['images_per_sec']:.1f}",
+                      color + f"{change:+.1f}%" + Fore.RESET])
+
+    if before.get('config') != after.get('config'):
+        print(Fore.YELLOW + "Runs used different settings:\n"
+              f"  {before['commit']}: {before.get('config')}\n  {after['commit']}: {after.get('config')}")
+    print(tabulate(table, headers="firstrow", tablefmt="grid", disable_numparse=True))
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', default=test_dir, help="Folder of images to run on")
+    parser.add_argument('--output', help="JSON file to write (default: benchmarks/<commit>.json)")
+    parser.add_argument('--repeats', type=int, default=5, help="Passes over the images for each latency")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--http-requests', type=int, default=128)
+    parser.add_argument('--http-concurrency', type=int, default=8)
+    parser.add_argument('--no-http', action='store_true', help="Skip the /predict measurements")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="Print the change between two result files instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    paths = test_images(args.images)
+    if not paths:
+        raise SystemExit(f"No images found under {args.images}")
+
+    commit = commit_id()
+    results = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'images': len(paths),
+        'repeats': args.repeats,
+        'config': {name: os.environ[name] for name in config_variables if name in os.environ},
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpus': os.cpu_count()},
+    }
+    results.update(bench_predictions(paths, args.batch_sizes, args.repeats))
+    if not args.no_http:
+        # The app holds its own registry, so this stage adds a second set of models to the peak
+        results['http'] = bench_http(paths, os.path.abspath(BACKEND_FOLDER), args.repeats, args.http_requests,
+                                     args.http_concurrency)
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    output = args.output or os.path.join(THIS_FOLDER, 'benchmarks', f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    single = results['single']
+    print(f"Cold start {results['cold_start']['seconds']:.2f}s, "
+          f"single image p50/p95/p99 {single['p50_ms']:.1f}/{single['p95_ms']:.1f}/{single['p99_ms']:.1f} ms, "
+          f"peak RSS {results['peak_rss_mb']:.0f} MB")
+    if 'http' in results:
+        http = results['http']['single']
+        print(f"/predict p50/p95/p99 {http['p50_ms']:.1f}/{http['p95_ms']:.1f}/{http['p99_ms']:.1f} ms, "
+              f"{results['http']['load']['requests_per_sec']:.1f} req/s under load")
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import numpy as np
+import tensorflow as tf
+from typing import Callable, Dict, List
+
+# Categories for each result by index
+categories_parts = ["Elbow", "Hand", "Shoulder"]
+categories_fracture = ['fractured', 'normal']
+
+# Column layout of the fused model output: body part probabilities followed by
+# the fracture probabilities of each per-part head
+fused_slices = {
+    'Parts': slice(0, 3),
+    'Elbow': slice(3, 5),
+    'Hand': slice(5, 7),
+    'Shoulder': slice(7, 9)
+}
+
+
+def classify(x: np.ndarray, predict_fn: Callable[[str, np.ndarray], np.ndarray]) -> Dict[str, object]:
+    """
+    Run the two-step cascade on one image: the body part model, then only the
+    fracture model of the part it selects.
+
+    `predict_fn(model_name, x)` must return the probability row for a single image.
+    """
+    part_probs = np.asarray(predict_fn('Parts', x))
+    body_part = categories_parts[int(np.argmax(part_probs))]
+    fracture_probs = np.asarray(predict_fn(body_part, x))
+    return _result(part_probs, fracture_probs)
+
+
+def classify_batch(images: np.ndarray,
+                   predict_batch_fn: Callable[[str, np.ndarray], np.ndarray]) -> List[Dict[str, object]]:
+    """
+    Run the cascade over a batch. The parts model sees the whole batch once, then
+    each fracture model runs once on the images routed to it.
+
+    `predict_batch_fn(model_name, batch)` must return one probability row per image.
+    """
+    part_probs = np.asarray(predict_batch_fn('Parts', images))
+    part_index = np.argmax(part_probs, axis=1)
+    fracture_probs = np.zeros((len(images), len(categories_fracture)), dtype=np.float32)
+    for i, part in enumerate(categories_parts):
+        rows = np.flatnonzero(part_index == i)
+        if len(rows):
+            fracture_probs[rows] = predict_batch_fn(part, images[rows])
+    return [_result(p, f) for p, f in zip(part_probs, fracture_probs)]
+
+
+def classify_fused(fused_row: np.ndarray) -> Dict[str, object]:
+    """
+    Read the cascade result for one image from a row of the fused model output.
+    """
+    part_probs = fused_row[fused_slices['Parts']]
+    body_part = categories_parts[int(np.argmax(part_probs))]
+    return _result(part_probs, fused_row[fused_slices[body_part]])
+
+
+def _result(part_probs: np.ndarray, fracture_probs: np.ndarray) -> Dict[str, object]:
+    part_index = int(np.argmax(part_probs))
+    fracture_index = int(np.argmax(fracture_probs))
+    return {
+        'body_part': categories_parts[part_index],
+        'body_part_prob': float(part_probs[part_index]),
+        'prediction': categories_fracture[fracture_index],
+        'fracture_prob': float(fracture_probs[fracture_index])
+    }
+
+
+def feature_layer_index(model: tf.keras.Model) -> int:
+    """
+    Index of the backbone's pooled feature layer, i.e. where the trained dense head starts.
+    """
+    for i in range(len(model.layers) - 1, -1, -1):
+        if isinstance(model.layers[i], tf.keras.layers.GlobalAveragePooling2D):
+            return i
+    raise ValueError(f"Model '{model.name}' has no pooled backbone output")
+
+
+def feature_extractor(model: tf.keras.Model) -> tf.keras.Model:
+    """
+    Model that stops at the backbone's pooled (penultimate) features.
+    """
+    return tf.keras.Model(model.inputs, model.layers[feature_layer_index(model)].output)
+
+
+def backbones_match(models: List[tf.keras.Model]) -> bool:
+    """
+    Check that the models share identical backbone weights. The training
+    notebooks freeze the ImageNet ResNet50, so only the dense heads differ.
+    """
+    reference = models[0]
+    reference_layers = reference.layers[:feature_layer_index(reference) + 1]
+    for model in models[1:]:
+        layers = model.layers[:feature_layer_index(model) + 1]
+        if len(layers) != len(reference_layers):
+            return False
+        for a, b in zip(reference_layers, layers):
+            weights_a, weights_b = a.get_weights(), b.get_weights()
+            if len(weights_a) != len(weights_b):
+                return False
+            if not all(np.array_equal(wa, wb) for wa, wb in zip(weights_a, weights_b)):
+                return False
+    return True
+
+
+def build_fused_model(model_dict: Dict[str, tf.keras.Model]) -> tf.keras.Model:
+    """
+    Build a single graph that runs the shared ResNet50 backbone once and feeds
+    its features to all four dense heads. The layers (and weights) are reused
+    from the loaded models, so this costs no extra weight memory.
+
+    The output is one row per image laid out as described by `fused_slices`.
+    """
+    names = list(fused_slices)
+    models = [model_dict[name] for name in names]
+    if not backbones_match(models):
+        raise ValueError("Models do not share the same backbone weights; cannot fuse them")
+
+    backbone = feature_extractor(model_dict['Parts'])
+    inputs = tf.keras.Input(shape=backbone.input_shape[1:])
+    features = backbone(inputs)
+
+    outputs = []
+    for model in models:
+        x = features
+        for layer in model.layers[feature_layer_index(model) + 1:]:
+            x = layer(x)
+        outputs.append(x)
+
+    return tf.keras.Model(inputs, tf.keras.layers.Concatenate()(outputs), name='ResNet50_Fused')
@@ -0,0 +1,70 @@
+import os
+import time
+import numpy as np
+from colorama import Fore
+from tabulate import tabulate
+from typing import Callable, Dict, List
+from predictions import model_dict
+from cascade import build_fused_model, classify, classify_fused
+from image_io import decode_image
+
+
+def load_images(path: str) -> List[np.ndarray]:
+    """
+    Decode every image under `path` once so only inference is timed.
+    """
+    images = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            images.append(decode_image(os.path.join(root, name)))
+    return images
+
+
+def run_legacy(x: np.ndarray) -> None:
+    # Mirrors the previous /predict handler: parts model, then every fracture model twice
+    images = np.expand_dims(x, axis=0)
+    model_dict['Parts'].predict(images, verbose=0)
+    for part in ('Elbow', 'Hand', 'Shoulder'):
+        np.argmax(model_dict[part].predict(images, verbose=0), axis=1)
+        model_dict[part].predict(images, verbose=0)
+
+
+def run_cascade(x: np.ndarray) -> None:
+    classify(x, lambda name, img: model_dict[name].predict(np.expand_dims(img, axis=0), verbose=0)[0])
+
+
+def benchmark(name: str, fn: Callable[[np.ndarray], None], images: List[np.ndarray]) -> List[str]:
+    fn(images[0])  # warm up
+    timings = []
+    for x in images:
+        start = time.perf_counter()
+        fn(x)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings = np.array(timings)
+    return [name, f"{timings.mean():.1f}", f"{np.percentile(timings, 50):.1f}", f"{np.percentile(timings, 95):.1f}"]
+
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+test_dir = os.path.join(THIS_FOLDER, 'test')
+
+if __name__ == '__main__':
+    images = load_images(test_dir)
+    modes: Dict[str, Callable[[np.ndarray], None]] = {
+        'legacy (7 passes)': run_legacy,
+        'cascade (2 passes)': run_cascade,
+    }
+    # The fused model is assembled from the Keras layers; TFLite serves it from its own exported graph
+    if model_dict.runtime == 'keras':
+        fused_model = build_fused_model(model_dict)
+        modes['fused (1 pass)'] = lambda x: classify_fused(
+            fused_model.predict(np.expand_dims(x, axis=0), verbose=0)[0])
+    else:
+        print(Fore.YELLOW + f"Skipping the fused mode: it needs INFERENCE_RUNTIME=keras, "
+                            f"not {model_dict.runtime}" + Fore.RESET)
+
+    table = [["Mode", "Mean ms", "p50 ms", "p95 ms"]]
+    for name, fn in modes.items():
+        table.append(benchmark(name, fn, images))
+
+    print(Fore.BLUE + f"\nPer-image latency over {len(images)} images:")
+    print(tabulate(table, headers="firstrow", tablefmt="grid"))
@@ -0,0 +1,235 @@
+import os
+import hashlib
+import argparse
+from typing import Dict, List, Tuple
+import numpy as np
+
+# Categories for each result by index
+categories_parts = ["Elbow", "Hand", "Shoulder"]
+categories_fracture = ['fractured', 'normal']
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+default_index_root = os.path.join(THIS_FOLDER, 'cache', 'index')
+
+# Column name -> numpy dtype of the manifest
+columns = {
+    'path': str,          # relative to the index root
+    'split': str,         # 'train', 'test' or '' when the root is a single split
+    'part': np.int8,      # index into categories_parts
+    'patient_id': str,    # '' for the flat <Part>/<label>/<image> layout
+    'study': str,
+    'label': np.int8,     # index into categories_fracture
+    'size': np.int64,
+    'mtime': np.int64
+}
+
+
+def _classify(relative_dir: str) -> Dict[str, object]:
+    """
+    Read split, body part, patient, study and label from the folders an image sits in.
+    Supports <Part>/<patient>/<study>_positive|negative, the same under a
+    <split> folder, and the flat <Part>/fractured|normal layout of `test`.
+    """
+    parts = relative_dir.split(os.sep) if relative_dir else []
+    split = ''
+    if parts and parts[0] not in categories_parts:
+        split, parts = parts[0], parts[1:]
+    if not parts or parts[0] not in categories_parts:
+        return None
+
+    if len(parts) == 3:
+        _, patient_id, study = parts
+        label = 'fractured' if study.endswith('positive') else 'normal'
+    elif len(parts) == 2 and parts[1] in categories_fracture:
+        patient_id, study, label = '', '', parts[1]
+    else:
+        return None
+    return {'split': split, 'part': categories_parts.index(parts[0]), 'patient_id': patient_id,
+            'study': study, 'label': categories_fracture.index(label)}
+
+
+class DatasetIndex:
+    """
+    Columnar manifest of the X-ray images under `root`: one numpy array per
+    entry of `columns`, plus the modification time of every folder.
+
+    `DatasetIndex.load(root)` reuses the manifest saved by a previous run and
+    only re-lists folders whose modification time changed. Filtering returns a
+    new index over the selected rows.
+    """
+
+    def __init__(self, root: str, data: Dict[str, np.ndarray], dirs: Dict[str, int] = None):
+        self.root = os.path.abspath(root)
+        self.data = data
+        self.dirs = dirs or {}
+
+    @classmethod
+    def scan(cls, root: str) -> 'DatasetIndex':
+        index = cls(root, {name: np.array([], dtype=dtype) for name, dtype in columns.items()})
+        return index.refresh(deep=True)
+
+    @classmethod
+    def load(cls, root: str, index_path: str = None, refresh: bool = True, deep: bool = False) -> 'DatasetIndex':
+        """
+        Load the saved manifest of `root` (scanning it on first use), bring it
+        up to date and save it again if anything changed.
+        """
+        index_path = index_path or default_index_path(root)
+        if not os.path.exists(index_path):
+            index = cls.scan(root)
+            index.save(index_path)
+            return index
+
+        saved = np.load(index_path)
+        data = {name: saved[name] for name in columns}
+        dirs = dict(zip(saved['dirs'].tolist(), saved['dir_mtimes'].tolist()))
+        index = cls(root, data, dirs)
+        if refresh:
+            before = (len(index), dict(index.dirs))
+            index.refresh(deep=deep)
+            if deep or before != (len(index), index.dirs):
+                index.save(index_path)
+        return index
+
+    def refresh(self, deep: bool = False) -> 'DatasetIndex':
+        """
+        Bring the manifest up to date with the disk. Folders whose modification
+        time is unchanged keep their rows without being listed again; with
+        `deep`, every folder is listed and every file re-stated, which also
+        catches files rewritten in place.
+        """
+        rows_by_dir: Dict[str, List[int]] = {}
+        for i, path in enumerate(self.data['path']):
+            rows_by_dir.setdefault(os.path.dirname(path), []).append(i)
+        children: Dict[str, List[str]] = {}
+        for d in self.dirs:
+            if d:
+                children.setdefault(os.path.dirname(d), []).append(d)
+
+        kept_rows: List[int] = []
+        new_rows: List[Dict[str, object]] = []
+        dirs: Dict[str, int] = {}
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            full_dir = os.path.join(self.root, relative_dir)
+            try:
+                mtime = os.stat(full_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            dirs[relative_dir] = mtime
+
+            if not deep and self.dirs.get(relative_dir) == mtime:
+                # Same entries as last time: reuse its rows and known sub-folders
+                kept_rows.extend(rows_by_dir.get(relative_dir, []))
+                stack.extend(children.get(relative_dir, []))
+                continue
+
+            info = _classify(relative_dir)
+            with os.scandir(full_dir) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(relative_dir, entry.name)
+                    if entry.is_dir():
+                        stack.append(relative_path)
+                    elif info is not None and entry.is_file():
+                        stat = entry.stat()
+                        new_rows.append(dict(info, path=relative_path, size=stat.st_size, mtime=stat.st_mtime_ns))
+
+        kept_rows.sort()
+        new_rows.sort(key=lambda r: r['path'])
+        self.data = {
+            name: np.concatenate([self.data[name][kept_rows],
+                                  np.array([r[name] for r in new_rows], dtype=dtype)]).astype(dtype)
+            for name, dtype in columns.items()
+        }
+        order = np.argsort(self.data['path'], kind='stable')
+        self.data = {name: values[order] for name, values in self.data.items()}
+        self.dirs = dirs
+        return self
+
+    def save(self, index_path: str = None) -> None:
+        index_path = index_path or default_index_path(self.root)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        tmp_path = index_path + '.tmp.npz'
+        np.savez(tmp_path, dirs=np.array(list(self.dirs), dtype=str),
+                 dir_mtimes=np.array(list(self.dirs.values()), dtype=np.int64), **self.data)
+        os.replace(tmp_path, index_path)
+
+    def __len__(self) -> int:
+        return len(self.data['path'])
+
+    def mask(self, part: str = None, label: str = None, patient_id: str = None, split: str = None) -> np.ndarray:
+        selected = np.ones(len(self), dtype=bool)
+        if part is not None:
+            selected &= self.data['part'] == categories_parts.index(part)
+        if label is not None:
+            selected &= self.data['label'] == categories_fracture.index(label)
+        if patient_id is not None:
+            selected &= self.data['patient_id'] == patient_id
+        if split is not None:
+            selected &= self.data['split'] == split
+        return selected
+
+    def select(self, part: str = None, label: str = None, patient_id: str = None, split: str = None) -> 'DatasetIndex':
+        return self.take(self.mask(part, label, patient_id, split))
+
+    def take(self, rows: np.ndarray) -> 'DatasetIndex':
+        return DatasetIndex(self.root, {name: values[rows] for name, values in self.data.items()}, self.dirs)
+
+    def image_paths(self) -> List[str]:
+        return [os.path.join(self.root, path) for path in self.data['path']]
+
+    def body_parts(self) -> List[str]:
+        return [categories_parts[i] for i in self.data['part']]
+
+    def labels(self) -> List[str]:
+        return [categories_fracture[i] for i in self.data['label']]
+
+    def records(self) -> List[Dict[str, str]]:
+        """
+        Rows as the list of dicts the evaluation scripts and notebooks use.
+        """
+        return [{
+            'body_part': body_part,
+            'patient_id': patient_id,
+            'label': label,
+            'image_path': image_path,
+            'image_name': os.path.basename(image_path)
+        } for body_part, patient_id, label, image_path in
+            zip(self.body_parts(), self.data['patient_id'].tolist(), self.labels(), self.image_paths())]
+
+    def patient_split(self, train_size: float = 0.9, seed: int = 1) -> Tuple['DatasetIndex', 'DatasetIndex']:
+        """
+        Split into train/test so that all images of a patient (per body part) land on the same side.
+        """
+        groups = np.char.add(np.char.add(self.data['part'].astype(str), '/'), self.data['patient_id'])
+        unique = np.unique(groups)
+        shuffled = np.random.default_rng(seed).permutation(unique)
+        train_groups = shuffled[:int(round(train_size * len(unique)))]
+        in_train = np.isin(groups, train_groups)
+        return self.take(in_train), self.take(~in_train)
+
+
+def default_index_path(root: str) -> str:
+    root = os.path.abspath(root)
+    digest = hashlib.sha1(root.encode()).hexdigest()[:8]
+    return os.path.join(default_index_root, f"{os.path.basename(root)}-{digest}.npz")
+
+
+def load_path(path: str) -> List[Dict[str, str]]:
+    """
+    Load X-ray dataset from the given directory structure.
+    """
+    return DatasetIndex.load(path).records()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or refresh the manifest of a dataset folder")
+    parser.add_argument('root', nargs='?', default=os.path.join(THIS_FOLDER, 'Dataset'))
+    parser.add_argument('--deep', action='store_true', help="Re-stat every file, not only changed folders")
+    args = parser.parse_args()
+    index = DatasetIndex.load(args.root, deep=args.deep)
+    for part in categories_parts:
+        for label in categories_fracture:
+            print(f"{part: <10}{label: <10}{int(index.mask(part=part, label=label).sum())}")
+    print(f"Total: {len(index)} images, {len(np.unique(index.data['patient_id']))} patients")
@@ -0,0 +1,125 @@
+import os
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from cascade import categories_parts, categories_fracture
+from image_io import decode_image
+
+
+def _decode(path: str) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    # Top-level so it can run in a process pool
+    try:
+        return decode_image(path), None
+    except ValueError as e:
+        return None, str(e)
+
+
+class EvaluationEngine:
+    """
+    Batched, pipelined evaluation of the body part -> fracture cascade.
+
+    Stage 1 decodes images in a thread (or process) pool, one batch ahead of
+    the models. Stage 2 runs the parts model on whole batches. Stage 3 routes
+    each image to the fracture model of its predicted part, which runs once a
+    full batch of images for that part has accumulated.
+
+    `predict_batch_fn(model_name, batch)` returns one probability row per image.
+    Images found in `tensor_cache` (see tensor_cache.py) are read from its
+    memory map instead of being decoded.
+    """
+
+    def __init__(self, predict_batch_fn: Callable[[str, np.ndarray], np.ndarray],
+                 batch_size: int = 64, decode_workers: int = None, use_processes: bool = False,
+                 tensor_cache=None):
+        self.predict_batch_fn = predict_batch_fn
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers or os.cpu_count()
+        self.use_processes = use_processes
+        self.tensor_cache = tensor_cache
+
+    def run(self, dataset: List[Dict[str, str]], progress=None) -> Dict[str, object]:
+        """
+        Evaluate every `image_path` in `dataset`. `progress`, if given, is a
+        tqdm-style object whose `update(n)` is called as images finish.
+
+        Returns the true/predicted labels of every image that decoded, the
+        decode errors, and the throughput.
+        """
+        start = time.perf_counter()
+        predicted_parts: Dict[int, str] = {}
+        predicted_fracture: Dict[int, str] = {}
+        errors: List[Tuple[str, str]] = []
+        pending = {part: ([], []) for part in categories_parts}
+
+        def flush(part: str) -> None:
+            indices, images = pending[part]
+            if not indices:
+                return
+            probs = self.predict_batch_fn(part, np.stack(images))
+            for i, row in zip(indices, probs):
+                predicted_fracture[i] = categories_fracture[int(np.argmax(row))]
+            if progress is not None:
+                progress.update(len(indices))
+            pending[part] = ([], [])
+
+        pool_cls = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with pool_cls(max_workers=self.decode_workers) as pool:
+            chunks = [range(i, min(i + self.batch_size, len(dataset))) for i in range(0, len(dataset), self.batch_size)]
+            next_decode = self._decode_chunk(pool, dataset, chunks[0]) if chunks else None
+            for n, chunk in enumerate(chunks):
+                decoded = next_decode
+                # Start decoding the next batch while the models work on this one
+                next_decode = self._decode_chunk(pool, dataset, chunks[n + 1]) if n + 1 < len(chunks) else None
+
+                indices, images = [], []
+                for i, future in zip(chunk, decoded):
+                    x, error = future.result()
+                    if error is not None:
+                        errors.append((dataset[i]['image_path'], error))
+                        if progress is not None:
+                            progress.update(1)
+                        continue
+                    indices.append(i)
+                    images.append(x)
+                if not indices:
+                    continue
+
+                part_probs = self.predict_batch_fn('Parts', np.stack(images))
+                for i, x, row in zip(indices, images, part_probs):
+                    part = categories_parts[int(np.argmax(row))]
+                    predicted_parts[i] = part
+                    pending[part][0].append(i)
+                    pending[part][1].append(x)
+                for part in categories_parts:
+                    if len(pending[part][0]) >= self.batch_size:
+                        flush(part)
+
+            for part in categories_parts:
+                flush(part)
+
+        seconds = time.perf_counter() - start
+        order = sorted(predicted_parts)
+        return {
+            'y_true_parts': [dataset[i]['body_part'] for i in order],
+            'y_pred_parts': [predicted_parts[i] for i in order],
+            'y_true_fracture': [dataset[i]['label'] for i in order],
+            'y_pred_fracture': [predicted_fracture[i] for i in order],
+            'errors': errors,
+            'images': len(order),
+            'seconds': seconds,
+            'images_per_sec': len(order) / seconds if seconds else 0.0
+        }
+
+    def _decode_chunk(self, pool: Executor, dataset: List[Dict[str, str]], chunk: range) -> List[Future]:
+        futures = []
+        for i in chunk:
+            path = dataset[i]['image_path']
+            row = self.tensor_cache.row_of(path) if self.tensor_cache is not None else -1
+            if row >= 0:
+                future = Future()
+                future.set_result((self.tensor_cache.images[row].astype(np.float32), None))
+            else:
+                future = pool.submit(_decode, path)
+            futures.append(future)
+        return futures
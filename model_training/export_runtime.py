@@ -0,0 +1,149 @@
+"""
+Convert the Keras models in weights/ to TFLite graphs for CPU inference
+(XNNPACK), optionally quantized, and measure what the conversion costs in
+accuracy on Dataset/test.
+
+    python export_runtime.py                                  # float32 graphs
+    python export_runtime.py --quantization float16 int8      # int8 is calibrated on Dataset/test
+    python export_runtime.py --quantization none int8 --fused --report
+
+Graphs are written to weights/tflite/<model>-<quantization>.tflite. Serve
+them with INFERENCE_RUNTIME=tflite and RUNTIME_QUANTIZATION=<quantization>.
+"""
+import argparse
+import contextlib
+import io
+import os
+from typing import Dict, List
+import numpy as np
+import tensorflow as tf
+from colorama import Fore
+from tabulate import tabulate
+from cascade import build_fused_model, categories_parts
+from dataset_index import DatasetIndex, load_path
+from evaluation import EvaluationEngine
+from image_io import decode_image
+from registry import ModelRegistry, model_files
+from runtimes import exported_path, quantizations
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+default_weights = os.path.join(THIS_FOLDER, 'weights')
+test_dir = os.path.join(THIS_FOLDER, 'Dataset/test')
+
+
+def calibration_images(name: str, split_dir: str = test_dir, count: int = 100, seed: int = 42) -> np.ndarray:
+    """
+    Random sample of the `split_dir` images the model `name` sees in the cascade:
+    every body part for 'Parts' and 'Fused', only its own part for a fracture model.
+    """
+    index = DatasetIndex.load(split_dir)
+    if name in categories_parts:
+        index = index.select(part=name)
+    paths = index.image_paths()
+    images = []
+    for i in np.random.default_rng(seed).permutation(len(paths)):
+        try:
+            images.append(decode_image(paths[i]))
+        except ValueError:
+            # Unreadable files are skipped, as in the evaluation scripts
+            continue
+        if len(images) == count:
+            break
+    if not images:
+        raise ValueError(f"No readable calibration images for '{name}' in {split_dir}")
+    return np.stack(images)
+
+
+def convert(model: tf.keras.Model, quantization: str = 'none', calibration: np.ndarray = None) -> bytes:
+    """
+    TFLite flatbuffer of `model`. Inputs and outputs stay float32 for every
+    quantization, so callers pass the same raw pixels as to the Keras model.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        # Weights and activations in int8, with ranges taken from real images
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([x[np.newaxis]] for x in calibration)
+    # The converter prints the whole exported signature
+    with contextlib.redirect_stdout(io.StringIO()):
+        return converter.convert()
+
+
+def export(weights_dir: str, quantization_modes: List[str], fused: bool = False,
+           split_dir: str = test_dir, calibration_count: int = 100) -> List[str]:
+    # The converter needs the plain Keras models
+    keras_models = ModelRegistry(weights_dir, runtime='keras', compiled=False)
+    names = list(model_files)
+    if fused:
+        keras_models.register('Fused', lambda: build_fused_model(keras_models))
+        names.append('Fused')
+
+    written = []
+    for name in names:
+        for quantization in quantization_modes:
+            calibration = calibration_images(name, split_dir, calibration_count) if quantization == 'int8' else None
+            path = exported_path(weights_dir, name, quantization)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(convert(keras_models[name], quantization, calibration))
+            print(Fore.BLUE + f"{name} ({quantization}): {path} ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+            written.append(path)
+    return written
+
+
+def evaluate(registry: ModelRegistry, dataset: List[Dict[str, str]], batch_size: int) -> Dict[str, float]:
+    from pred_test_metrics import computeMetrics
+
+    engine = EvaluationEngine(lambda name, batch: registry[name].predict(batch, verbose=0), batch_size=batch_size)
+    registry.preload(block=True)
+    result = engine.run(dataset)
+    size = sum(os.path.getsize(registry.model_path(name)) for name in model_files)
+    return dict(computeMetrics(result), images_per_sec=result['images_per_sec'], size_mb=size / 2 ** 20)
+
+
+def accuracy_report(weights_dir: str, quantization_modes: List[str], split_dir: str = test_dir,
+                    batch_size: int = 64) -> None:
+    """
+    Score the Keras models and each exported variant on `split_dir` and print
+    the metric deltas against Keras next to the throughput gained.
+    """
+    dataset = load_path(split_dir)
+    baseline = evaluate(ModelRegistry(weights_dir, runtime='keras'), dataset, batch_size)
+    rows = [('keras', baseline)] + [
+        (f"tflite {quantization}",
+         evaluate(ModelRegistry(weights_dir, runtime='tflite', quantization=quantization), dataset, batch_size))
+        for quantization in quantization_modes
+    ]
+
+    table = [["Runtime", "Part acc", "Δ", "Fracture acc", "Δ", "Fracture F1", "Δ", "Images/sec", "Speedup",
+              "Size MB"]]
+    for label, metrics in rows:
+        table.append([
+            label,
+            f"{metrics['part_Accuracy']:.4f}", f"{metrics['part_Accuracy'] - baseline['part_Accuracy']:+.4f}",
+            f"{metrics['status_Accuracy']:.4f}", f"{metrics['status_Accuracy'] - baseline['status_Accuracy']:+.4f}",
+            f"{metrics['status_F1 Score']:.4f}", f"{metrics['status_F1 Score'] - baseline['status_F1 Score']:+.4f}",
+            f"{metrics['images_per_sec']:.1f}", f"{metrics['images_per_sec'] / baseline['images_per_sec']:.2f}x",
+            f"{metrics['size_mb']:.0f}"
+        ])
+    print(Fore.BLUE + f"\nAccuracy delta on {len(dataset)} test images:")
+    print(tabulate(table, headers="firstrow", tablefmt="grid", disable_numparse=True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=default_weights)
+    parser.add_argument('--quantization', nargs='+', choices=quantizations, default=['none'])
+    parser.add_argument('--test-dir', default=test_dir, help="Images for int8 calibration and the report")
+    parser.add_argument('--fused', action='store_true', help="Also export the fused single-backbone model")
+    parser.add_argument('--calibration', type=int, default=100, help="Images used to calibrate int8")
+    parser.add_argument('--report', action='store_true', help="Compare accuracy and speed with Keras afterwards")
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    export(args.weights, args.quantization, args.fused, args.test_dir, args.calibration)
+    if args.report:
+        accuracy_report(args.weights, args.quantization, args.test_dir, args.batch_size)
@@ -0,0 +1,285 @@
+"""
+Train the dense heads of the four models on cached backbone features.
+
+Every model is an ImageNet ResNet50 that stays frozen, plus a small dense
+head (see training.build_model). The backbone output of an image never
+changes, so it is computed once, stored on disk keyed by a hash of the
+file, and the heads are trained on the stored 2048-value vectors instead
+of on images. Epochs take seconds, which also makes a learning-rate search
+affordable. Only images that are new or changed are sent through the
+backbone on later runs.
+
+    python feature_training.py                      # all four models
+    python feature_training.py --models Hand Elbow --learning-rates 1e-4 3e-4 1e-3
+
+The trained heads are put back on the backbone and saved as
+weights/ResNet50_*.h5, so predictions.py and the backend load them as before.
+"""
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+import tensorflow as tf
+from colorama import Fore
+from tabulate import tabulate
+from dataset_index import DatasetIndex
+from image_io import decode_image, decode_limits, new_buffer, size
+from registry import model_files
+from training import ThroughputCallback, build_model, plot_history, split_data, targets, trainable_models
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+keys_file = 'keys.npy'
+features_file = 'features.npy'
+flipped_file = 'flipped.npy'
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def build_backbone() -> tf.keras.Model:
+    """
+    The frozen ImageNet ResNet50 shared by all four models (see training.build_model).
+    """
+    return tf.keras.applications.ResNet50(input_shape=(size, size, 3), include_top=False, weights='imagenet',
+                                          pooling='avg')
+
+
+def backbone_features(backbone: tf.keras.Model, batch: np.ndarray) -> np.ndarray:
+    # preprocess_input works in place on numpy arrays, so it gets a copy
+    x = tf.keras.applications.resnet50.preprocess_input(np.array(batch, dtype=np.float32))
+    return backbone.predict(x, verbose=0).astype(np.float16)
+
+
+class FeatureCache:
+    """
+    Backbone features of images, keyed by the SHA-1 of the image file.
+
+    `features` holds one float16 row per key, and `flipped` the features of
+    the horizontally flipped image, used as augmentation. The cache folder is
+    specific to the decoder settings, since reduced-resolution decoding (see
+    image_io.DecodeLimits) changes the pixels the backbone sees.
+
+    The hash of each path is remembered with the file's size and
+    modification time, so repeated `update` calls in one run only hash
+    files that are new or have changed.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        if os.path.exists(os.path.join(cache_dir, keys_file)):
+            self.keys = np.load(os.path.join(cache_dir, keys_file))
+            self.features = np.load(os.path.join(cache_dir, features_file), mmap_mode='r')
+            self.flipped = np.load(os.path.join(cache_dir, flipped_file), mmap_mode='r')
+        else:
+            self.keys = np.array([], dtype=str)
+            self.features = self.flipped = np.zeros((0, 0), dtype=np.float16)
+        self._rows = {key: i for i, key in enumerate(self.keys.tolist())}
+        self._hashes: Dict[str, Tuple[Tuple[int, int], str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def update(self, paths: List[str], backbone: tf.keras.Model = None, batch_size: int = 64,
+               workers: int = None) -> np.ndarray:
+        """
+        Make sure every image in `paths` has features, running only the
+        missing ones through the backbone, and return the row of each path.
+        Files that fail to decode get row -1.
+        """
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            keys = list(pool.map(self._key, paths))
+            missing = sorted({key: path for key, path in zip(keys, paths) if key not in self._rows}.items())
+            if missing:
+                backbone = backbone or build_backbone()
+                self._extract(missing, backbone, batch_size, pool)
+        return np.array([self._rows.get(key, -1) for key in keys])
+
+    def _key(self, path: str) -> str:
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        known = self._hashes.get(path)
+        if known is None or known[0] != stamp:
+            known = self._hashes[path] = (stamp, file_hash(path))
+        return known[1]
+
+    def _extract(self, missing: List[Tuple[str, str]], backbone: tf.keras.Model, batch_size: int,
+                 pool: ThreadPoolExecutor) -> None:
+        start = time.perf_counter()
+        new_keys, new_features, new_flipped = [], [], []
+
+        def decode(item: Tuple[int, np.ndarray, str]) -> bool:
+            i, batch, path = item
+            try:
+                decode_image(path, out=batch[i])
+                return True
+            except ValueError as e:
+                print(Fore.RED + f"Skipping {path}: {e}")
+                return False
+
+        for chunk_start in range(0, len(missing), batch_size):
+            chunk = missing[chunk_start:chunk_start + batch_size]
+            batch = new_buffer(len(chunk))
+            ok = np.array(list(pool.map(decode, [(i, batch, path) for i, (_, path) in enumerate(chunk)])))
+            if not ok.any():
+                continue
+            batch = batch[ok]
+            new_keys.extend(key for (key, _), good in zip(chunk, ok) if good)
+            new_features.append(backbone_features(backbone, batch))
+            new_flipped.append(backbone_features(backbone, batch[:, :, ::-1]))
+            print(f"\rExtracted {chunk_start + len(chunk)}/{len(missing)} images", end='')
+        print()
+        if not new_keys:
+            return
+
+        self._save(np.concatenate([self.keys, np.array(new_keys, dtype=str)]),
+                   np.concatenate([np.asarray(self.features).reshape(-1, new_features[0].shape[1])]
+                                  + new_features),
+                   np.concatenate([np.asarray(self.flipped).reshape(-1, new_flipped[0].shape[1])]
+                                  + new_flipped))
+        print(Fore.BLUE + f"Cached features of {len(new_keys)} images in {time.perf_counter() - start:.1f}s"
+              + Fore.RESET)
+
+    def _save(self, keys: np.ndarray, features: np.ndarray, flipped: np.ndarray) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # The features are written first, so a crash never leaves keys pointing past their rows
+        for name, values in ((features_file, features), (flipped_file, flipped), (keys_file, keys)):
+            tmp_path = os.path.join(self.cache_dir, name + '.tmp.npy')
+            np.save(tmp_path, values)
+            os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        self.keys = keys
+        self.features = np.load(os.path.join(self.cache_dir, features_file), mmap_mode='r')
+        self.flipped = np.load(os.path.join(self.cache_dir, flipped_file), mmap_mode='r')
+        self._rows = {key: i for i, key in enumerate(keys.tolist())}
+
+
+def default_cache_dir() -> str:
+    decode_mode = 'reduced' if decode_limits.reduced else 'full'
+    return os.path.join(THIS_FOLDER, 'cache', 'features', f"resnet50-imagenet-{decode_mode}")
+
+
+def build_head(n_classes: int, n_features: int) -> tf.keras.Model:
+    """
+    The dense head of training.build_model on its own, taking backbone features.
+    """
+    inputs = tf.keras.Input((n_features,))
+    x = tf.keras.layers.Dense(128, activation='relu')(inputs)
+    x = tf.keras.layers.Dense(50, activation='relu')(x)
+    outputs = tf.keras.layers.Dense(n_classes, activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def export_model(head: tf.keras.Model, n_classes: int) -> tf.keras.Model:
+    """
+    Full image model with the trained head, the same graph the notebooks saved.
+    """
+    model = build_model(n_classes)
+    for source, target in zip(head.layers[-3:], model.layers[-3:]):
+        target.set_weights(source.get_weights())
+    return model
+
+
+def feature_dataset(features: np.ndarray, flipped: np.ndarray, rows: np.ndarray, y: np.ndarray, n_classes: int,
+                    batch_size: int, training: bool, seed: int) -> tf.data.Dataset:
+    one_hot = np.eye(n_classes, dtype=np.float32)[y]
+    x = np.asarray(features[rows], dtype=np.float32)
+    if training:
+        # The flipped image of every training image, as ImageDataGenerator(horizontal_flip=True) did
+        x = np.concatenate([x, np.asarray(flipped[rows], dtype=np.float32)])
+        one_hot = np.concatenate([one_hot, one_hot])
+    dataset = tf.data.Dataset.from_tensor_slices((x, one_hot))
+    if training:
+        dataset = dataset.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def train_head(name: str, data: DatasetIndex, cache: FeatureCache, weights_dir: str, plots_dir: str = None,
+               learning_rates: List[float] = (1e-4,), epochs: int = 100, batch_size: int = 64,
+               patience: int = 5, seed: int = 42) -> Dict[str, object]:
+    """
+    Train the head of model `name` on cached features once per learning
+    rate, keep the one with the lowest validation loss, and save it with the
+    backbone to `weights_dir`.
+    """
+    splits = {}
+    for split, subset in zip(('train', 'val', 'test'), split_data(data, name)):
+        rows = cache.update(subset.image_paths())
+        y, n_classes = targets(subset, name)
+        splits[split] = (rows[rows >= 0], y[rows >= 0])
+
+    def dataset(split: str, training: bool = False) -> tf.data.Dataset:
+        rows, y = splits[split]
+        return feature_dataset(cache.features, cache.flipped, rows, y, n_classes, batch_size, training, seed)
+
+    print(Fore.YELLOW + f"-------Training {name} head ({len(splits['train'][0])} train, {len(splits['val'][0])} "
+                        f"validation, {len(splits['test'][0])} test images)-------" + Fore.RESET)
+    best = None
+    for learning_rate in learning_rates:
+        tf.keras.utils.set_random_seed(seed)
+        head = build_head(n_classes, cache.features.shape[1])
+        head.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                     loss='categorical_crossentropy', metrics=['accuracy'])
+        throughput = ThroughputCallback(batch_size, 2 * len(splits['train'][0]), every=0, verbose=False)
+        history = head.fit(dataset('train', training=True), validation_data=dataset('val'), epochs=epochs,
+                           verbose=0, callbacks=[
+                               tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience,
+                                                                restore_best_weights=True),
+                               throughput])
+        val_loss = min(history.history['val_loss'])
+        print(f"learning rate {learning_rate:g}: val_loss {val_loss:.4f} after {len(history.history['loss'])} "
+              f"epochs, {np.mean(throughput.history):.0f} samples/sec")
+        if best is None or val_loss < best['val_loss']:
+            best = {'learning_rate': learning_rate, 'val_loss': val_loss, 'head': head, 'history': history.history,
+                    'samples_per_sec': float(np.mean(throughput.history))}
+
+    loss, accuracy = best['head'].evaluate(dataset('test'), verbose=0)
+    print(Fore.BLUE + f"{name} test accuracy: {np.round(accuracy * 100, 2)}% "
+                      f"(learning rate {best['learning_rate']:g})" + Fore.RESET)
+
+    os.makedirs(weights_dir, exist_ok=True)
+    export_model(best['head'], n_classes).save(os.path.join(weights_dir, model_files[name]))
+    if plots_dir is not None:
+        plot_history(best['history'], os.path.join(plots_dir, 'BodyParts' if name == 'Parts'
+                                                   else os.path.join('FractureDetection', name)))
+
+    return {
+        'learning_rate': best['learning_rate'],
+        'test_loss': loss,
+        'test_accuracy': accuracy,
+        'epochs': len(best['history']['loss']),
+        'samples_per_sec': best['samples_per_sec']
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=os.path.join(THIS_FOLDER, 'Dataset'))
+    parser.add_argument('--weights', default=os.path.join(THIS_FOLDER, 'weights'))
+    parser.add_argument('--plots', default=os.path.join(THIS_FOLDER, 'plots'))
+    parser.add_argument('--cache', default=None, help="Feature cache folder (default: cache/features/...)")
+    parser.add_argument('--models', nargs='+', default=trainable_models, choices=trainable_models)
+    parser.add_argument('--learning-rates', type=float, nargs='+', default=[1e-4, 3e-4, 1e-3])
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    data = DatasetIndex.load(args.dataset)
+    cache = FeatureCache(args.cache or default_cache_dir())
+    # Extract every image in one go, so each model below only reads the cache
+    cache.update(data.image_paths(), batch_size=args.batch_size)
+
+    summary = [["Model", "Learning rate", "Epochs", "Test accuracy", "Samples/sec"]]
+    for name in args.models:
+        result = train_head(name, data, cache, args.weights, args.plots, args.learning_rates, args.epochs,
+                            args.batch_size, seed=args.seed)
+        summary.append([name, f"{result['learning_rate']:g}", result['epochs'],
+                        f"{result['test_accuracy'] * 100:.2f}%", f"{result['samples_per_sec']:.0f}"])
+
+    print(Fore.BLUE + "\nTraining summary:")
+    print(tabulate(summary, headers="firstrow", tablefmt="grid", disable_numparse=True))
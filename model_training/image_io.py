@@ -0,0 +1,216 @@
+import io
+import os
+import threading
+import time
+import numpy as np
+from PIL import Image, UnidentifiedImageError
+from typing import BinaryIO, Callable, Dict, List, Union
+
+size = 224
+
+ImageSource = Union[str, bytes, bytearray, memoryview, BinaryIO]
+
+
+class DecodeLimits:
+    """
+    What `decode_image` accepts and how it decodes.
+
+    Images larger than `max_pixels` (declared in the header, so nothing is
+    decoded) or files larger than `max_bytes` are rejected with a ValueError.
+    With `reduced`, JPEGs are decoded by DCT scaling straight to the smallest
+    size that still covers 224x224, instead of at full resolution. This gives
+    slightly different pixels than a full decode and a nearest-neighbour
+    resize, which the models were not trained on, so it is off by default
+    until its effect on accuracy has been measured (pred_test_metrics.py
+    with REDUCED_DECODE=1 and 0).
+    """
+
+    def __init__(self, max_pixels: int = None, max_bytes: int = None, reduced: bool = False):
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.reduced = reduced
+
+
+def decode_limits_from_env() -> DecodeLimits:
+    """
+    Limits from DECODE_MAX_MEGAPIXELS (default 100), DECODE_MAX_MB (default 50)
+    and REDUCED_DECODE (1/0, default 0); a limit of 0 disables it.
+    """
+    max_megapixels = float(os.environ.get('DECODE_MAX_MEGAPIXELS', 100))
+    max_mb = float(os.environ.get('DECODE_MAX_MB', 50))
+    return DecodeLimits(
+        max_pixels=int(max_megapixels * 1e6) or None,
+        max_bytes=int(max_mb * 2 ** 20) or None,
+        reduced=os.environ.get('REDUCED_DECODE', '0') == '1'
+    )
+
+
+# Shared by every caller of decode_image
+decode_limits = decode_limits_from_env()
+
+
+class DecodeStats:
+    """
+    Decode count, time and pixels per image format. `listeners` are called
+    with (format, seconds) after every decode, e.g. to feed a metrics histogram.
+    """
+
+    def __init__(self):
+        self.listeners: List[Callable[[str, float], None]] = []
+        self._formats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, image_format: str, seconds: float, source_pixels: int, reduced: bool) -> None:
+        with self._lock:
+            stats = self._formats.setdefault(image_format, {'count': 0, 'seconds': 0.0, 'reduced': 0,
+                                                            'source_megapixels': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['reduced'] += int(reduced)
+            stats['source_megapixels'] += source_pixels / 1e6
+        for listener in self.listeners:
+            listener(image_format, seconds)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {image_format: dict(values, avg_ms=values['seconds'] / values['count'] * 1000)
+                    for image_format, values in self._formats.items()}
+
+
+decode_stats = DecodeStats()
+
+
+def new_buffer(batch_size: int = None) -> np.ndarray:
+    """
+    Allocate a float32 buffer for one image, or a batch of images, ready to be filled by `decode_image`.
+    """
+    shape = (size, size, 3) if batch_size is None else (batch_size, size, size, 3)
+    return np.empty(shape, dtype=np.float32)
+
+
+def decode_image(source: ImageSource, out: np.ndarray = None, limits: DecodeLimits = None) -> np.ndarray:
+    """
+    Decode an image straight into a (224, 224, 3) float32 array.
+
+    `source` may be a file path, raw bytes or a binary stream such as an
+    uploaded file, so uploads never have to touch the disk. The pixels are
+    written into `out` when given (e.g. one row of a batch from `new_buffer`,
+    or a uint8 row of a memory-mapped tensor cache) without an intermediate
+    float copy.
+
+    The result matches `keras.preprocessing.image.load_img(..., target_size=(224, 224))`
+    followed by `img_to_array`: RGB conversion and a nearest-neighbour resize.
+    The one exception is JPEGs decoded at reduced resolution (see
+    `DecodeLimits`), which skip most of the work on multi-megapixel files.
+    Any format PIL can decode is accepted, as `load_img` did (GIF, BMP, TIFF,
+    ...). Formats other than JPEG have no scaled decode, so they are resized
+    before the RGB conversion, which gives the same pixels without a
+    full-size RGB copy.
+
+    Files over the `limits` (default: `decode_limits`, read from the
+    environment) raise a ValueError, as do unsupported or corrupt files.
+    """
+    if out is None:
+        out = new_buffer()
+    elif out.shape != (size, size, 3):
+        raise ValueError(f"Output buffer must have shape ({size}, {size}, 3)")
+    limits = limits or decode_limits
+
+    start = time.perf_counter()
+    try:
+        with _open(source, limits.max_bytes) as img:
+            image_format = img.format
+            width, height = img.size
+            if limits.max_pixels and width * height > limits.max_pixels:
+                raise ValueError(f"Image is {width}x{height}, over the limit of {limits.max_pixels} pixels")
+            reduced = False
+            if limits.reduced and image_format == 'JPEG' and min(width, height) >= 2 * size:
+                # DCT scaling by 1/2, 1/4 or 1/8, keeping both sides at least 224
+                img.draft('RGB', (size, size))
+                reduced = img.size != (width, height)
+            # Nearest-neighbour picks pixels, so resizing before the conversion gives the same result
+            if img.size != (size, size):
+                img = img.resize((size, size), Image.NEAREST)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            np.copyto(out, np.asarray(img), casting='unsafe')
+    except UnidentifiedImageError:
+        raise ValueError("Cannot decode image: unsupported or corrupt file")
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Cannot decode image: {e}")
+    except (OSError, EOFError) as e:
+        # EOFError: truncated GIF and other frame-based formats
+        raise ValueError(f"Cannot decode image: {e}")
+
+    decode_stats.record(image_format, time.perf_counter() - start, width * height, reduced)
+    return out
+
+
+def _open(source: ImageSource, max_bytes: int = None) -> Image.Image:
+    if isinstance(source, (str, os.PathLike)):
+        _check_bytes(os.path.getsize(source), max_bytes)
+        return Image.open(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        _check_bytes(len(source), max_bytes)
+        return Image.open(io.BytesIO(source))
+    # Upload streams are not always seekable, which PIL needs to sniff the format
+    if not (hasattr(source, 'seekable') and source.seekable()):
+        # Read one byte past the limit to tell an oversized stream apart without reading all of it
+        data = source.read(max_bytes + 1) if max_bytes else source.read()
+        _check_bytes(len(data), max_bytes)
+        source = io.BytesIO(data)
+    elif max_bytes:
+        position = source.tell()
+        source.seek(0, io.SEEK_END)
+        _check_bytes(source.tell() - position, max_bytes)
+        source.seek(position)
+    return Image.open(source)
+
+
+def _check_bytes(n_bytes: int, max_bytes: int = None) -> None:
+    if max_bytes and n_bytes > max_bytes:
+        raise ValueError(f"Image file is over the limit of {max_bytes / 2 ** 20:g} MB")
+
+
+if __name__ == '__main__':
+    import argparse
+    from colorama import Fore
+    from tabulate import tabulate
+
+    THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Decode time per format, at full and at reduced resolution")
+    parser.add_argument('folder', nargs='?', default=os.path.join(THIS_FOLDER, 'test'))
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    # Read the files once so only decoding is timed
+    files = []
+    for root, _, names in os.walk(args.folder):
+        for name in sorted(names):
+            with open(os.path.join(root, name), 'rb') as f:
+                files.append(f.read())
+
+    results = {}
+    for mode, reduced in (('full', False), ('reduced', True)):
+        decode_stats = DecodeStats()
+        limits = DecodeLimits(decode_limits.max_pixels, decode_limits.max_bytes, reduced)
+        for _ in range(args.repeats):
+            for data in files:
+                try:
+                    decode_image(data, limits=limits)
+                except ValueError as e:
+                    print(Fore.RED + f"Skipping a file: {e}")
+        results[mode] = decode_stats.stats()
+
+    table = [["Format", "Images", "Avg source MP", "Full ms", "Reduced ms", "Reduced share", "Speedup"]]
+    for image_format, full in sorted(results['full'].items()):
+        reduced = results['reduced'][image_format]
+        table.append([
+            image_format, full['count'] // args.repeats,
+            f"{full['source_megapixels'] / full['count']:.2f}",
+            f"{full['avg_ms']:.2f}", f"{reduced['avg_ms']:.2f}",
+            f"{reduced['reduced'] / reduced['count'] * 100:.0f}%",
+            f"{full['avg_ms'] / reduced['avg_ms']:.2f}x"
+        ])
+    print(Fore.BLUE + f"\nDecode time per image to {size}x{size} ({args.repeats} passes over {args.folder}):")
+    print(tabulate(table, headers="firstrow", tablefmt="grid", disable_numparse=True))
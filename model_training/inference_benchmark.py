@@ -0,0 +1,71 @@
+"""
+Per-call overhead of the ways a model can be run: `Model.predict` (the
+previous path), a direct eager call, and the pre-warmed compiled function
+of runtimes.CompiledModel. The overhead column is the time above the
+compiled call at the same batch size.
+
+    python inference_benchmark.py --model Parts --batch-sizes 1 4 16 --calls 20
+"""
+import argparse
+import os
+import time
+from typing import Callable, Dict, List
+import numpy as np
+import tensorflow as tf
+from colorama import Fore
+from tabulate import tabulate
+from registry import ModelRegistry, model_files
+from runtimes import CompiledModel
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_calls(fn: Callable[[], object], calls: int) -> float:
+    """
+    Median milliseconds of `calls` calls to `fn`, after one untimed call.
+    """
+    fn()
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def benchmark(model: tf.keras.Model, batch_sizes: List[int], calls: int) -> List[Dict[str, float]]:
+    compiled = CompiledModel(model, warmup_batch_sizes=batch_sizes)
+    rows = []
+    for batch_size in batch_sizes:
+        x = np.random.default_rng(0).uniform(0, 255, (batch_size,) + compiled.input_shape[1:]).astype(np.float32)
+        rows.append({
+            'batch_size': batch_size,
+            'predict_ms': time_calls(lambda: model.predict(x, verbose=0), calls),
+            'eager_call_ms': time_calls(lambda: model(x, training=False).numpy(), calls),
+            'compiled_ms': time_calls(lambda: compiled.predict(x), calls),
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--weights', default=os.path.join(THIS_FOLDER, 'weights'))
+    parser.add_argument('--model', default='Parts', choices=list(model_files))
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--calls', type=int, default=20)
+    args = parser.parse_args()
+
+    model = ModelRegistry(args.weights, runtime='keras', compiled=False)[args.model]
+    table = [["Batch", "model.predict ms", "Eager call ms", "Compiled ms", "predict overhead ms", "Speedup"]]
+    for row in benchmark(model, args.batch_sizes, args.calls):
+        table.append([
+            row['batch_size'],
+            f"{row['predict_ms']:.1f}",
+            f"{row['eager_call_ms']:.1f}",
+            f"{row['compiled_ms']:.1f}",
+            f"{row['predict_ms'] - row['compiled_ms']:.1f}",
+            f"{row['predict_ms'] / row['compiled_ms']:.2f}x"
+        ])
+
+    print(Fore.BLUE + f"\nPer-call latency of {args.model} (median of {args.calls} calls):")
+    print(tabulate(table, headers="firstrow", tablefmt="grid", disable_numparse=True))
@@ -1,80 +1,77 @@
 import os
+import argparse
 from colorama import Fore
-from predictions import predict
+from predictions import model_dict, predict_proba
+from evaluation import EvaluationEngine
+from tensor_cache import build_tensor_cache, cache_dir_for
 from typing import List, Dict
+from dataset_index import load_path
 from tqdm import tqdm
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix
 from tabulate import tabulate
 
-def load_path(path: str) -> List[Dict[str, str]]:
-    """
-    Load X-ray dataset from the given directory structure.
-    """
-    dataset = []
-    for body in os.listdir(path):
-        body_part = body
-        body_path = os.path.join(path, body)
-        for patient_id in os.listdir(body_path):
-            patient_path = os.path.join(body_path, patient_id)
-            for label_folder in os.listdir(patient_path):
-                label = 'fractured' if label_folder.endswith('positive') else 'normal'
-                label_path = os.path.join(patient_path, label_folder)
-                for img in os.listdir(label_path):
-                    img_path = os.path.join(label_path, img)
-                    dataset.append({
-                            'body_part': body_part,
-                            'label': label,
-                            'image_path': img_path,
-                            'image_name': img
-                        })
-    return dataset
-
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
 
-def reportPredict(dataset: List[Dict[str, str]]) -> None:
-    y_true_parts = []
-    y_pred_parts = []
-    y_true_fracture = []
-    y_pred_fracture = []
+metric_names = ["Accuracy", "Precision", "Recall", "F1 Score"]
 
-    for img in tqdm(dataset, desc="Processing images"):
-        try:
-            body_part_predict = predict(img['image_path'], verbose=0)
-            fracture_predict = predict(img['image_path'], body_part_predict, verbose=0)
-        except Exception as e:
-            print(Fore.RED + f"Error predicting image {img['image_name']}: {e}")
-            continue
+def computeMetrics(result: Dict[str, object]) -> Dict[str, float]:
+    """
+    Body part and fracture status metrics of an `EvaluationEngine.run` result,
+    keyed 'part_<metric>' and 'status_<metric>'.
+    """
+    y_true_parts = result['y_true_parts']
+    y_pred_parts = result['y_pred_parts']
+    y_true_fracture = result['y_true_fracture']
+    y_pred_fracture = result['y_pred_fracture']
+
+    return {
+        # Metrics for body parts
+        'part_Accuracy': accuracy_score(y_true_parts, y_pred_parts),
+        'part_Precision': precision_score(y_true_parts, y_pred_parts, average='weighted'),
+        'part_Recall': recall_score(y_true_parts, y_pred_parts, average='weighted'),
+        'part_F1 Score': f1_score(y_true_parts, y_pred_parts, average='weighted'),
+        # Metrics for fracture status
+        'status_Accuracy': accuracy_score(y_true_fracture, y_pred_fracture),
+        'status_Precision': precision_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured'),
+        'status_Recall': recall_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured'),
+        'status_F1 Score': f1_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured')
+    }
 
-        y_true_parts.append(img['body_part'])
-        y_pred_parts.append(body_part_predict)
-        y_true_fracture.append(img['label'])
-        y_pred_fracture.append(fracture_predict)
+def reportPredict(dataset: List[Dict[str, str]], batch_size: int = 64, decode_workers: int = None,
+                  use_processes: bool = False, tensor_cache=None) -> None:
+    engine = EvaluationEngine(lambda model, images: predict_proba(images, model),
+                              batch_size=batch_size, decode_workers=decode_workers, use_processes=use_processes,
+                              tensor_cache=tensor_cache)
+    model_dict.preload(block=True)  # keep model loading out of the images/sec figure
+    with tqdm(total=len(dataset), desc="Processing images") as progress:
+        result = engine.run(dataset, progress)
 
-    # Calculate metrics for body parts
-    part_accuracy = accuracy_score(y_true_parts, y_pred_parts)
-    part_precision = precision_score(y_true_parts, y_pred_parts, average='weighted')
-    part_recall = recall_score(y_true_parts, y_pred_parts, average='weighted')
-    part_f1 = f1_score(y_true_parts, y_pred_parts, average='weighted')
+    for image_path, error in result['errors']:
+        print(Fore.RED + f"Error predicting image {os.path.basename(image_path)}: {error}")
 
-    # Calculate metrics for fracture status
-    status_accuracy = accuracy_score(y_true_fracture, y_pred_fracture)
-    status_precision = precision_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured')
-    status_recall = recall_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured')
-    status_f1 = f1_score(y_true_fracture, y_pred_fracture, average='binary', pos_label='fractured')
+    metrics = computeMetrics(result)
 
     # Display metrics in tabular form
-    table = [
-        ["Metric", "Body Part", "Fracture Status"],
-        ["Accuracy", f"{part_accuracy:.2f}", f"{status_accuracy:.2f}"],
-        ["Precision", f"{part_precision:.2f}", f"{status_precision:.2f}"],
-        ["Recall", f"{part_recall:.2f}", f"{status_recall:.2f}"],
-        ["F1 Score", f"{part_f1:.2f}", f"{status_f1:.2f}"]
-    ]
+    table = [["Metric", "Body Part", "Fracture Status"]]
+    for metric in metric_names:
+        table.append([metric, f"{metrics['part_' + metric]:.2f}", f"{metrics['status_' + metric]:.2f}"])
 
     print(Fore.BLUE + "\nClassification Report:")
     print(tabulate(table, headers="firstrow", tablefmt="grid"))
+    print(Fore.BLUE + f"Processed {result['images']} images in {result['seconds']:.1f}s "
+                      f"({result['images_per_sec']:.1f} images/sec)")
 
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 test_dir = os.path.join(THIS_FOLDER, 'Dataset/test')
-reportPredict(load_path(test_dir))
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score the models on Dataset/test")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=None, help="Decode workers (default: CPU count)")
+    parser.add_argument('--processes', action='store_true', help="Decode in processes instead of threads")
+    parser.add_argument('--tensor-cache', action='store_true',
+                        help="Read pre-decoded images from the memory-mapped cache, updating it first")
+    args = parser.parse_args()
+    cache = build_tensor_cache(test_dir, cache_dir_for(test_dir), args.workers) if args.tensor_cache else None
+    reportPredict(load_path(test_dir), args.batch_size, args.workers, args.processes, cache)
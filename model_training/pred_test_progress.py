@@ -1,59 +1,50 @@
 import os
+import argparse
 from colorama import Fore
-from predictions import predict
+from predictions import model_dict, predict_proba
+from evaluation import EvaluationEngine
+from tensor_cache import build_tensor_cache, cache_dir_for
 from typing import List, Dict
+from dataset_index import load_path
 from tqdm import tqdm
 
-def load_path(path: str) -> List[Dict[str, str]]:
-    """
-    Load X-ray dataset from the given directory structure.
-    """
-    dataset = []
-    for body in os.listdir(path):
-        body_part = body
-        body_path = os.path.join(path, body)
-        for patient_id in os.listdir(body_path):
-            patient_path = os.path.join(body_path, patient_id)
-            for label_folder in os.listdir(patient_path):
-                label = 'fractured' if label_folder.endswith('positive') else 'normal'
-                label_path = os.path.join(patient_path, label_folder)
-                for img in os.listdir(label_path):
-                    img_path = os.path.join(label_path, img)
-                    dataset.append({
-                            'body_part': body_part,
-                            'label': label,
-                            'image_path': img_path,
-                            'image_name': img
-                        })
-    return dataset
-
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
 
-def reportPredict(dataset: List[Dict[str, str]]) -> None:
+def reportPredict(dataset: List[Dict[str, str]], batch_size: int = 64, decode_workers: int = None,
+                  use_processes: bool = False, tensor_cache=None) -> None:
     total_count = len(dataset)
-    part_count = 0
-    status_count = 0
-
-    for img in tqdm(dataset, desc="Processing images"):
-        try:
-            body_part_predict = predict(img['image_path'], verbose=0)
-            fracture_predict = predict(img['image_path'], body_part_predict, verbose=0)
-        except Exception as e:
-            print(Fore.RED + f"Error predicting image {img['image_name']}: {e}")
-            continue
-
-        if img['body_part'] == body_part_predict:
-            part_count += 1
-        if img['label'] == fracture_predict:
-            status_count += 1
+    engine = EvaluationEngine(lambda model, images: predict_proba(images, model),
+                              batch_size=batch_size, decode_workers=decode_workers, use_processes=use_processes,
+                              tensor_cache=tensor_cache)
+    model_dict.preload(block=True)  # keep model loading out of the images/sec figure
+    with tqdm(total=total_count, desc="Processing images") as progress:
+        result = engine.run(dataset, progress)
+
+    for image_path, error in result['errors']:
+        print(Fore.RED + f"Error predicting image {os.path.basename(image_path)}: {error}")
+
+    part_count = sum(t == p for t, p in zip(result['y_true_parts'], result['y_pred_parts']))
+    status_count = sum(t == p for t, p in zip(result['y_true_fracture'], result['y_pred_fracture']))
 
     part_acc = (part_count / total_count) * 100 if total_count else 0
     status_acc = (status_count / total_count) * 100 if total_count else 0
 
     print(Fore.BLUE + f"\nPart accuracy: {part_acc:.2f}%")
     print(Fore.BLUE + f"Status accuracy: {status_acc:.2f}%")
+    print(Fore.BLUE + f"Processed {result['images']} images in {result['seconds']:.1f}s "
+                      f"({result['images_per_sec']:.1f} images/sec)")
 
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 test_dir = os.path.join(THIS_FOLDER, 'Dataset/test')
-reportPredict(load_path(test_dir))
\ No newline at end of file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report model accuracy on Dataset/test")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=None, help="Decode workers (default: CPU count)")
+    parser.add_argument('--processes', action='store_true', help="Decode in processes instead of threads")
+    parser.add_argument('--tensor-cache', action='store_true',
+                        help="Read pre-decoded images from the memory-mapped cache, updating it first")
+    args = parser.parse_args()
+    cache = build_tensor_cache(test_dir, cache_dir_for(test_dir), args.workers) if args.tensor_cache else None
+    reportPredict(load_path(test_dir), args.batch_size, args.workers, args.processes, cache)
@@ -0,0 +1,170 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+import numpy as np
+
+
+def image_key(x: np.ndarray) -> str:
+    """
+    Content address of a decoded image. Re-encoded or renamed copies of the
+    same radiograph map to the same key as long as the pixels match.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(x).tobytes(), digest_size=16).hexdigest()
+
+
+class PredictionCache:
+    """
+    LRU cache of model outputs keyed by image content.
+
+    Each entry holds the probability rows of every model that has seen the
+    image ('Parts', 'Elbow', ...), so one upload's body part and fracture
+    results are evicted together. Entries older than `ttl` seconds are
+    treated as misses. With `disk_path` set, results are also written to a
+    SQLite file that survives restarts and backs memory misses. The file
+    keeps at most about `max_disk_entries` results: expired rows and the
+    least recently used ones are deleted when it is opened and every
+    `prune_every` writes.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = None, disk_path: str = None,
+                 max_disk_entries: int = 100000, prune_every: int = 256):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.prune_every = prune_every
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        self.disk_evictions = 0
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            # WAL lets the server workers sharing the file read while one of them writes
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions (key TEXT, model TEXT, probs BLOB, "
+                             "created REAL, last_used REAL, PRIMARY KEY (key, model))")
+            # Files written before rows tracked their last use
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(predictions)")]
+            if 'last_used' not in columns:
+                self._db.execute("ALTER TABLE predictions ADD COLUMN last_used REAL")
+                self._db.execute("UPDATE predictions SET last_used = created")
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+            self._db.commit()
+            self.disk_evictions += self._prune()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self._db is not None
+
+    def get(self, key: str, model: str) -> Optional[np.ndarray]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, outputs = entry
+                if self._expired(created, now):
+                    del self._entries[key]
+                elif model in outputs:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return outputs[model]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT probs, created FROM predictions WHERE key = ? AND model = ?",
+                                       (key, model)).fetchone()
+                if row is not None and not self._expired(row[1], now):
+                    probs = np.frombuffer(row[0], dtype=np.float32)
+                    self._db.execute("UPDATE predictions SET last_used = ? WHERE key = ? AND model = ?",
+                                     (now, key, model))
+                    self._db.commit()
+                    self._remember(key, model, probs, row[1])
+                    self.disk_hits += 1
+                    return probs
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, model: str, probs: np.ndarray) -> None:
+        probs = np.asarray(probs, dtype=np.float32)
+        now = time.time()
+        with self._lock:
+            self._remember(key, model, probs, now)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO predictions (key, model, probs, created, last_used) "
+                                 "VALUES (?, ?, ?, ?, ?)", (key, model, probs.tobytes(), now, now))
+                self._db.commit()
+                self._writes += 1
+                if self._writes % self.prune_every == 0:
+                    self.disk_evictions += self._prune()
+
+    def get_or_compute(self, key: str, model: str, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the cached probabilities of `model` for `key`, calling `compute` on a miss.
+        """
+        if not self.enabled:
+            return compute()
+        probs = self.get(key, model)
+        if probs is None:
+            probs = np.asarray(compute(), dtype=np.float32)
+            self.put(key, model, probs)
+        return probs
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_evictions': self.disk_evictions,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def _prune(self) -> int:
+        # Caller holds the lock (or is the constructor); returns how many rows were deleted
+        deleted = 0
+        if self.ttl is not None:
+            deleted += self._db.execute("DELETE FROM predictions WHERE created < ?",
+                                        (time.time() - self.ttl,)).rowcount
+        excess = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.max_disk_entries
+        if excess > 0:
+            deleted += self._db.execute("DELETE FROM predictions WHERE rowid IN "
+                                        "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)",
+                                        (excess,)).rowcount
+        self._db.commit()
+        return deleted
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key: str, model: str, probs: np.ndarray, created: float) -> None:
+        # Caller holds the lock
+        if self.max_entries <= 0:
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (created, {})
+            self._entries[key] = entry
+        entry[1][model] = probs
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -2,29 +2,7 @@ import os
 from colorama import Fore
 from predictions import predict
 from typing import List, Dict
-
-def load_path(path: str) -> List[Dict[str, str]]:
-    dataset = []
-    try:
-        for body in os.listdir(path):
-            body_part = body
-            path_p = os.path.join(path, body)
-            for lab in os.listdir(path_p):
-                label = lab
-                path_l = os.path.join(path_p, lab)
-                for img in os.listdir(path_l):
-                    img_path = os.path.join(path_l, img)
-                    dataset.append(
-                        {
-                            'body_part': body_part,
-                            'label': label,
-                            'image_path': img_path,
-                            'image_name': img
-                        }
-                    )
-    except Exception as e:
-        print(Fore.RED + f"Error loading path: {e}")
-    return dataset
+from dataset_index import load_path
 
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
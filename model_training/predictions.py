@@ -1,52 +1,56 @@
+import os
 import numpy as np
-import tensorflow as tf
-from keras.preprocessing import image
 from typing import Union
+from image_io import ImageSource, decode_image, size
+from prediction_cache import PredictionCache, image_key
+from registry import registry_from_env
 
-# Load the models when importing "predictions.py"
-try:
-    model_elbow_frac = tf.keras.models.load_model("weights/ResNet50_Elbow_frac.h5")
-    model_hand_frac = tf.keras.models.load_model("weights/ResNet50_Hand_frac.h5")
-    model_shoulder_frac = tf.keras.models.load_model("weights/ResNet50_Shoulder_frac.h5")
-    model_parts = tf.keras.models.load_model("weights/ResNet50_BodyParts.h5")
-except Exception as e:
-    raise RuntimeError(f"Error loading models: {e}")
+# Models are loaded through the shared registry (lazily by default, see MODEL_LOAD_MODE)
+model_dict = registry_from_env("weights")
 
 # Categories for each result by index
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
 
-# Dictionary for model selection
-model_dict = {
-    'Parts': model_parts,
-    'Elbow': model_elbow_frac,
-    'Hand': model_hand_frac,
-    'Shoulder': model_shoulder_frac
-}
-
-def predict(img: Union[str, np.ndarray], model: str = "Parts", verbose: int = 0) -> str:
-    size = 224
+# Results keyed by image content; set PREDICTION_CACHE_PATH to keep them between runs
+prediction_cache = PredictionCache(
+    max_entries=int(os.environ.get('PREDICTION_CACHE_SIZE', 1024)),
+    ttl=float(os.environ['PREDICTION_CACHE_TTL']) if os.environ.get('PREDICTION_CACHE_TTL') else None,
+    disk_path=os.environ.get('PREDICTION_CACHE_PATH'),
+    max_disk_entries=int(os.environ.get('PREDICTION_CACHE_DISK_SIZE', 100000))
+)
+
+def predict_proba(images: np.ndarray, model: str = "Parts", verbose: int = 0) -> np.ndarray:
+    """
+    Class probabilities of `model` for a batch of preprocessed (224, 224, 3) images.
+    """
     chosen_model = model_dict.get(model)
-    
+
     if chosen_model is None:
         raise ValueError(f"Model '{model}' is not recognized. Valid options are: {list(model_dict.keys())}")
 
+    return chosen_model.predict(images, verbose=verbose)
+
+def predict(img: Union[ImageSource, np.ndarray], model: str = "Parts", verbose: int = 0) -> str:
+    if model not in model_dict:
+        raise ValueError(f"Model '{model}' is not recognized. Valid options are: {list(model_dict.keys())}")
+
     # Load and preprocess image
-    if isinstance(img, str):
-        temp_img = image.load_img(img, target_size=(size, size))
-        x = image.img_to_array(temp_img)
-    elif isinstance(img, np.ndarray):
+    if isinstance(img, np.ndarray):
         if img.shape[:2] != (size, size):
             raise ValueError(f"Input image must be of size ({size}, {size})")
         x = img
+    elif isinstance(img, (str, bytes, bytearray, memoryview)) or hasattr(img, 'read'):
+        x = decode_image(img)
     else:
-        raise TypeError("Input image must be a file path or a numpy array")
+        raise TypeError("Input image must be a file path, bytes, a binary stream or a numpy array")
+
+    images = np.expand_dims(x, axis=0)
 
-    x = np.expand_dims(x, axis=0)
-    images = np.vstack([x])
-    
     try:
-        prediction = np.argmax(chosen_model.predict(images, verbose=verbose), axis=1)
+        probs = prediction_cache.get_or_compute(
+            image_key(x), model_dict.cache_name(model), lambda: predict_proba(images, model, verbose)[0])
+        prediction = np.argmax(probs)
     except Exception as e:
         raise RuntimeError(f"Error during prediction: {e}")
 
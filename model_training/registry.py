@@ -0,0 +1,292 @@
+import gc
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Sequence
+from runtimes import CompiledModel, exported_path, quantizations, runtime_loader
+
+logger = logging.getLogger(__name__)
+
+# Weight file of each model inside the weights folder
+model_files = {
+    'Parts': 'ResNet50_BodyParts.h5',
+    'Elbow': 'ResNet50_Elbow_frac.h5',
+    'Hand': 'ResNet50_Hand_frac.h5',
+    'Shoulder': 'ResNet50_Shoulder_frac.h5'
+}
+
+load_modes = ('lazy', 'background', 'eager')
+
+
+def current_rss() -> int:
+    """
+    Resident set size of this process in bytes, or 0 when it cannot be read.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return 0
+
+
+class ModelRegistry:
+    """
+    Shared, memory-aware holder for the ResNet50 models.
+
+    Load modes:
+      lazy       - a model is loaded the first time it is requested
+      background - all models start loading in a background thread at creation;
+                   a request for a model that is still loading waits for it, and
+                   one that failed to load raises the error from the background load
+      eager      - all models are loaded before the constructor returns
+
+    With `max_resident` set, the least recently used model is dropped once more
+    than that many are in memory; it is reloaded on its next use.
+
+    `runtime` selects how models are run (see runtimes.py): 'keras' loads the
+    .h5 files, 'tflite' the graphs exported by export_runtime.py with the
+    given `quantization`. Keras models are `compiled` into fixed-signature
+    functions and warmed with `warmup_batch_sizes` as they load.
+
+    The registry behaves like the old `model_dict` (`registry['Parts']`,
+    `registry.get(name)`, `registry.keys()`), loading models on access.
+    """
+
+    def __init__(self, weights_dir: str = 'weights', mode: str = 'lazy', max_resident: int = None,
+                 loader: Callable[[str], Any] = None, runtime: str = 'keras', quantization: str = 'none',
+                 num_threads: int = None, compiled: bool = True, warmup_batch_sizes: Sequence[int] = (1,)):
+        if mode not in load_modes:
+            raise ValueError(f"Load mode '{mode}' is not recognized. Valid options are: {list(load_modes)}")
+        if quantization not in quantizations:
+            raise ValueError(f"Quantization '{quantization}' is not recognized. Valid options are: {list(quantizations)}")
+        self.weights_dir = weights_dir
+        self.mode = mode
+        self.max_resident = max_resident
+        self.runtime = runtime
+        self.quantization = quantization
+        self.compiled = compiled
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.loader = loader or runtime_loader(runtime, num_threads, compiled, warmup_batch_sizes)
+
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._models: "OrderedDict[str, Any]" = OrderedDict()
+        self._name_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._background = None
+        self._errors: Dict[str, RuntimeError] = {}  # background load failures, raised by load()
+        self._fingerprints: Dict[str, str] = {}
+
+        for name in model_files:
+            self.register(name, lambda path=self.model_path(name): self.loader(path))
+
+        if mode == 'eager':
+            self.preload(block=True)
+        elif mode == 'background':
+            self.preload()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """
+        Add a model built by `factory`, e.g. one derived from the other registered models.
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._name_locks[name] = threading.Lock()
+            self._stats[name] = {'loaded': False, 'loads': 0, 'uses': 0, 'evictions': 0,
+                                 'load_seconds': 0.0, 'rss_bytes': 0, 'param_bytes': 0}
+
+    def model_path(self, name: str) -> str:
+        """
+        File model `name` is loaded from with the configured runtime.
+        """
+        if self.runtime == 'keras':
+            return os.path.join(self.weights_dir, model_files[name])
+        return exported_path(self.weights_dir, name, self.quantization)
+
+    def prepare(self, model: Any) -> Any:
+        """
+        Wrap a Keras model built outside the registry (e.g. the fused model) like the loaded ones.
+        """
+        return CompiledModel(model, self.warmup_batch_sizes) if self.compiled else model
+
+    def cache_name(self, name: str) -> str:
+        # Name under which outputs of model `name` are cached, so runtimes never share entries
+        # and retrained weights never serve the previous model's cached predictions
+        base = name if self.runtime == 'keras' else f"{name}@{self.runtime}-{self.quantization}"
+        return f"{base}#{self.weights_fingerprint(name)}"
+
+    def weights_fingerprint(self, name: str) -> str:
+        """
+        Short hash of the size and modification time of the file(s) model `name`
+        is built from, taken again each time the model is loaded; models
+        registered from other models use all weight files.
+        """
+        fingerprint = self._fingerprints.get(name)
+        if fingerprint is None:
+            digest = hashlib.blake2b(digest_size=4)
+            for model in [name] if name in model_files else sorted(model_files):
+                try:
+                    stat = os.stat(self.model_path(model))
+                    digest.update(f"{model}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+                except OSError:
+                    digest.update(f"{model}:missing;".encode())
+            fingerprint = self._fingerprints[name] = digest.hexdigest()
+        return fingerprint
+
+    def load(self, name: str) -> Any:
+        """
+        Return model `name`, loading it first if it is not resident.
+        """
+        if name not in self._factories:
+            raise KeyError(f"Model '{name}' is not recognized. Valid options are: {self.keys()}")
+
+        with self._lock:
+            model = self._models.get(name)
+            if model is not None:
+                self._models.move_to_end(name)
+                self._stats[name]['uses'] += 1
+                return model
+
+        with self._name_locks[name]:
+            # Another thread may have finished loading it while we waited
+            with self._lock:
+                model = self._models.get(name)
+                error = self._errors.get(name)
+            if model is None and error is not None:
+                # Raised until the next preload() instead of retrying on every request
+                raise error
+            if model is None:
+                model = self._load(name)
+                # The file may have been replaced since the fingerprint was taken
+                self._fingerprints.pop(name, None)
+            with self._lock:
+                self._models[name] = model
+                self._models.move_to_end(name)
+                self._stats[name]['uses'] += 1
+                self._evict_over_limit(keep=name)
+            return model
+
+    def preload(self, names: List[str] = None, block: bool = False) -> None:
+        """
+        Load `names` (default: every registered model), in a background thread unless `block` is set.
+        A model that fails to load in the background raises that error from load() until the next preload().
+        """
+        names = list(names or self.keys())
+        with self._lock:
+            for name in names:
+                self._errors.pop(name, None)
+
+        def run():
+            for name in names:
+                try:
+                    self.load(name)
+                except RuntimeError as e:
+                    logger.error("Background load of model '%s' failed: %s", name, e)
+                    with self._lock:
+                        self._errors[name] = e
+
+        if block:
+            for name in names:
+                self.load(name)
+        else:
+            self._background = threading.Thread(target=run, name='model-preload', daemon=True)
+            self._background.start()
+
+    def wait_ready(self, timeout: float = None) -> None:
+        if self._background is not None:
+            self._background.join(timeout)
+
+    def evict(self, name: str) -> None:
+        with self._lock:
+            if self._models.pop(name, None) is not None:
+                self._stats[name]['loaded'] = False
+                self._stats[name]['evictions'] += 1
+        gc.collect()
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._models)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(values) for name, values in self._stats.items()}
+
+    # Mapping interface, compatible with the old `model_dict`
+    def get(self, name: str, default: Any = None) -> Any:
+        return self.load(name) if name in self._factories else default
+
+    def keys(self) -> List[str]:
+        return list(self._factories)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.load(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._factories
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self._factories)
+
+    def _load(self, name: str) -> Any:
+        rss_before = current_rss()
+        start = time.perf_counter()
+        try:
+            model = self._factories[name]()
+        except Exception as e:
+            raise RuntimeError(f"Error loading model '{name}': {e}")
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            stats = self._stats[name]
+            stats['loaded'] = True
+            stats['loads'] += 1
+            stats['load_seconds'] = elapsed
+            stats['rss_bytes'] = max(current_rss() - rss_before, 0)
+            if hasattr(model, 'count_params'):
+                stats['param_bytes'] = model.count_params() * 4
+        return model
+
+    def _evict_over_limit(self, keep: str) -> None:
+        # Caller holds the lock
+        if not self.max_resident:
+            return
+        while len(self._models) > self.max_resident:
+            oldest = next(iter(self._models))
+            if oldest == keep:
+                break
+            del self._models[oldest]
+            self._stats[oldest]['loaded'] = False
+            self._stats[oldest]['evictions'] += 1
+
+
+def registry_from_env(weights_dir: str = 'weights', warmup_batch_sizes: Sequence[int] = (1,)) -> ModelRegistry:
+    """
+    Registry configured by MODEL_LOAD_MODE (lazy/background/eager), MAX_RESIDENT_MODELS,
+    INFERENCE_RUNTIME (keras/tflite), RUNTIME_QUANTIZATION, RUNTIME_THREADS,
+    COMPILED_INFERENCE (1/0) and WARMUP_BATCH_SIZES (comma-separated).
+    """
+    max_resident = os.environ.get('MAX_RESIDENT_MODELS')
+    num_threads = os.environ.get('RUNTIME_THREADS')
+    if os.environ.get('WARMUP_BATCH_SIZES'):
+        warmup_batch_sizes = [int(n) for n in os.environ['WARMUP_BATCH_SIZES'].split(',')]
+    return ModelRegistry(
+        weights_dir,
+        mode=os.environ.get('MODEL_LOAD_MODE', 'lazy'),
+        max_resident=int(max_resident) if max_resident else None,
+        runtime=os.environ.get('INFERENCE_RUNTIME', 'keras'),
+        quantization=os.environ.get('RUNTIME_QUANTIZATION', 'none'),
+        num_threads=int(num_threads) if num_threads else None,
+        compiled=os.environ.get('COMPILED_INFERENCE', '1') != '0',
+        warmup_batch_sizes=warmup_batch_sizes
+    )
@@ -0,0 +1,108 @@
+import os
+import threading
+from typing import Any, Callable, Sequence
+import numpy as np
+
+# Runtimes the registry can load models with. 'tflite' reads the graphs written by export_runtime.py.
+runtime_names = ('keras', 'tflite')
+quantizations = ('none', 'float16', 'int8')
+
+
+def exported_path(weights_dir: str, name: str, quantization: str = 'none') -> str:
+    """
+    Path of the TFLite graph of model `name` ('Parts', 'Elbow', ..., 'Fused').
+    """
+    return os.path.join(weights_dir, 'tflite', f"{name}-{quantization}.tflite")
+
+
+def _interpreter_class():
+    # The standalone LiteRT package replaces tf.lite.Interpreter in newer releases
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel:
+    """
+    TFLite graph behind the `predict(batch, verbose=0)` interface of a Keras
+    model, so the registry, the batching engine and the cascade use it
+    unchanged. Runs on the XNNPACK CPU delegate. An interpreter is not
+    thread-safe, so calls are serialized.
+    """
+
+    def __init__(self, path: str, num_threads: int = None):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; run export_runtime.py first")
+        self.path = path
+        self.interpreter = _interpreter_class()(model_path=path, num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]['index']
+        self._output = self.interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, x: np.ndarray, verbose: int = 0) -> np.ndarray:
+        x = np.asarray(x, dtype=np.float32)
+        with self._lock:
+            if x.shape[0] != self._batch_size:
+                # Re-plan the tensors only when the batch size changes
+                self.interpreter.resize_tensor_input(self._input, list(x.shape))
+                self.interpreter.allocate_tensors()
+                self._batch_size = x.shape[0]
+            self.interpreter.set_tensor(self._input, x)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output).copy()
+
+
+class CompiledModel:
+    """
+    Keras model called through one `tf.function` with a fixed
+    (None, 224, 224, 3) float32 signature. `Model.predict` builds a data
+    adapter and may retrace on every call, which for one image costs more than
+    the network itself; here the graph is traced once, run once per batch size
+    in `warmup_batch_sizes` at load time, and then called directly.
+
+    Other attributes (`layers`, `input`, ...) are those of the wrapped model,
+    so it can still be fused or inspected.
+    """
+
+    def __init__(self, model, warmup_batch_sizes: Sequence[int] = (1,), jit_compile: bool = False):
+        import tensorflow as tf
+
+        self.model = model
+        self.input_shape = tuple(model.input_shape)
+        self._fn = tf.function(lambda x: model(x, training=False), jit_compile=jit_compile,
+                               input_signature=[tf.TensorSpec((None,) + self.input_shape[1:], tf.float32)])
+        self.warm(warmup_batch_sizes)
+
+    def warm(self, batch_sizes: Sequence[int]) -> None:
+        for batch_size in batch_sizes:
+            self._fn(np.zeros((batch_size,) + self.input_shape[1:], dtype=np.float32))
+
+    def predict(self, x: np.ndarray, verbose: int = 0) -> np.ndarray:
+        return self._fn(np.asarray(x, dtype=np.float32)).numpy()
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+
+def runtime_loader(runtime: str = 'keras', num_threads: int = None, compiled: bool = True,
+                   warmup_batch_sizes: Sequence[int] = (1,)) -> Callable[[str], Any]:
+    """
+    Function that loads a model file with `runtime`. Keras models are wrapped in
+    a `CompiledModel` unless `compiled` is off.
+    """
+    if runtime not in runtime_names:
+        raise ValueError(f"Runtime '{runtime}' is not recognized. Valid options are: {list(runtime_names)}")
+    if runtime == 'tflite':
+        return lambda path: TFLiteModel(path, num_threads)
+
+    import tensorflow as tf
+    if compiled:
+        return lambda path: CompiledModel(tf.keras.models.load_model(path), warmup_batch_sizes)
+    return lambda path: tf.keras.models.load_model(path)
@@ -0,0 +1,339 @@
+"""
+Approximate nearest-neighbour index of radiograph embeddings, for showing
+the most similar prior studies next to a prediction.
+
+Embeddings are the pooled ResNet50 features of the body part model (the
+backbone all four models share, see cascade.feature_extractor), normalized
+so that the dot product is the cosine similarity, and stored as float16.
+Search is an inverted file: the vectors are grouped around k-means
+centroids, and a query only scans the groups of its `nprobe` nearest
+centroids. New images are added to the group of their nearest centroid;
+the centroids are only retrained when the index has grown fourfold.
+
+    python similarity_index.py build                     # index Dataset/train (only new images on later runs)
+    python similarity_index.py query test/Hand/fractured/broken.jpg -k 5
+"""
+import argparse
+import os
+import threading
+import time
+from typing import Dict, List
+import numpy as np
+from cascade import categories_parts, categories_fracture
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+default_index_path = os.path.join(THIS_FOLDER, 'cache', 'similar', 'train.npz')
+
+# Per-image metadata saved with the vectors (see dataset_index.columns)
+metadata_columns = {
+    'path': str,          # relative to the indexed folder
+    'part': np.int8,      # index into categories_parts
+    'label': np.int8,     # index into categories_fracture
+    'patient_id': str,
+    'size': np.int64,
+    'mtime': np.int64
+}
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means: unit-length centroids that maximise the cosine similarity to their members.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~sums.any(axis=1)
+        # Restart empty clusters from random points so every list stays in use
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class EmbeddingIndex:
+    """
+    Inverted-file index of unit-length float16 vectors with per-vector metadata.
+
+    Below `min_train` vectors every search is an exact scan. Once that many
+    have been added, `nlist` centroids (default: 4 * sqrt(n)) are trained on
+    them and each search scans only the lists of the `nprobe` centroids
+    closest to the query. Vectors added later join the list of their nearest
+    centroid, and the centroids are retrained once the index has grown to
+    four times the size they were trained on, so the lists stay balanced.
+
+    Thread-safe: searches may run while vectors are added.
+    """
+
+    def __init__(self, dim: int, nprobe: int = 16, nlist: int = None, min_train: int = 2048,
+                 root: str = ''):
+        self.dim = dim
+        self.nprobe = nprobe
+        self.nlist = nlist
+        self.min_train = min_train
+        self.root = root
+        self.vectors = np.zeros((0, dim), dtype=np.float16)
+        self.metadata = {name: np.array([], dtype=dtype) for name, dtype in metadata_columns.items()}
+        self.centroids = None
+        self.trained_size = 0
+        self.assignment = np.zeros(0, dtype=np.int32)
+        self._lock = threading.RLock()
+        self._order = self._offsets = None
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def add(self, vectors: np.ndarray, metadata: Dict[str, np.ndarray]) -> None:
+        """
+        Insert `vectors` (one row per image) with a value of every metadata column for each.
+        """
+        vectors = normalize(vectors)
+        with self._lock:
+            self.vectors = np.concatenate([self.vectors, vectors.astype(np.float16)])
+            self.metadata = {name: np.concatenate([self.metadata[name], np.asarray(metadata[name], dtype=dtype)])
+                             for name, dtype in metadata_columns.items()}
+            if len(self) >= max(self.min_train, 4 * self.trained_size):
+                self.train()
+            elif self.centroids is not None:
+                self.assignment = np.concatenate([self.assignment, self._assign(vectors)])
+                self._order = None
+
+    def train(self, seed: int = 0) -> None:
+        """
+        (Re)train the centroids on the stored vectors and regroup them.
+        """
+        with self._lock:
+            nlist = self.nlist or max(1, int(4 * np.sqrt(len(self))))
+            sample = self.vectors
+            if len(sample) > 64 * nlist:
+                sample = sample[np.random.default_rng(seed).choice(len(sample), 64 * nlist, replace=False)]
+            self.centroids = kmeans(sample.astype(np.float32), min(nlist, len(sample)), seed=seed)
+            self.assignment = self._assign(self.vectors)
+            self.trained_size = len(self)
+            self._order = None
+
+    def remove(self, rows: np.ndarray) -> None:
+        """
+        Drop the vectors at `rows`, e.g. images that changed on disk and are re-added.
+        """
+        with self._lock:
+            keep = np.ones(len(self), dtype=bool)
+            keep[rows] = False
+            self.vectors = self.vectors[keep]
+            self.metadata = {name: values[keep] for name, values in self.metadata.items()}
+            if self.centroids is not None:
+                self.assignment = self.assignment[keep]
+                self._order = None
+
+    def search(self, query: np.ndarray, k: int = 5, part: str = None, nprobe: int = None) -> List[Dict[str, object]]:
+        """
+        The `k` stored images most similar to `query`, best first, optionally
+        only those of body part `part`. Each result holds its metadata and
+        cosine `score`.
+
+        With `part`, when the `nprobe` nearest lists hold fewer than `k`
+        images of that part, all images of the part are scanned instead, so a
+        part that is rare near the query still returns its `k` best.
+        """
+        query = normalize(query).reshape(-1)
+        with self._lock:
+            if self.centroids is None:
+                rows = np.arange(len(self))
+            else:
+                nprobe = min(nprobe or self.nprobe, len(self.centroids))
+                probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+                rows = self._rows_of(probed)
+            if part is not None:
+                in_part = self.metadata['part'] == categories_parts.index(part)
+                rows = rows[in_part[rows]]
+                if len(rows) < k:
+                    rows = np.flatnonzero(in_part)
+            if not len(rows):
+                return []
+            scores = self.vectors[rows].astype(np.float32) @ query
+            best = np.argpartition(-scores, k - 1)[:k] if len(rows) > k else np.arange(len(rows))
+            top = best[np.argsort(-scores[best])]
+            return [self._result(rows[i], scores[i]) for i in top]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        with self._lock:
+            arrays = dict(self.metadata, vectors=self.vectors, assignment=self.assignment,
+                          settings=np.array([self.dim, self.nprobe, self.nlist or 0, self.min_train,
+                                             self.trained_size]),
+                          root=np.array(self.root))
+            if self.centroids is not None:
+                arrays['centroids'] = self.centroids
+            np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingIndex':
+        saved = np.load(path)
+        dim, nprobe, nlist, min_train, trained_size = saved['settings'].tolist()
+        index = cls(dim, nprobe, nlist or None, min_train, str(saved['root']))
+        index.trained_size = trained_size
+        index.vectors = saved['vectors']
+        index.metadata = {name: saved[name] for name in metadata_columns}
+        if 'centroids' in saved:
+            index.centroids = saved['centroids']
+            index.assignment = saved['assignment']
+        return index
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        assignment = np.empty(len(vectors), dtype=np.int32)
+        # In chunks, so a large insert does not build one huge similarity matrix
+        for start in range(0, len(vectors), 4096):
+            chunk = np.asarray(vectors[start:start + 4096], dtype=np.float32)
+            assignment[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignment
+
+    def _rows_of(self, lists: np.ndarray) -> np.ndarray:
+        # Rows grouped by list, rebuilt after inserts on the next search
+        if self._order is None:
+            self._order = np.argsort(self.assignment, kind='stable')
+            self._offsets = np.searchsorted(self.assignment[self._order], np.arange(len(self.centroids) + 1))
+        return np.concatenate([self._order[self._offsets[i]:self._offsets[i + 1]] for i in lists])
+
+    def _result(self, row: int, score: float) -> Dict[str, object]:
+        return {
+            'path': str(self.metadata['path'][row]),
+            'body_part': categories_parts[self.metadata['part'][row]],
+            'label': categories_fracture[self.metadata['label'][row]],
+            'patient_id': str(self.metadata['patient_id'][row]),
+            'score': float(score)
+        }
+
+
+class SimilarityService:
+    """
+    Index file shared by the backend: loaded on first use and reloaded when
+    `similarity_index.py build` has rewritten it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def index(self) -> EmbeddingIndex:
+        """
+        The current index, or a FileNotFoundError when it has not been built.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                self._index = EmbeddingIndex.load(self.path)
+                self._mtime = mtime
+            return self._index
+
+
+def build_index(split_dir: str, index_path: str, embed_batch, batch_size: int = 64, workers: int = None,
+                nprobe: int = 16) -> EmbeddingIndex:
+    """
+    Index every image of `split_dir`, or bring an existing index up to date:
+    only new or modified images are embedded, and deleted ones are dropped.
+    `embed_batch(images)` returns one embedding per decoded image.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from colorama import Fore
+    from dataset_index import DatasetIndex
+    from image_io import decode_image, new_buffer
+
+    dataset = DatasetIndex.load(split_dir)
+    index = EmbeddingIndex.load(index_path) if os.path.exists(index_path) else None
+
+    current = {(path, file_size, mtime): i for i, (path, file_size, mtime) in enumerate(
+        zip(dataset.data['path'].tolist(), dataset.data['size'].tolist(), dataset.data['mtime'].tolist()))}
+    if index is not None:
+        stored = list(zip(index.metadata['path'].tolist(), index.metadata['size'].tolist(),
+                          index.metadata['mtime'].tolist()))
+        stale = [i for i, entry in enumerate(stored) if entry not in current]
+        if stale:
+            index.remove(np.array(stale))
+        for entry in stored:
+            current.pop(entry, None)
+    new_rows = sorted(current.values())
+
+    start = time.perf_counter()
+    added_rows, added_vectors = [], []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for chunk_start in range(0, len(new_rows), batch_size):
+            rows = new_rows[chunk_start:chunk_start + batch_size]
+            batch = new_buffer(len(rows))
+
+            def decode(i: int) -> bool:
+                try:
+                    decode_image(os.path.join(dataset.root, dataset.data['path'][rows[i]]), out=batch[i])
+                    return True
+                except ValueError as e:
+                    print(Fore.RED + f"Skipping {dataset.data['path'][rows[i]]}: {e}")
+                    return False
+
+            ok = np.array(list(pool.map(decode, range(len(rows)))))
+            if not ok.any():
+                continue
+            added_rows.append(np.array(rows)[ok])
+            # Kept as float16 until the insert, like the index stores them
+            added_vectors.append(normalize(embed_batch(batch[ok])).astype(np.float16))
+            print(f"\rEmbedded {min(chunk_start + batch_size, len(new_rows))}/{len(new_rows)} images", end='')
+    if new_rows:
+        print()
+
+    # One insert for the whole run, so the stored vectors are copied once
+    if added_vectors:
+        rows = np.concatenate(added_rows)
+        if index is None:
+            index = EmbeddingIndex(added_vectors[0].shape[1], nprobe=nprobe, root=dataset.root)
+        index.add(np.concatenate(added_vectors), {name: dataset.data[name][rows] for name in metadata_columns})
+    if index is None:
+        raise ValueError(f"No images could be indexed under {split_dir}")
+    index.save(index_path)
+    print(Fore.BLUE + f"Indexed {len(new_rows)} new images in {time.perf_counter() - start:.1f}s "
+                      f"({len(index)} in total)" + Fore.RESET)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('image', nargs='?', help="Image to look up (query)")
+    parser.add_argument('--dataset', default=os.path.join(THIS_FOLDER, 'Dataset', 'train'))
+    parser.add_argument('--index', default=default_index_path)
+    parser.add_argument('--weights', default=os.path.join(THIS_FOLDER, 'weights'))
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--part', choices=categories_parts, help="Only return images of this body part")
+    args = parser.parse_args()
+
+    from cascade import feature_extractor
+    from registry import ModelRegistry
+    models = ModelRegistry(args.weights, runtime='keras', compiled=False)
+    embedder = feature_extractor(models['Parts'])
+
+    if args.command == 'build':
+        build_index(args.dataset, args.index, lambda images: embedder.predict(images, verbose=0),
+                    args.batch_size, args.workers, args.nprobe)
+    else:
+        from image_io import decode_image
+        from tabulate import tabulate
+        if args.image is None:
+            parser.error("query needs an image")
+        index = EmbeddingIndex.load(args.index)
+        query = embedder.predict(decode_image(args.image)[np.newaxis], verbose=0)[0]
+        start = time.perf_counter()
+        results = index.search(query, args.k, args.part, args.nprobe)
+        print(f"Searched {len(index)} images in {(time.perf_counter() - start) * 1000:.2f} ms")
+        print(tabulate([[r['score'], r['body_part'], r['label'], r['patient_id'], r['path']] for r in results],
+                       headers=["Score", "Part", "Label", "Patient", "Path"], tablefmt="grid", floatfmt=".3f"))
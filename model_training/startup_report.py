@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+from colorama import Fore
+from tabulate import tabulate
+from registry import load_modes
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+sample_image = os.path.join(THIS_FOLDER, 'test', 'Hand', 'fractured', 'broken.jpg')
+
+# Runs in a fresh interpreter so every mode starts cold
+probe = """
+import json, sys, time
+start = time.perf_counter()
+import predictions
+from registry import current_rss
+import_seconds = time.perf_counter() - start
+import_rss = current_rss()
+predictions.predict(sys.argv[1])
+print(json.dumps({
+    'import_seconds': import_seconds,
+    'first_predict_seconds': time.perf_counter() - start - import_seconds,
+    'import_rss': import_rss,
+    'rss': current_rss(),
+    'resident': predictions.model_dict.loaded()
+}))
+# Let a background preload finish instead of tearing down TensorFlow under it
+predictions.model_dict.wait_ready()
+"""
+
+
+def measure(mode: str) -> dict:
+    env = dict(os.environ, MODEL_LOAD_MODE=mode, PYTHONPATH=THIS_FOLDER, TF_CPP_MIN_LOG_LEVEL='3')
+    output = subprocess.run([sys.executable, '-c', probe, sample_image], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    # Models are read from ./weights, as in predictions.py
+    table = [["Mode", "Import s", "First predict s", "RSS after import MB", "RSS after predict MB", "Resident models"]]
+    for mode in load_modes:
+        result = measure(mode)
+        table.append([
+            mode,
+            f"{result['import_seconds']:.2f}",
+            f"{result['first_predict_seconds']:.2f}",
+            f"{result['import_rss'] / 2 ** 20:.0f}",
+            f"{result['rss'] / 2 ** 20:.0f}",
+            ", ".join(result['resident'])
+        ])
+
+    print(Fore.BLUE + "\nStartup report ('eager' matches the previous import-time loading):")
+    print(tabulate(table, headers="firstrow", tablefmt="grid"))
@@ -0,0 +1,218 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
+from colorama import Fore
+from cascade import categories_parts, categories_fracture
+from image_io import decode_image, decode_limits, size
+from dataset_index import DatasetIndex
+
+meta_file = 'meta.npz'
+images_file = 'images.u8'
+
+
+def _scan(split_dir: str) -> List[Dict[str, object]]:
+    """
+    List every image of the split with its size and modification time.
+    """
+    index = DatasetIndex.load(split_dir, deep=True)
+    return [{
+        'path': path,
+        'size': file_size,
+        'mtime': mtime,
+        'body_part': body_part,
+        'patient_id': patient_id,
+        'label': label
+    } for path, file_size, mtime, body_part, patient_id, label in zip(
+        index.data['path'].tolist(), index.data['size'].tolist(), index.data['mtime'].tolist(),
+        index.body_parts(), index.data['patient_id'].tolist(), index.labels())]
+
+
+class TensorCache:
+    """
+    Read-only view of a dataset split that was decoded once into a memory-mapped
+    uint8 array of shape (N, 224, 224, 3), plus per-image metadata.
+
+    `parts` and `labels` hold indices into `categories_parts` and
+    `categories_fracture`; `paths` are relative to the split folder `root`.
+    `decode_mode` is 'full' or 'reduced', the JPEG decoding the pixels came from.
+    """
+
+    def __init__(self, cache_dir: str):
+        meta = np.load(os.path.join(cache_dir, meta_file))
+        self.cache_dir = cache_dir
+        self.root = str(meta['root'])
+        self.paths = meta['paths']
+        self.sizes = meta['sizes']
+        self.mtimes = meta['mtimes']
+        self.parts = meta['parts']
+        self.labels = meta['labels']
+        self.patient_ids = meta['patient_ids']
+        # Caches written before the mode was recorded were decoded at full resolution
+        self.decode_mode = str(meta['decode_mode']) if 'decode_mode' in meta.files else 'full'
+        # Files that failed to decode, remembered so unchanged ones are not retried
+        self.skipped = set(zip(meta['skipped_paths'], meta['skipped_sizes'], meta['skipped_mtimes']))
+        self.images = np.memmap(os.path.join(cache_dir, images_file), dtype=np.uint8, mode='r',
+                                shape=(len(self.paths), size, size, 3)) if len(self.paths) else \
+            np.zeros((0, size, size, 3), dtype=np.uint8)
+        self._rows = {path: i for i, path in enumerate(self.paths)}
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def row_of(self, path: str) -> int:
+        """
+        Row of an image by its absolute path or its path relative to the split
+        folder, or -1 if it is not cached.
+        """
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.root)
+        return self._rows.get(path, -1)
+
+    def select(self, part: str = None, label: str = None) -> np.ndarray:
+        mask = np.ones(len(self), dtype=bool)
+        if part is not None:
+            mask &= self.parts == categories_parts.index(part)
+        if label is not None:
+            mask &= self.labels == categories_fracture.index(label)
+        return np.flatnonzero(mask)
+
+    def batches(self, indices: np.ndarray = None, batch_size: int = 64, shuffle: bool = False,
+                seed: int = 42) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Yield (float32 images, row indices) batches straight from the memory map.
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        for start in range(0, len(indices), batch_size):
+            rows = indices[start:start + batch_size]
+            # Sorted reads are sequential on disk; restore the requested order afterwards
+            order = np.argsort(rows)
+            batch = np.empty((len(rows), size, size, 3), dtype=np.float32)
+            batch[order] = self.images[rows[order]]
+            yield batch, rows
+
+    def as_dataset(self, indices: np.ndarray = None, target: str = 'fracture', batch_size: int = 64,
+                   shuffle: bool = True, seed: int = 42, preprocess=None):
+        """
+        tf.data pipeline of (images, one-hot labels) for `model.fit`. `target` is
+        'fracture' or 'parts'; `preprocess` is applied to each float32 batch
+        (e.g. `tf.keras.applications.resnet50.preprocess_input`).
+        """
+        import tensorflow as tf
+
+        classes = categories_fracture if target == 'fracture' else categories_parts
+        labels = self.labels if target == 'fracture' else self.parts
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        n_epoch = [0]
+
+        def generate():
+            # A new shuffle every epoch, reproducible from `seed`
+            n_epoch[0] += 1
+            for batch, rows in self.batches(indices, batch_size, shuffle, seed + n_epoch[0]):
+                if preprocess is not None:
+                    batch = preprocess(batch)
+                yield batch, np.eye(len(classes), dtype=np.float32)[labels[rows]]
+
+        signature = (tf.TensorSpec((None, size, size, 3), tf.float32),
+                     tf.TensorSpec((None, len(classes)), tf.float32))
+        return tf.data.Dataset.from_generator(generate, output_signature=signature).prefetch(tf.data.AUTOTUNE)
+
+
+def build_tensor_cache(split_dir: str, cache_dir: str, workers: int = None) -> TensorCache:
+    """
+    Decode every image of `split_dir` into `cache_dir`. Rows of an existing
+    cache whose file size and modification time are unchanged are copied over,
+    so only new or modified images are decoded again. A cache decoded with
+    another REDUCED_DECODE setting is rebuilt from scratch.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    rows = _scan(split_dir)
+    decode_mode = 'reduced' if decode_limits.reduced else 'full'
+
+    previous = None
+    skipped = set()
+    if os.path.exists(os.path.join(cache_dir, meta_file)):
+        previous = TensorCache(cache_dir)
+        if previous.decode_mode != decode_mode:
+            print(Fore.YELLOW + f"{cache_dir} was decoded in {previous.decode_mode} mode; decoding it again")
+            previous = None
+    if previous is not None:
+        current = {(r['path'], r['size'], r['mtime']) for r in rows}
+        skipped = previous.skipped & current
+        rows = [r for r in rows if (r['path'], r['size'], r['mtime']) not in skipped]
+        unchanged = (len(previous) == len(rows) and all(
+            previous.row_of(r['path']) == i and previous.sizes[i] == r['size'] and previous.mtimes[i] == r['mtime']
+            for i, r in enumerate(rows)))
+        if unchanged:
+            return previous
+
+    tmp_images = os.path.join(cache_dir, images_file + '.tmp')
+    images = np.memmap(tmp_images, dtype=np.uint8, mode='w+', shape=(max(len(rows), 1), size, size, 3))
+    keep = np.ones(len(rows), dtype=bool)
+    to_decode = []
+    for i, r in enumerate(rows):
+        old = previous.row_of(r['path']) if previous is not None else -1
+        if old >= 0 and previous.sizes[old] == r['size'] and previous.mtimes[old] == r['mtime']:
+            images[i] = previous.images[old]
+        else:
+            to_decode.append(i)
+
+    def decode(i: int) -> None:
+        try:
+            decode_image(os.path.join(split_dir, rows[i]['path']), out=images[i])
+        except ValueError as e:
+            print(Fore.RED + f"Skipping {rows[i]['path']}: {e}")
+            keep[i] = False
+            skipped.add((rows[i]['path'], rows[i]['size'], rows[i]['mtime']))
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(decode, to_decode))
+
+    # Drop rows that failed to decode
+    kept = np.flatnonzero(keep)
+    if len(kept) != len(rows):
+        for new, old in enumerate(kept):
+            images[new] = images[old]
+        rows = [rows[i] for i in kept]
+    images.flush()
+    del images
+    if previous is not None:
+        del previous
+
+    os.truncate(tmp_images, len(rows) * size * size * 3)
+    os.replace(tmp_images, os.path.join(cache_dir, images_file))
+    np.savez(os.path.join(cache_dir, meta_file),
+             root=np.array(os.path.abspath(split_dir)),
+             decode_mode=np.array(decode_mode),
+             paths=np.array([r['path'] for r in rows], dtype=str),
+             sizes=np.array([r['size'] for r in rows], dtype=np.int64),
+             mtimes=np.array([r['mtime'] for r in rows], dtype=np.int64),
+             parts=np.array([categories_parts.index(r['body_part']) for r in rows], dtype=np.int8),
+             labels=np.array([categories_fracture.index(r['label']) for r in rows], dtype=np.int8),
+             patient_ids=np.array([r['patient_id'] for r in rows], dtype=str),
+             skipped_paths=np.array([path for path, _, _ in sorted(skipped)], dtype=str),
+             skipped_sizes=np.array([file_size for _, file_size, _ in sorted(skipped)], dtype=np.int64),
+             skipped_mtimes=np.array([mtime for _, _, mtime in sorted(skipped)], dtype=np.int64))
+    print(Fore.BLUE + f"Cached {len(rows)} images from {split_dir} ({len(to_decode)} decoded)")
+    return TensorCache(cache_dir)
+
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+default_cache_root = os.path.join(THIS_FOLDER, 'cache')
+
+
+def cache_dir_for(split_dir: str) -> str:
+    return os.path.join(default_cache_root, os.path.basename(os.path.normpath(split_dir)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decode dataset splits once into memory-mapped tensor caches")
+    parser.add_argument('splits', nargs='*', default=[os.path.join(THIS_FOLDER, 'Dataset/train'),
+                                                      os.path.join(THIS_FOLDER, 'Dataset/test')])
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    for split in args.splits:
+        build_tensor_cache(split, cache_dir_for(split), args.workers)
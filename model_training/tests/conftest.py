@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The training modules import each other as top-level scripts, as when run from model_training/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
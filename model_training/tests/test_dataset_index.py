@@ -0,0 +1,93 @@
+import os
+import pytest
+import dataset_index
+from dataset_index import DatasetIndex
+
+
+def write(path, data: bytes = b'x') -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def touch_dir(path, seconds: int) -> None:
+    # Folder mtimes can be too coarse to change within a test, so they are set explicitly
+    stamp = seconds * 10 ** 9
+    os.utime(path, ns=(stamp, stamp))
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / 'Dataset'
+    write(str(root / 'train' / 'Hand' / 'patient1' / 'study1_positive' / 'image1.png'))
+    write(str(root / 'train' / 'Hand' / 'patient1' / 'study2_negative' / 'image1.png'))
+    write(str(root / 'train' / 'Elbow' / 'patient2' / 'study1_negative' / 'image1.png'))
+    write(str(root / 'test' / 'Shoulder' / 'fractured' / 'a.png'))
+    write(str(root / 'test' / 'Shoulder' / 'normal' / 'b.png'))
+    for i, (path, _, _) in enumerate(os.walk(root)):
+        touch_dir(path, 1000 + i)
+    return root
+
+
+@pytest.fixture
+def listed(monkeypatch):
+    # Folders whose entries are read during a refresh
+    folders = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        folders.append(os.path.abspath(path))
+        return scandir(path)
+
+    monkeypatch.setattr(dataset_index.os, 'scandir', recording_scandir)
+    return folders
+
+
+def test_scan_reads_labels_from_the_layout(dataset):
+    index = DatasetIndex.scan(str(dataset))
+    assert len(index) == 5
+    records = {record['image_path'].replace(str(dataset) + os.sep, ''): record for record in index.records()}
+    positive = records[os.path.join('train', 'Hand', 'patient1', 'study1_positive', 'image1.png')]
+    assert (positive['body_part'], positive['label']) == ('Hand', 'fractured')
+    assert len(index.select(split='test', label='normal')) == 1
+    assert len(index.select(part='Hand')) == 2
+
+
+def test_refresh_only_lists_changed_folders(dataset, tmp_path, listed):
+    index_path = str(tmp_path / 'index.npz')
+    DatasetIndex.load(str(dataset), index_path)
+    study = dataset / 'train' / 'Hand' / 'patient1' / 'study1_positive'
+    write(str(study / 'image2.png'))
+    touch_dir(str(study), 5000)
+
+    listed.clear()
+    index = DatasetIndex.load(str(dataset), index_path)
+    assert listed == [str(study)]
+    assert len(index) == 6
+    assert len(index.select(part='Hand', label='fractured')) == 2
+
+    listed.clear()
+    assert len(DatasetIndex.load(str(dataset), index_path)) == 6
+    assert listed == []
+
+
+def test_refresh_drops_removed_folders(dataset, tmp_path):
+    index_path = str(tmp_path / 'index.npz')
+    DatasetIndex.load(str(dataset), index_path)
+    elbow = dataset / 'train' / 'Elbow'
+    for path, _, files in os.walk(elbow, topdown=False):
+        for name in files:
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+    touch_dir(str(dataset / 'train'), 5000)
+
+    index = DatasetIndex.load(str(dataset), index_path)
+    assert len(index) == 4
+    assert len(index.select(part='Elbow')) == 0
+
+
+def test_patient_split_keeps_patients_together(dataset):
+    index = DatasetIndex.scan(str(dataset)).select(split='train')
+    train, test = index.patient_split(train_size=0.5, seed=0)
+    assert len(train) + len(test) == len(index)
+    assert not set(train.data['patient_id']) & set(test.data['patient_id'])
@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+
+feature_training = pytest.importorskip('feature_training')
+FeatureCache = feature_training.FeatureCache
+
+
+class FakeBackbone:
+    """
+    Stands in for ResNet50: one feature row per image (its mean colour), counting the images it sees.
+    """
+
+    def __init__(self):
+        self.images = 0
+
+    def predict(self, x, verbose=0):
+        self.images += len(x)
+        return np.asarray(x).mean(axis=(1, 2))
+
+
+class NoBackbone:
+    def predict(self, x, verbose=0):
+        raise AssertionError("Features should have come from the cache")
+
+
+def write_image(path, colour) -> str:
+    Image.new('RGB', (32, 32), colour).save(path)
+    return str(path)
+
+
+@pytest.fixture
+def images(tmp_path):
+    return [write_image(tmp_path / f"{i}.png", (40 * i, 0, 0)) for i in range(4)]
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    # Paths read in full to be hashed
+    paths = []
+    file_hash = feature_training.file_hash
+
+    def counting_hash(path):
+        paths.append(path)
+        return file_hash(path)
+
+    monkeypatch.setattr(feature_training, 'file_hash', counting_hash)
+    return paths
+
+
+def test_only_new_images_are_extracted(tmp_path, images):
+    cache_dir = str(tmp_path / 'features')
+    backbone = FakeBackbone()
+    rows = FeatureCache(cache_dir).update(images[:3], backbone, workers=2)
+    assert sorted(rows.tolist()) == [0, 1, 2]
+    # Each image and its flipped copy
+    assert backbone.images == 6
+
+    cache = FeatureCache(cache_dir)
+    assert len(cache) == 3
+    rows = cache.update(images, backbone, workers=2)
+    assert backbone.images == 8
+    assert len(cache) == 4 and len(set(rows.tolist())) == 4
+    assert cache.features.shape == cache.flipped.shape == (4, 3)
+    # Rows of different images hold different features
+    assert len({tuple(row) for row in np.asarray(cache.features)}) == 4
+
+    FeatureCache(cache_dir).update(images, NoBackbone(), workers=2)
+
+
+def test_copies_of_an_image_share_a_row(tmp_path, images):
+    copy = write_image(tmp_path / 'copy.png', (40, 0, 0))
+    rows = FeatureCache(str(tmp_path / 'features')).update([images[1], copy], FakeBackbone(), workers=2)
+    assert rows[0] == rows[1]
+
+
+def test_each_file_is_hashed_once_per_run(tmp_path, images, hashed):
+    cache = FeatureCache(str(tmp_path / 'features'))
+    cache.update(images, FakeBackbone(), workers=2)
+    cache.update(images, NoBackbone(), workers=2)
+    assert sorted(hashed) == sorted(images)
+
+    hashed.clear()
+    write_image(images[0], (255, 255, 255))
+    stat = os.stat(images[0])
+    os.utime(images[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    backbone = FakeBackbone()
+    cache.update(images, backbone, workers=2)
+    assert hashed == [images[0]]
+    assert backbone.images == 2
+
+
+def test_undecodable_files_get_row_minus_one(tmp_path, images):
+    broken = tmp_path / 'broken.png'
+    broken.write_bytes(b'not an image')
+    rows = FeatureCache(str(tmp_path / 'features')).update([images[0], str(broken)], FakeBackbone(), workers=2)
+    assert rows[0] == 0 and rows[1] == -1
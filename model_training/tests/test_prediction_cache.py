@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+import prediction_cache
+from prediction_cache import PredictionCache, image_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, 'time', lambda: now[0])
+    return now
+
+
+def probs(value: float) -> np.ndarray:
+    return np.array([value, 1 - value], dtype=np.float32)
+
+
+def test_image_key_depends_only_on_pixels():
+    x = np.arange(12, dtype=np.float32).reshape(2, 2, 3)
+    assert image_key(x) == image_key(x.copy())
+    assert image_key(x) != image_key(x + 1)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = PredictionCache(max_entries=2)
+    cache.put('a', 'Parts', probs(0.1))
+    cache.put('b', 'Parts', probs(0.2))
+    assert cache.get('a', 'Parts') is not None
+    cache.put('c', 'Parts', probs(0.3))
+    assert cache.get('b', 'Parts') is None
+    assert cache.get('a', 'Parts') is not None
+    assert cache.get('c', 'Parts') is not None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_models_of_one_image_share_an_entry():
+    cache = PredictionCache(max_entries=1)
+    cache.put('a', 'Parts', probs(0.1))
+    cache.put('a', 'Hand', probs(0.2))
+    np.testing.assert_array_equal(cache.get('a', 'Parts'), probs(0.1))
+    np.testing.assert_array_equal(cache.get('a', 'Hand'), probs(0.2))
+    assert cache.stats()['evictions'] == 0
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PredictionCache(max_entries=4, ttl=60)
+    cache.put('a', 'Parts', probs(0.1))
+    clock[0] += 59
+    assert cache.get('a', 'Parts') is not None
+    clock[0] += 2
+    assert cache.get('a', 'Parts') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_get_or_compute_computes_once():
+    cache = PredictionCache(max_entries=4)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return probs(0.4)
+
+    for _ in range(3):
+        np.testing.assert_array_equal(cache.get_or_compute('a', 'Parts', compute), probs(0.4))
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 2
+
+
+def test_disk_cache_survives_restarts_and_is_bounded(tmp_path, clock):
+    path = str(tmp_path / 'predictions.db')
+    cache = PredictionCache(max_entries=0, disk_path=path, max_disk_entries=2, prune_every=1)
+    for i, key in enumerate('abc'):
+        clock[0] += 1
+        cache.put(key, 'Parts', probs(i / 10))
+    reopened = PredictionCache(max_entries=0, disk_path=path, max_disk_entries=2)
+    assert reopened.get('a', 'Parts') is None
+    np.testing.assert_array_equal(reopened.get('c', 'Parts'), probs(0.2))
+    assert cache.stats()['disk_evictions'] == 1
+
+
+def test_expired_disk_rows_are_pruned_on_open(tmp_path, clock):
+    path = str(tmp_path / 'predictions.db')
+    PredictionCache(max_entries=0, disk_path=path, ttl=60).put('a', 'Parts', probs(0.1))
+    clock[0] += 120
+    reopened = PredictionCache(max_entries=0, disk_path=path, ttl=60)
+    assert reopened.disk_evictions == 1
+    assert reopened.get('a', 'Parts') is None
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+similarity_index = pytest.importorskip('similarity_index')
+EmbeddingIndex = similarity_index.EmbeddingIndex
+normalize = similarity_index.normalize
+
+
+def clustered(n: int, dim: int = 32, clusters: int = 20, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    return centres[rng.integers(clusters, size=n)] + 0.3 * rng.normal(size=(n, dim))
+
+
+def metadata(n: int, parts: np.ndarray = None):
+    return {
+        'path': np.array([f"image{i}.png" for i in range(n)]),
+        'part': parts if parts is not None else np.arange(n) % 3,
+        'label': np.zeros(n),
+        'patient_id': np.array([f"patient{i}" for i in range(n)]),
+        'size': np.ones(n),
+        'mtime': np.ones(n),
+    }
+
+
+def exact(vectors: np.ndarray, query: np.ndarray, k: int, rows: np.ndarray = None) -> set:
+    rows = np.arange(len(vectors)) if rows is None else rows
+    scores = normalize(vectors[rows]) @ normalize(query)
+    return set(rows[np.argsort(-scores)[:k]].tolist())
+
+
+def found(results) -> set:
+    return {int(result['path'][len('image'):-len('.png')]) for result in results}
+
+
+@pytest.fixture
+def index():
+    vectors = clustered(4000)
+    index = EmbeddingIndex(dim=32, nprobe=8, min_train=1000)
+    index.add(vectors, metadata(len(vectors)))
+    return index, vectors
+
+
+def test_small_index_is_searched_exactly():
+    vectors = clustered(100)
+    index = EmbeddingIndex(dim=32, min_train=1000)
+    index.add(vectors, metadata(len(vectors)))
+    assert index.centroids is None
+    query = vectors[7]
+    results = index.search(query, k=5)
+    assert found(results) == exact(vectors, query, 5)
+    assert results[0]['score'] == pytest.approx(1.0, abs=1e-2)
+
+
+def test_recall_is_close_to_an_exact_scan(index):
+    index, vectors = index
+    assert index.centroids is not None
+    # New images from the same distribution as the indexed ones
+    queries = clustered(4050)[4000:]
+    recall = np.mean([len(found(index.search(q, k=10)) & exact(vectors, q, 10)) / 10 for q in queries])
+    assert recall >= 0.9
+
+
+def test_part_filter_still_returns_k_results():
+    vectors = clustered(4000)
+    # Part 2 is rare: 30 images, none of them near the query
+    parts = np.zeros(len(vectors), dtype=np.int8)
+    query = vectors[0]
+    far = np.argsort(normalize(vectors) @ normalize(query))[:30]
+    parts[far] = 2
+    index = EmbeddingIndex(dim=32, nprobe=2, min_train=1000)
+    index.add(vectors, metadata(len(vectors), parts))
+
+    results = index.search(query, k=10, part='Shoulder')
+    assert len(results) == 10
+    assert found(results) <= set(far.tolist())
+    # The best 10 of the part, up to float16 rounding of near ties
+    best = np.sort(normalize(vectors[far]) @ normalize(query))[::-1][:10]
+    np.testing.assert_allclose([result['score'] for result in results], best, atol=1e-2)
+    assert len(index.search(query, k=50, part='Shoulder')) == 30
+
+
+def test_saved_index_gives_the_same_results(index, tmp_path):
+    index, vectors = index
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+    loaded = EmbeddingIndex.load(path)
+    query = vectors[3]
+    assert found(loaded.search(query, k=10)) == found(index.search(query, k=10))
+
+
+def test_removed_vectors_are_not_returned(index):
+    index, vectors = index
+    index.remove(np.array([5]))
+    assert len(index) == len(vectors) - 1
+    assert 'image5.png' not in [result['path'] for result in index.search(vectors[5], k=10)]
@@ -0,0 +1,276 @@
+"""
+Train the body part model and the per-part fracture models from one script,
+replacing the ImageDataGenerator loops of the training notebooks.
+
+Images are read through a tf.data pipeline that decodes in parallel (with the
+same decoder as inference, see image_io.py), flips horizontally for
+augmentation and prefetches batches while the model trains. Shuffling, the flips and the weight
+initialisation all derive from `--seed`, so two runs see the same batches.
+
+    python training.py                         # Parts, Elbow, Hand and Shoulder
+    python training.py --models Hand --epochs 5 --batch-size 32
+    python training.py --check-pipeline        # each image once per epoch, no training
+
+Weights are written to weights/ under the names predictions.py loads, and the
+accuracy/loss curves to plots/.
+"""
+import argparse
+import os
+import time
+from typing import Dict, List, Tuple
+import numpy as np
+import tensorflow as tf
+from colorama import Fore
+from tabulate import tabulate
+from cascade import categories_parts, categories_fracture
+from dataset_index import DatasetIndex
+from image_io import decode_image, size
+from registry import model_files
+
+THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Models this script can train: 'Parts' classifies the body part, the others are fracture models
+trainable_models = list(model_files)
+
+
+def _decode(path: bytes) -> np.ndarray:
+    return decode_image(path.decode())
+
+
+def load_image(path: tf.Tensor) -> tf.Tensor:
+    image = tf.numpy_function(_decode, [path], tf.float32, stateful=False)
+    image.set_shape((size, size, 3))
+    return image
+
+
+def file_order(paths: List[str], labels: np.ndarray, n_classes: int, training: bool = True,
+               seed: int = 42) -> tf.data.Dataset:
+    """
+    (path, one-hot label) pairs in the order they are read: with `training`,
+    one permutation of the whole list per epoch, so every file is read exactly once.
+    """
+    one_hot = np.eye(n_classes, dtype=np.float32)[np.asarray(labels)]
+    files = tf.data.Dataset.from_tensor_slices((np.asarray(paths, dtype=str), one_hot))
+    if training:
+        files = files.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    return files
+
+
+def input_pipeline(paths: List[str], labels: np.ndarray, n_classes: int, batch_size: int = 64,
+                   training: bool = True, seed: int = 42) -> tf.data.Dataset:
+    """
+    tf.data pipeline of (preprocessed images, one-hot labels).
+
+    Files are decoded with parallel calls, so slow files do not stall the
+    others. With `training`, the files are reshuffled every epoch and half
+    of the images are flipped horizontally (the augmentation of the
+    notebooks). Both are drawn from `seed` and the pipeline keeps element
+    order, so the batches are the same from run to run.
+    """
+    dataset = file_order(paths, labels, n_classes, training, seed).map(
+        lambda path, label: (load_image(path), label), num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+
+    if training:
+        # One draw per image, different every epoch but reproducible from `seed`
+        flips = tf.data.Dataset.random(seed=seed, rerandomize_each_iteration=True)
+        dataset = tf.data.Dataset.zip((dataset, flips)).map(
+            lambda pair, draw: (tf.cond(draw % 2 == 0, lambda: tf.image.flip_left_right(pair[0]),
+                                        lambda: pair[0]), pair[1]),
+            num_parallel_calls=tf.data.AUTOTUNE)
+
+    return (dataset.batch(batch_size)
+            .map(lambda images, y: (tf.keras.applications.resnet50.preprocess_input(images), y),
+                 num_parallel_calls=tf.data.AUTOTUNE)
+            .prefetch(tf.data.AUTOTUNE))
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Report training samples/sec every `every` batches and at the end of each
+    epoch. The rate of every epoch is kept in `history`, and only recorded
+    when `verbose` is off.
+    """
+
+    def __init__(self, batch_size: int, samples_per_epoch: int, every: int = 50, verbose: bool = True):
+        super().__init__()
+        self.batch_size = batch_size
+        self.samples_per_epoch = samples_per_epoch
+        self.every = every
+        self.verbose = verbose
+        self.history: List[float] = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.verbose and self.every and (batch + 1) % self.every == 0:
+            elapsed = time.perf_counter() - self._start
+            print(f" - {(batch + 1) * self.batch_size / elapsed:.1f} samples/sec")
+
+    def on_epoch_end(self, epoch, logs=None):
+        rate = self.samples_per_epoch / (time.perf_counter() - self._start)
+        self.history.append(rate)
+        if logs is not None:
+            logs['samples_per_sec'] = rate
+        if self.verbose:
+            print(Fore.BLUE + f"Epoch {epoch + 1}: {rate:.1f} samples/sec" + Fore.RESET)
+
+
+def build_model(n_classes: int) -> tf.keras.Model:
+    """
+    Frozen ImageNet ResNet50 with the dense head used by all four models.
+    """
+    pretrained_model = tf.keras.applications.ResNet50(
+        input_shape=(size, size, 3),
+        include_top=False,
+        weights='imagenet',
+        pooling='avg'
+    )
+    pretrained_model.trainable = False
+
+    x = tf.keras.layers.Dense(128, activation='relu')(pretrained_model.output)
+    x = tf.keras.layers.Dense(50, activation='relu')(x)
+    outputs = tf.keras.layers.Dense(n_classes, activation='softmax')(x)
+    return tf.keras.Model(pretrained_model.input, outputs)
+
+
+def split_data(data: DatasetIndex, name: str, seed: int = 1) -> Tuple[DatasetIndex, DatasetIndex, DatasetIndex]:
+    """
+    Train/validation/test rows for model `name`, split by patient as in the notebooks
+    (90% train, of which 20% is held out for validation).
+    """
+    if name != 'Parts':
+        data = data.select(part=name)
+    train_data, test_data = data.patient_split(train_size=0.9, seed=seed)
+    train_data, val_data = train_data.patient_split(train_size=0.8, seed=seed)
+    return train_data, val_data, test_data
+
+
+def targets(data: DatasetIndex, name: str) -> Tuple[np.ndarray, int]:
+    # Class indices follow categories_parts / categories_fracture, the order predictions.py reads
+    if name == 'Parts':
+        return data.data['part'], len(categories_parts)
+    return data.data['label'], len(categories_fracture)
+
+
+def train_model(name: str, data: DatasetIndex, weights_dir: str, plots_dir: str = None, epochs: int = 25,
+                batch_size: int = 64, learning_rate: float = 1e-4, patience: int = 3,
+                seed: int = 42) -> Dict[str, object]:
+    """
+    Train model `name` ('Parts', 'Elbow', 'Hand' or 'Shoulder'), save it to
+    `weights_dir` and return its test results and training throughput.
+    """
+    tf.keras.utils.set_random_seed(seed)
+    train_data, val_data, test_data = split_data(data, name)
+    train_y, n_classes = targets(train_data, name)
+    val_y, _ = targets(val_data, name)
+    test_y, _ = targets(test_data, name)
+
+    train_images = input_pipeline(train_data.image_paths(), train_y, n_classes, batch_size, training=True, seed=seed)
+    val_images = input_pipeline(val_data.image_paths(), val_y, n_classes, batch_size, training=False)
+    test_images = input_pipeline(test_data.image_paths(), test_y, n_classes, 32, training=False)
+
+    model = build_model(n_classes)
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                  loss='categorical_crossentropy', metrics=['accuracy'])
+
+    print(Fore.YELLOW + f"-------Training {name} ({len(train_data)} train, {len(val_data)} validation, "
+                        f"{len(test_data)} test images)-------" + Fore.RESET)
+    throughput = ThroughputCallback(batch_size, len(train_data))
+    callbacks = [
+        tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=patience, restore_best_weights=True),
+        throughput
+    ]
+    history = model.fit(train_images, validation_data=val_images, epochs=epochs, callbacks=callbacks)
+
+    os.makedirs(weights_dir, exist_ok=True)
+    model.save(os.path.join(weights_dir, model_files[name]))
+    loss, accuracy = model.evaluate(test_images, verbose=0)
+    print(Fore.BLUE + f"{name} test accuracy: {np.round(accuracy * 100, 2)}%" + Fore.RESET)
+
+    if plots_dir is not None:
+        plot_history(history.history, os.path.join(plots_dir, 'BodyParts' if name == 'Parts'
+                                                   else os.path.join('FractureDetection', name)))
+
+    return {
+        'test_loss': loss,
+        'test_accuracy': accuracy,
+        'epochs': len(history.history['loss']),
+        'samples_per_sec': float(np.mean(throughput.history)) if throughput.history else 0.0
+    }
+
+
+def check_epochs(paths: List[str], seed: int = 42, epochs: int = 2) -> bool:
+    """
+    Check that each training epoch reads every path exactly once, in a new order.
+    """
+    files = file_order(paths, np.zeros(len(paths), dtype=int), 1, training=True, seed=seed)
+    orders = []
+    for epoch in range(epochs):
+        order = [path.decode() for path, _ in files.as_numpy_iterator()]
+        orders.append(order)
+        if sorted(order) != sorted(paths):
+            print(Fore.RED + f"Epoch {epoch + 1}: {len(order)} reads, {len(set(order))} of {len(paths)} "
+                             f"distinct images" + Fore.RESET)
+            return False
+    if epochs > 1 and all(order == orders[0] for order in orders[1:]):
+        print(Fore.RED + "Every epoch used the same order" + Fore.RESET)
+        return False
+    return True
+
+
+def plot_history(history: Dict[str, List[float]], plot_dir: str) -> None:
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(plot_dir, exist_ok=True)
+    for metric, title in (('accuracy', 'Model Accuracy'), ('loss', 'Model Loss')):
+        plt.plot(history[metric])
+        plt.plot(history['val_' + metric])
+        plt.title(title)
+        plt.ylabel(metric.capitalize())
+        plt.xlabel('Epoch')
+        plt.legend(['Train', 'Validation'], loc='upper left')
+        plt.savefig(os.path.join(plot_dir, f"_{metric.capitalize()}.jpeg"))
+        plt.clf()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dataset', default=os.path.join(THIS_FOLDER, 'Dataset'))
+    parser.add_argument('--weights', default=os.path.join(THIS_FOLDER, 'weights'))
+    parser.add_argument('--plots', default=os.path.join(THIS_FOLDER, 'plots'))
+    parser.add_argument('--models', nargs='+', default=trainable_models, choices=trainable_models)
+    parser.add_argument('--epochs', type=int, default=25)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--learning-rate', type=float, default=1e-4)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--deterministic', action='store_true',
+                        help="Also make TensorFlow ops deterministic (slower)")
+    parser.add_argument('--check-pipeline', action='store_true',
+                        help="Check that each epoch reads every training image once, then exit")
+    args = parser.parse_args()
+
+    if args.deterministic:
+        tf.config.experimental.enable_op_determinism()
+
+    data = DatasetIndex.load(args.dataset)
+    if args.check_pipeline:
+        for name in args.models:
+            train_paths = split_data(data, name)[0].image_paths()
+            ok = check_epochs(train_paths, args.seed)
+            print(f"{name}: {len(train_paths)} training images, {'ok' if ok else 'FAILED'}")
+            if not ok:
+                raise SystemExit(1)
+        raise SystemExit(0)
+
+    summary = [["Model", "Epochs", "Test accuracy", "Samples/sec"]]
+    for name in args.models:
+        result = train_model(name, data, args.weights, args.plots, args.epochs, args.batch_size,
+                             args.learning_rate, seed=args.seed)
+        summary.append([name, result['epochs'], f"{result['test_accuracy'] * 100:.2f}%",
+                        f"{result['samples_per_sec']:.1f}"])
+
+    print(Fore.BLUE + "\nTraining summary:")
+    print(tabulate(summary, headers="firstrow", tablefmt="grid", disable_numparse=True))